@@ -1,15 +1,60 @@
 import re
+import math
 import random
-from typing import List, Optional, Dict, Any
+from collections import Counter
+from typing import List, Optional, Dict, Any, Mapping
+
+TOKEN_RE = re.compile(r"[a-z0-9_]+")
+MAX_TERM_LENGTH = 64
+
+STOPWORDS = frozenset("""
+about above after again against all also and any are aren because been before being below between both but
+can cannot could couldn did didn does doesn doing don down during each few for from further get got had hadn
+has hasn have haven having her here hers herself him himself his how into isn its itself just let more most
+much must mustn myself nor not now off once only other our ours ourselves out over own same she should
+shouldn some such than that the their theirs them themselves then there these they this those through too
+under until very was wasn were weren what when where which while who whom why will with won would wouldn
+you your yours yourself yourselves today went going really one two lot
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, without stopwords and very short words"""
+    return [w for w in TOKEN_RE.findall(text.lower()) if 3 <= len(w) <= MAX_TERM_LENGTH and w not in STOPWORDS]
 
 # very simple keyword extractor placeholder
 def extract_keywords(text: str, k: int = 5) -> List[str]:
-    words = re.findall(r"[A-Za-z0-9_]+", text.lower())
-    freq = {}
-    for w in words:
-        if len(w) < 3: continue
-        freq[w] = freq.get(w, 0) + 1
-    return [w for w, _ in sorted(freq.items(), key=lambda x: -x[1])[:k]]
+    freq = Counter(tokenize(text))
+    return [w for w, _ in freq.most_common(k)]
+
+def tfidf_keywords(
+    token_lists: List[List[str]],
+    doc_freq: Mapping[str, int],
+    doc_count: int,
+    k: int = 5
+) -> List[List[str]]:
+    """
+    Score every document of a batch at once with TF-IDF.
+    doc_freq/doc_count are the corpus statistics including this batch.
+    """
+    idf_cache: Dict[str, float] = {}
+    results = []
+    for tokens in token_lists:
+        if not tokens:
+            results.append([])
+            continue
+        counts = Counter(tokens)
+        length = len(tokens)
+        scores = []
+        for term, count in counts.items():
+            idf = idf_cache.get(term)
+            if idf is None:
+                idf = math.log((1 + doc_count) / (1 + doc_freq.get(term, 0))) + 1
+                idf_cache[term] = idf
+            scores.append((count / length * idf, term))
+        # Stable sort keeps first-appearance order among equal scores
+        scores.sort(key=lambda item: -item[0])
+        results.append([term for _, term in scores[:k]])
+    return results
 
 # simple "AI" summarizer stub (replace with real LLM call)
 async def summarize(text: str) -> str:
@@ -231,6 +276,19 @@ def generate_clarification_questions(
     return questions[:2]
 
 
+def vision_message(prompt: str, image_bytes: bytes) -> Dict[str, Any]:
+    """Chat message with the prompt and the JPEG inlined as a base64 data URL (GPT-4 Vision)"""
+    import base64
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "high"}},
+        ],
+    }
+
+
 def create_timeline_narrative(
     image_bytes: bytes,
     caption: str = "",
@@ -242,19 +300,16 @@ def create_timeline_narrative(
     Generate a friendly journalist-style narrative using GPT-4 Vision.
     Analyzes the image directly and creates contextually aware descriptions.
     """
-    import base64
     import json
     from datetime import datetime
-    from openai import OpenAI
     from .settings import settings
+    from .image_processor import get_openai_client
+    from . import resilience
     
     if not settings.openai_api_key:
         return "A moment captured in time."
     
     try:
-        # Encode image for GPT-4 Vision
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        
         # Parse datetime for smart context
         day_of_week = ""
         time_context = ""
@@ -321,28 +376,12 @@ Example good outputs:
 - "{user_name} captured the sunrise during an early morning hike before starting his workday"
 """
 
-        client = OpenAI(api_key=settings.openai_api_key)
+        client = get_openai_client()
         
-        response = client.chat.completions.create(
+        response = resilience.call(
+            "openai", client.chat.completions.create,
             model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "high"
-                            }
-                        }
-                    ]
-                }
-            ],
+            messages=[vision_message(prompt, image_bytes)],
             max_tokens=150,
             temperature=0.7
         )
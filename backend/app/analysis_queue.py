@@ -0,0 +1,272 @@
+"""
+Shared queue of bulk analysis jobs
+The import and reprocess CLIs run in processes of their own, so handing
+their work to a scheduler there would compete with interactive uploads for
+provider quota and DB time instead of yielding to them. They insert jobs
+into analysis_jobs instead, and every API process drains the table onto
+its own analysis scheduler (see scheduler.py), where bulk jobs wait behind
+uploads and share the workers fairly.
+
+A drainer only claims as many jobs as its scheduler has background workers
+free, round-robin over (priority, session) flows, with FOR UPDATE SKIP
+LOCKED so API workers never claim the same job. A job claimed by a process
+that died is queued again after ANALYSIS_QUEUE_LEASE_SECONDS. The CLIs
+poll the table for the outcome; with --drain they also run the jobs
+themselves, for setups without a running API.
+"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set
+from sqlalchemy import delete, func, select, update
+from .settings import settings
+from .db import SessionLocal
+from . import metrics, models, scheduler
+
+ANALYZE = "analyze"
+REPROCESS = "reprocess"
+OPEN = ("queued", "running")
+SWEEP_SECONDS = 60
+STALLED_WARNING_SECONDS = 60  # queued jobs nobody picks up for this long get a hint
+FINISHED_RETENTION = timedelta(days=1)
+
+
+def enqueue(priority: str, session_id: str, task: str, event_id: int, **params: Any) -> int:
+    """Queue a job unless the event already has an open one of that task; returns its id"""
+    with SessionLocal() as db:
+        existing = db.scalar(
+            select(models.AnalysisJob.id).where(
+                models.AnalysisJob.event_id == event_id,
+                models.AnalysisJob.task == task,
+                models.AnalysisJob.status.in_(OPEN),
+            )
+        )
+        if existing is not None:
+            return existing
+        job = models.AnalysisJob(priority=priority, session_id=session_id, task=task, event_id=event_id,
+                                 params=params, status="queued")
+        db.add(job)
+        db.commit()
+        metrics.inc(f"analysis_queue_{priority}_enqueued")
+        return job.id
+
+
+def statuses(job_ids: Iterable[int]) -> Dict[int, str]:
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(models.AnalysisJob.id, models.AnalysisJob.status).where(models.AnalysisJob.id.in_(job_ids))
+        ).all()
+    return {row.id: row.status for row in rows}
+
+
+def wait(job_ids: Iterable[int], room: int = 0) -> Dict[int, str]:
+    """Block until at most room of the jobs are queued or running; returns the status of each"""
+    job_ids = set(job_ids)
+    idle_since = time.monotonic()
+    while True:
+        # Rows removed meanwhile (retention) count as done
+        found = statuses(job_ids)
+        current = {job_id: found.get(job_id, "completed") for job_id in job_ids}
+        if sum(status in OPEN for status in current.values()) <= room:
+            return current
+        if "running" in current.values():
+            idle_since = time.monotonic()
+        elif idle_since and time.monotonic() - idle_since > STALLED_WARNING_SECONDS:
+            print("Analysis queue: no worker is taking jobs; start the API or run the CLI with --drain")
+            idle_since = 0.0
+        time.sleep(settings.analysis_queue_poll_seconds)
+
+
+def cancel(job_ids: Iterable[int]) -> int:
+    """Drop jobs nobody claimed yet; running ones finish"""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return 0
+    with SessionLocal() as db:
+        deleted = db.execute(
+            delete(models.AnalysisJob).where(models.AnalysisJob.id.in_(job_ids), models.AnalysisJob.status == "queued")
+        ).rowcount
+        db.commit()
+    return deleted
+
+
+def run_job(task: str, event_id: int, session_id: str, params: Dict[str, Any]) -> str:
+    """Run one job in this process; "completed" or "failed" from the event's outcome"""
+    if task == REPROCESS:
+        from .reprocess import reprocess_event
+        return reprocess_event(event_id, params["stages"])
+    from .image_processor import process_image_async
+    process_image_async(event_id, params["s3_key"], params.get("caption") or "", session_id,
+                        memory_estimate=params.get("memory_estimate"))
+    with SessionLocal() as db:
+        status = db.scalar(select(models.Event.processing_status).where(models.Event.id == event_id))
+    return "completed" if status == "completed" else "failed"
+
+
+class Drainer:
+    """Moves queued jobs onto this process's scheduler while it has background workers free"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight: Set[int] = set()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_sweep = 0.0
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="analysis-queue", daemon=True)
+            self.thread.start()
+
+    def _free_slots(self) -> int:
+        local = scheduler.scheduler()
+        status = local.status()
+        background = sum(count for priority, count in status["running"].items() if priority != scheduler.INTERACTIVE)
+        background += sum(count for priority, count in status["queued"].items() if priority != scheduler.INTERACTIVE)
+        return local.workers - local.reserved_interactive - background
+
+    def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        """Up to limit queued jobs, taking one per flow in turn (oldest first within a flow)"""
+        ranked = select(
+            models.AnalysisJob.id,
+            func.row_number().over(
+                partition_by=(models.AnalysisJob.priority, models.AnalysisJob.session_id),
+                order_by=models.AnalysisJob.id,
+            ).label("rank"),
+        ).where(models.AnalysisJob.status == "queued").subquery()
+        with SessionLocal() as db:
+            jobs = db.scalars(
+                select(models.AnalysisJob)
+                .join(ranked, ranked.c.id == models.AnalysisJob.id)
+                .where(models.AnalysisJob.status == "queued")
+                .order_by(ranked.c.rank, models.AnalysisJob.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True, of=models.AnalysisJob)
+            ).all()
+            now = datetime.now(timezone.utc)
+            claimed = []
+            for job in jobs:
+                job.status = "running"
+                job.claimed_at = now
+                claimed.append({"id": job.id, "priority": job.priority, "session_id": job.session_id,
+                                "task": job.task, "event_id": job.event_id, "params": job.params})
+            db.commit()
+        return claimed
+
+    def _finish(self, job_id: int, status: str) -> None:
+        with SessionLocal() as db:
+            db.execute(update(models.AnalysisJob).where(models.AnalysisJob.id == job_id)
+                       .values(status=status, finished_at=datetime.now(timezone.utc)))
+            db.commit()
+        with self.lock:
+            self.in_flight.discard(job_id)
+        metrics.inc(f"analysis_queue_{status}")
+        self.wakeup.set()  # a worker is free again
+
+    def _submit(self, job: Dict[str, Any]) -> None:
+        future = scheduler.submit(job["priority"], job["session_id"], run_job,
+                                  job["task"], job["event_id"], job["session_id"], job["params"])
+
+        def done(future, job_id=job["id"]):
+            try:
+                status = "failed" if future.cancelled() or future.exception() else future.result()
+                self._finish(job_id, status)
+            except Exception as e:
+                print(f"Analysis queue: could not record job {job_id}: {e}")
+
+        with self.lock:
+            self.in_flight.add(job["id"])
+        future.add_done_callback(done)
+
+    def _sweep(self) -> None:
+        """Queue jobs of processes that died mid-job again; forget old finished jobs"""
+        now = datetime.now(timezone.utc)
+        with SessionLocal() as db:
+            requeued = db.execute(
+                update(models.AnalysisJob)
+                .where(models.AnalysisJob.status == "running",
+                       models.AnalysisJob.claimed_at < now - timedelta(seconds=settings.analysis_queue_lease_seconds))
+                .values(status="queued", claimed_at=None)
+            ).rowcount
+            db.execute(delete(models.AnalysisJob).where(
+                models.AnalysisJob.status.in_(("completed", "failed")),
+                models.AnalysisJob.finished_at < now - FINISHED_RETENTION,
+            ))
+            db.commit()
+        if requeued:
+            print(f"Analysis queue: {requeued} jobs whose lease expired are queued again")
+
+    def _loop(self) -> None:
+        while not self.stopped.is_set():
+            claimed = 0
+            try:
+                if time.monotonic() - self.last_sweep >= SWEEP_SECONDS:
+                    self.last_sweep = time.monotonic()
+                    self._sweep()
+                slots = self._free_slots()
+                if slots > 0:
+                    for job in self._claim(slots):
+                        self._submit(job)
+                        claimed += 1
+            except Exception as e:
+                print(f"Analysis queue: {e.__class__.__name__}: {e}")
+            if not claimed:
+                self.wakeup.wait(settings.analysis_queue_poll_seconds)
+                self.wakeup.clear()
+
+    def stop(self) -> int:
+        """Stop claiming and hand jobs still running here back to the queue; returns how many"""
+        self.stopped.set()
+        self.wakeup.set()
+        with self.lock:
+            in_flight = list(self.in_flight)
+            self.in_flight.clear()
+        if not in_flight:
+            return 0
+        with SessionLocal() as db:
+            db.execute(update(models.AnalysisJob)
+                       .where(models.AnalysisJob.id.in_(in_flight), models.AnalysisJob.status == "running")
+                       .values(status="queued", claimed_at=None))
+            db.commit()
+        return len(in_flight)
+
+
+_drainer: Optional[Drainer] = None
+_drainer_lock = threading.Lock()
+
+
+def start_drainer() -> Drainer:
+    global _drainer
+    with _drainer_lock:
+        if _drainer is None:
+            _drainer = Drainer()
+            _drainer.start()
+        return _drainer
+
+
+def stop_drainer() -> int:
+    with _drainer_lock:
+        return _drainer.stop() if _drainer is not None else 0
+
+
+def queue_metrics() -> Dict[str, Any]:
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(models.AnalysisJob.priority, models.AnalysisJob.status, func.count())
+            .where(models.AnalysisJob.status.in_(OPEN))
+            .group_by(models.AnalysisJob.priority, models.AnalysisJob.status)
+        ).all()
+    counts: Dict[str, Dict[str, int]] = {}
+    for priority, status, count in rows:
+        counts.setdefault(priority, {})[status] = count
+    with _drainer_lock:
+        draining = _drainer is not None and not _drainer.stopped.is_set()
+        in_flight = len(_drainer.in_flight) if _drainer is not None else 0
+    return {"draining": draining, "in_flight_here": in_flight, "jobs": counts}
+
+
+metrics.register_collector("analysis_queue", queue_metrics)
@@ -0,0 +1,296 @@
+"""
+Burst and near-duplicate detection
+Phones shoot bursts of nearly identical photos, and each would otherwise
+run the whole vision, geocoding and OpenAI pipeline. Image events get a
+signature when they are uploaded or imported: capture time, a 64-bit
+difference hash and a sharpness score (image_formats.perceptual_signature).
+Photos taken at most BURST_WINDOW_SECONDS apart whose hashes differ in at
+most BURST_MAX_DISTANCE bits belong to one burst. The (session_id,
+taken_at) index narrows the lookup to the few photos of that window, so
+Hamming distances are only computed for a handful of rows.
+
+Only one photo per burst is analyzed. When the first job of a burst
+starts, the sharpest of its photos not yet claimed becomes the
+representative (join_burst); later photos join it. Followers inherit its
+results when it completes (share_results), with "burst_of" in ai_results.
+If it fails or is purged, its followers are analyzed on their own again
+(release_followers, release_purged). Photos whose
+captions differ are never grouped, since the caption shapes the narrative.
+Inherited events and the provider calls they saved appear in /metrics;
+python -m app.bursts reports them per session.
+"""
+import argparse
+import copy
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import select, text, update
+from sqlalchemy.orm import Session
+from .settings import settings
+from .db import SessionLocal
+from .image_formats import sniff_format, exif_datetime, perceptual_signature, JPEG
+from . import metrics, models
+
+HASH_MASK = (1 << 64) - 1
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & HASH_MASK).bit_count()
+
+
+def image_signature(image_bytes: bytes, preview_bytes: Optional[bytes] = None) -> Optional[Dict[str, Any]]:
+    """
+    {"phash", "sharpness", "exif_time"} of a new image, hashed from the JPEG
+    itself or, for other formats, from its preview; None when neither is
+    usable or detection is off. Cheap enough for the upload request.
+    """
+    if not settings.burst_detection:
+        return None
+    source = image_bytes if sniff_format(image_bytes) == JPEG else preview_bytes
+    if not source:
+        return None
+    try:
+        phash, sharpness = perceptual_signature(source)
+    except Exception as e:
+        print(f"Perceptual hash failed: {e}")
+        return None
+    try:
+        exif_time = exif_datetime(image_bytes)
+    except Exception:
+        exif_time = None
+    # BigInteger is signed
+    return {"phash": phash - (1 << 64) if phash >= 1 << 63 else phash, "sharpness": sharpness, "exif_time": exif_time}
+
+
+def add_signature(db: Session, event: models.Event, signature: Optional[Dict[str, Any]],
+                  timestamp: Optional[str] = None) -> None:
+    """Store an event's signature; timestamp (HEIC metadata or sidecar, ISO) wins over the EXIF time"""
+    if not signature:
+        return
+    taken_at = signature["exif_time"]
+    if timestamp:
+        try:
+            taken_at = datetime.fromisoformat(timestamp)
+        except (ValueError, TypeError):
+            pass
+    if taken_at is None:
+        return  # a photo without capture time cannot be placed in a burst
+    db.add(models.PhotoSignature(
+        event_id=event.id, session_id=event.session_id, taken_at=taken_at,
+        phash=signature["phash"], sharpness=signature["sharpness"],
+    ))
+
+
+def provider_calls(ai_results: Dict[str, Any], caption: str) -> int:
+    """Provider requests the pipeline made to produce these results"""
+    calls = 1  # labels
+    calls += sum(1 for step in (ai_results.get("plan") or {}).values() if step.get("run"))
+    if settings.openai_api_key:
+        calls += 2  # classification and narrative
+        if not caption or len(caption.strip()) <= 3:
+            calls += 1  # clarification questions
+    return calls
+
+
+def _lock_session(db: Session, session_id: str) -> None:
+    """Serialize burst assignment per session across worker threads/processes"""
+    if db.bind.dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"burst:{session_id}"})
+
+
+def _same_caption(a: Optional[str], b: Optional[str]) -> bool:
+    return (a or "").strip().lower() == (b or "").strip().lower()
+
+
+def _candidates(db: Session, signature: models.PhotoSignature, caption: Optional[str]) -> List[models.PhotoSignature]:
+    """Signatures of other photos in the burst window that look the same"""
+    window = timedelta(seconds=settings.burst_window_seconds)
+    rows = db.execute(
+        select(models.PhotoSignature, models.Event.processing_status, models.Event.user_caption)
+        .join(models.Event, models.Event.id == models.PhotoSignature.event_id)
+        .where(
+            models.PhotoSignature.session_id == signature.session_id,
+            models.PhotoSignature.taken_at.between(signature.taken_at - window, signature.taken_at + window),
+            models.PhotoSignature.event_id != signature.event_id,
+        )
+    ).all()
+    return [
+        other for other, status, other_caption in rows
+        if status != "failed" and _same_caption(caption, other_caption)
+        and hamming(other.phash, signature.phash) <= settings.burst_max_distance
+    ]
+
+
+def _representative_for(db: Session, signature: models.PhotoSignature, caption: Optional[str]) -> int:
+    """Join the burst's representative, or pick one among the photos nobody claimed yet"""
+    candidates = _candidates(db, signature, caption)
+    claimed = [other for other in candidates if other.burst_of is not None]
+    if claimed:
+        nearest = min(claimed, key=lambda other: abs(other.taken_at - signature.taken_at))
+        signature.burst_of = nearest.burst_of
+        return signature.burst_of
+    members = [signature] + candidates
+    representative = max(members, key=lambda member: (member.sharpness, -member.event_id))
+    for member in members:
+        member.burst_of = representative.event_id
+    if len(members) > 1:
+        metrics.inc("burst_groups")
+        print(f"Burst of {len(members)} photos in session {signature.session_id}: "
+              f"event {representative.event_id} is analyzed for all of them")
+    return representative.event_id
+
+
+def join_burst(db: Session, event: models.Event) -> Optional[models.Event]:
+    """
+    The representative whose results event shares, or None when the event
+    is analyzed itself. Inherits right away when the representative is
+    already complete; otherwise its share_results will. Commits.
+    """
+    _lock_session(db, event.session_id)
+    db.refresh(event)
+    signature = db.get(models.PhotoSignature, event.id)
+    if signature is None or not settings.burst_detection:
+        db.commit()
+        return None
+    representative_id = signature.burst_of
+    representative = None
+    if representative_id is not None and representative_id != event.id:
+        representative = db.get(models.Event, representative_id)
+        if representative is None or representative.processing_status == "failed":
+            representative_id = None  # e.g. purged while this job was queued; group again
+    if representative_id is None:
+        representative_id = _representative_for(db, signature, event.user_caption)
+        representative = db.get(models.Event, representative_id) if representative_id != event.id else None
+    if representative is None:
+        db.commit()
+        return None
+    if event.processing_status == "completed":
+        db.commit()  # shared while this job was queued
+    elif representative.processing_status == "completed":
+        inherit(db, event, representative)  # commits, which releases the lock
+    else:
+        db.commit()
+        print(f"Event {event.id} is a near-duplicate of event {representative.id}; it shares its results")
+    return representative
+
+
+def inherit(db: Session, event: models.Event, representative: models.Event, saved: bool = True) -> None:
+    """Complete event with a copy of its representative's results (saved=False: a refreshed copy)"""
+    from .image_processor import save_results
+    signature = db.get(models.PhotoSignature, event.id)
+    results = copy.deepcopy(representative.ai_results or {})
+    results["burst_of"] = representative.id
+    save_results(db, event, results, representative.summary, signature.taken_at if signature else None)
+    if not saved:
+        return  # the provider calls were already counted as saved the first time
+    metrics.inc("burst_inherited_events")
+    metrics.inc("burst_saved_provider_calls", provider_calls(results, event.user_caption or ""))
+
+
+def share_results(db: Session, representative: models.Event, refresh: bool = False) -> None:
+    """
+    Hand a completed representative's results to the followers waiting for
+    them; with refresh (after reprocessing it) also replace the copies
+    followers inherited earlier
+    """
+    follower_ids = db.scalars(
+        select(models.PhotoSignature.event_id).where(
+            models.PhotoSignature.burst_of == representative.id,
+            models.PhotoSignature.event_id != representative.id,
+        )
+    ).all()
+    for follower_id in follower_ids:
+        # One locked transaction per follower, so its own job never inherits a second time
+        _lock_session(db, representative.session_id)
+        follower = db.get(models.Event, follower_id, populate_existing=True)
+        if follower is not None and follower.processing_status == "pending":
+            inherit(db, follower, representative)
+        elif (refresh and follower is not None and follower.processing_status == "completed"
+              and (follower.ai_results or {}).get("burst_of") == representative.id):
+            inherit(db, follower, representative, saved=False)
+        else:
+            db.commit()
+
+
+def release_followers(db: Session, representative: models.Event) -> List[models.Event]:
+    """
+    Ungroup a failed representative's burst, committing together with the
+    caller's pending changes (its failed status). Returns the followers
+    still waiting, which must be analyzed again; they regroup among themselves.
+    """
+    _lock_session(db, representative.session_id)
+    followers = db.scalars(
+        select(models.Event)
+        .join(models.PhotoSignature, models.PhotoSignature.event_id == models.Event.id)
+        .where(models.PhotoSignature.burst_of == representative.id,
+               models.Event.id != representative.id,
+               models.Event.processing_status == "pending")
+    ).all()
+    db.execute(
+        update(models.PhotoSignature).where(models.PhotoSignature.burst_of == representative.id).values(burst_of=None)
+    )
+    db.commit()
+    return list(followers)
+
+
+def release_purged(db: Session, event_ids: List[int], session_ids: Iterable[str]) -> List[Any]:
+    """
+    Ungroup the bursts of events being purged, in the caller's transaction.
+    Returns (id, session_id, source, user_caption) of their followers still
+    waiting; pass them to analyze_again once the purge commits.
+    """
+    for session_id in sorted(set(session_ids)):
+        _lock_session(db, session_id)
+    followers = db.execute(
+        select(models.Event.id, models.Event.session_id, models.Event.source, models.Event.user_caption)
+        .join(models.PhotoSignature, models.PhotoSignature.event_id == models.Event.id)
+        .where(models.PhotoSignature.burst_of.in_(event_ids),
+               models.Event.id.not_in(event_ids),
+               models.Event.processing_status == "pending")
+    ).all()
+    db.execute(
+        update(models.PhotoSignature).where(models.PhotoSignature.burst_of.in_(event_ids)).values(burst_of=None)
+    )
+    return list(followers)
+
+
+def analyze_again(followers: Iterable[Any]) -> None:
+    """Queue released followers for analysis on the shared queue (any API worker runs them)"""
+    from . import analysis_queue, scheduler
+    for follower in followers:
+        analysis_queue.enqueue(scheduler.IMPORT, follower.session_id, analysis_queue.ANALYZE, follower.id,
+                               s3_key=follower.source, caption=follower.user_caption or "")
+    if followers:
+        print(f"Burst: {len(followers)} photos whose representative was purged are analyzed again")
+
+
+def session_report(session_id: str) -> Dict[str, Any]:
+    """Bursts of a session and the provider calls their followers did not make"""
+    report = {"signatures": 0, "bursts": 0, "inherited_events": 0, "waiting_events": 0, "saved_provider_calls": 0}
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(models.PhotoSignature.event_id, models.PhotoSignature.burst_of,
+                   models.Event.processing_status, models.Event.ai_results, models.Event.user_caption)
+            .join(models.Event, models.Event.id == models.PhotoSignature.event_id)
+            .where(models.PhotoSignature.session_id == session_id)
+        ).all()
+    representatives = set()
+    for event_id, burst_of, status, ai_results, caption in rows:
+        report["signatures"] += 1
+        if burst_of is None or burst_of == event_id:
+            continue
+        representatives.add(burst_of)
+        if status == "completed" and (ai_results or {}).get("burst_of") == burst_of:
+            report["inherited_events"] += 1
+            report["saved_provider_calls"] += provider_calls(ai_results, caption or "")
+        elif status == "pending":
+            report["waiting_events"] += 1
+    report["bursts"] = len(representatives)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report photo bursts and the analysis they saved")
+    parser.add_argument("--session-id", required=True)
+    args = parser.parse_args()
+    for key, value in session_report(args.session_id).items():
+        print(f"{key}: {value}")
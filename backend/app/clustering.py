@@ -0,0 +1,317 @@
+"""
+Incremental moment clustering
+Completed events are assigned to clusters at three levels:
+- "day":   consecutive moments separated by a short time gap and distance (an outing)
+- "trip":  moments away from the home city separated by at most a couple of days
+- "place": moments within a small radius of each other, regardless of time
+
+Time-based levels only look at the nearest earlier and later member (two
+index range lookups), so an insert is O(log n) no matter how large the
+session is or in what order photos arrive. A late photo that bridges two
+clusters merges the smaller one into the larger (union by size).
+"""
+import math
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import select, update, delete, text
+from sqlalchemy.orm import Session
+from .settings import settings
+from .db import SessionLocal
+from .geo import haversine_km, valid_coordinates
+from .rollups import as_utc, event_time
+from . import models
+
+TIME_LEVELS = ("day", "trip")
+LEVELS = TIME_LEVELS + ("place",)
+# Place clusters are looked up in a grid of ~1.1 km cells around the point
+PLACE_CELL_DEGREES = 0.01
+
+
+class Moment:
+    """The clustering-relevant facts about one event"""
+
+    def __init__(self, event_id: int, session_id: str, taken_at: datetime,
+                 latitude: Optional[float] = None, longitude: Optional[float] = None, city: Optional[str] = None):
+        self.event_id = event_id
+        self.session_id = session_id
+        self.taken_at = as_utc(taken_at)
+        self.has_location = valid_coordinates(latitude, longitude)
+        self.latitude = latitude if self.has_location else None
+        self.longitude = longitude if self.has_location else None
+        self.city = city
+
+    @classmethod
+    def from_member(cls, member: models.ClusterMember) -> "Moment":
+        return cls(member.event_id, member.session_id, member.taken_at, member.latitude, member.longitude, member.city)
+
+
+def level_thresholds(level: str):
+    """(max time gap, max distance in km or None) between neighbours of a time level"""
+    if level == "day":
+        return timedelta(hours=settings.cluster_day_gap_hours), settings.cluster_day_distance_km
+    return timedelta(hours=settings.cluster_trip_gap_hours), None
+
+
+def is_away(moment: Moment) -> bool:
+    home = settings.user_profile.get("city", "")
+    return bool(moment.city) and moment.city.lower() != home.lower()
+
+
+def close(level: str, a: Moment, b: Moment) -> bool:
+    max_gap, max_km = level_thresholds(level)
+    if abs(a.taken_at - b.taken_at) > max_gap:
+        return False
+    if max_km is not None and a.has_location and b.has_location:
+        return haversine_km(a.latitude, a.longitude, b.latitude, b.longitude) <= max_km
+    return True
+
+
+def _lock_session(db: Session, session_id: str) -> None:
+    """Serialize clustering per session across worker threads/processes"""
+    if db.bind.dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:session_id))"), {"session_id": session_id})
+
+
+def _neighbour(db: Session, level: str, moment: Moment, earlier: bool) -> Optional[models.ClusterMember]:
+    member = models.ClusterMember
+    query = select(member).where(
+        member.session_id == moment.session_id,
+        member.level == level,
+        member.event_id != moment.event_id,
+    )
+    if earlier:
+        query = query.where(member.taken_at <= moment.taken_at).order_by(member.taken_at.desc())
+    else:
+        query = query.where(member.taken_at >= moment.taken_at).order_by(member.taken_at.asc())
+    return db.execute(query.limit(1)).scalar_one_or_none()
+
+
+def _new_cluster(db: Session, level: str, moment: Moment) -> models.MomentCluster:
+    cluster = models.MomentCluster(
+        session_id=moment.session_id, level=level, event_count=0,
+        lat_sum=0, lon_sum=0, geo_count=0, city_counts={},
+    )
+    if level == "place":
+        cluster.cell_lat, cluster.cell_lon = _cell(moment)
+    db.add(cluster)
+    db.flush()
+    return cluster
+
+
+def _add_to_cluster(cluster: models.MomentCluster, moment: Moment) -> None:
+    cluster.event_count += 1
+    start, end = as_utc(cluster.start_at), as_utc(cluster.end_at)
+    cluster.start_at = min(start, moment.taken_at) if start else moment.taken_at
+    cluster.end_at = max(end, moment.taken_at) if end else moment.taken_at
+    if moment.has_location:
+        cluster.lat_sum += moment.latitude
+        cluster.lon_sum += moment.longitude
+        cluster.geo_count += 1
+    if moment.city:
+        counts = dict(cluster.city_counts or {})
+        counts[moment.city] = counts.get(moment.city, 0) + 1
+        cluster.city_counts = counts
+
+
+def _merge(db: Session, keep: models.MomentCluster, absorb: models.MomentCluster) -> None:
+    """Move every member of absorb into keep (absorb is the smaller cluster)"""
+    db.execute(
+        update(models.ClusterMember)
+        .where(models.ClusterMember.cluster_id == absorb.id)
+        .values(cluster_id=keep.id)
+    )
+    keep.event_count += absorb.event_count
+    keep.start_at = min(as_utc(keep.start_at), as_utc(absorb.start_at))
+    keep.end_at = max(as_utc(keep.end_at), as_utc(absorb.end_at))
+    keep.lat_sum += absorb.lat_sum
+    keep.lon_sum += absorb.lon_sum
+    keep.geo_count += absorb.geo_count
+    counts = dict(keep.city_counts or {})
+    for city, count in (absorb.city_counts or {}).items():
+        counts[city] = counts.get(city, 0) + count
+    keep.city_counts = counts
+    db.delete(absorb)
+
+
+def _assign_time_level(db: Session, level: str, moment: Moment) -> models.MomentCluster:
+    neighbours = [
+        member for member in (_neighbour(db, level, moment, True), _neighbour(db, level, moment, False))
+        if member is not None and close(level, moment, Moment.from_member(member))
+    ]
+    cluster_ids = list(dict.fromkeys(member.cluster_id for member in neighbours))
+    if not cluster_ids:
+        return _new_cluster(db, level, moment)
+
+    clusters = [db.get(models.MomentCluster, cluster_id) for cluster_id in cluster_ids]
+    clusters.sort(key=lambda cluster: -cluster.event_count)
+    for smaller in clusters[1:]:
+        _merge(db, clusters[0], smaller)
+    return clusters[0]
+
+
+def _cell(moment: Moment):
+    return math.floor(moment.latitude / PLACE_CELL_DEGREES), math.floor(moment.longitude / PLACE_CELL_DEGREES)
+
+
+def _centroid(cluster: models.MomentCluster):
+    if not cluster.geo_count:
+        return None, None
+    return cluster.lat_sum / cluster.geo_count, cluster.lon_sum / cluster.geo_count
+
+
+def _assign_place(db: Session, moment: Moment) -> models.MomentCluster:
+    cell_lat, cell_lon = _cell(moment)
+    candidates = db.execute(
+        select(models.MomentCluster).where(
+            models.MomentCluster.session_id == moment.session_id,
+            models.MomentCluster.level == "place",
+            models.MomentCluster.cell_lat.between(cell_lat - 1, cell_lat + 1),
+            models.MomentCluster.cell_lon.between(cell_lon - 1, cell_lon + 1),
+        )
+    ).scalars().all()
+
+    best, best_km = None, settings.cluster_place_radius_km
+    for cluster in candidates:
+        latitude, longitude = _centroid(cluster)
+        if latitude is None:
+            continue
+        distance = haversine_km(moment.latitude, moment.longitude, latitude, longitude)
+        if distance <= best_km:
+            best, best_km = cluster, distance
+    return best or _new_cluster(db, "place", moment)
+
+
+def assign_moment(db: Session, moment: Moment) -> Dict[str, int]:
+    """Place one moment into its clusters at every applicable level; the caller commits"""
+    _lock_session(db, moment.session_id)
+    remove_events(db, [moment.event_id])
+
+    assigned = {}
+    for level in LEVELS:
+        if level == "trip" and not is_away(moment):
+            continue
+        if level == "place" and not moment.has_location:
+            continue
+        if level == "place":
+            cluster = _assign_place(db, moment)
+        else:
+            cluster = _assign_time_level(db, level, moment)
+        _add_to_cluster(cluster, moment)
+        db.add(models.ClusterMember(
+            event_id=moment.event_id, level=level, cluster_id=cluster.id,
+            session_id=moment.session_id, taken_at=moment.taken_at,
+            latitude=moment.latitude, longitude=moment.longitude, city=moment.city,
+        ))
+        db.flush()
+        assigned[level] = cluster.id
+    return assigned
+
+
+def event_moment(event, gps: Optional[Dict[str, float]] = None, city: Optional[str] = None) -> Optional[Moment]:
+    """Build a Moment from an event, using the pipeline's GPS and city when given"""
+    taken_at = event_time(event)
+    if taken_at is None:
+        return None
+    ai_results = event.ai_results or {}
+    gps = gps or ai_results.get("gps") or {}
+    if city is None:
+        city = (ai_results.get("location") or {}).get("city")
+    return Moment(event.id, event.session_id, taken_at, gps.get("latitude"), gps.get("longitude"), city)
+
+
+def _rebuild_cluster(db: Session, cluster: models.MomentCluster) -> None:
+    """
+    Recompute a cluster after members left. Removing a moment from a time
+    level can open a gap, so the remaining members are split into runs.
+    """
+    members = db.execute(
+        select(models.ClusterMember)
+        .where(models.ClusterMember.cluster_id == cluster.id)
+        .order_by(models.ClusterMember.taken_at)
+    ).scalars().all()
+    if not members:
+        db.delete(cluster)
+        return
+
+    runs: List[List[models.ClusterMember]] = [[members[0]]]
+    for previous, member in zip(members, members[1:]):
+        if cluster.level in TIME_LEVELS and not close(cluster.level, Moment.from_member(previous), Moment.from_member(member)):
+            runs.append([])
+        runs[-1].append(member)
+
+    for index, run in enumerate(runs):
+        target = cluster if index == 0 else _new_cluster(db, cluster.level, Moment.from_member(run[0]))
+        target.event_count, target.start_at, target.end_at = 0, None, None
+        target.lat_sum, target.lon_sum, target.geo_count, target.city_counts = 0, 0, 0, {}
+        for member in run:
+            member.cluster_id = target.id
+            _add_to_cluster(target, Moment.from_member(member))
+
+
+def remove_events(db: Session, event_ids: Iterable[int]) -> None:
+    """Drop memberships of deleted or re-clustered events and repair their clusters"""
+    event_ids = list(event_ids)
+    if not event_ids:
+        return
+    cluster_ids = set(db.execute(
+        select(models.ClusterMember.cluster_id).where(models.ClusterMember.event_id.in_(event_ids))
+    ).scalars().all())
+    if not cluster_ids:
+        return
+    db.execute(delete(models.ClusterMember).where(models.ClusterMember.event_id.in_(event_ids)))
+    for cluster_id in cluster_ids:
+        cluster = db.get(models.MomentCluster, cluster_id)
+        if cluster is not None:
+            _rebuild_cluster(db, cluster)
+    db.flush()
+
+
+def cluster_out(cluster: models.MomentCluster) -> Dict[str, Any]:
+    latitude, longitude = _centroid(cluster)
+    cities = cluster.city_counts or {}
+    return {
+        "id": cluster.id,
+        "level": cluster.level,
+        "start_at": as_utc(cluster.start_at),
+        "end_at": as_utc(cluster.end_at),
+        "event_count": cluster.event_count,
+        "latitude": latitude,
+        "longitude": longitude,
+        "city": max(cities, key=cities.get) if cities else None,
+        "cities": cities,
+    }
+
+
+def rebuild_clusters(session_id: Optional[str] = None, chunk_size: int = 500) -> int:
+    """Cluster existing completed events (backfill); uses GPS stored in ai_results"""
+    assigned, last_id = 0, 0
+    while True:
+        with SessionLocal() as db:
+            query = select(models.Event).where(
+                models.Event.id > last_id,
+                models.Event.kind == "image",
+                models.Event.processing_status == "completed",
+            )
+            if session_id:
+                query = query.where(models.Event.session_id == session_id)
+            events = db.execute(query.order_by(models.Event.id).limit(chunk_size)).scalars().all()
+            if not events:
+                break
+            for event in events:
+                location = (event.heic_metadata or {}).get("location") or {}
+                moment = event_moment(event, gps=location if "latitude" in location else None)
+                if moment:
+                    assign_moment(db, moment)
+            db.commit()
+            last_id = events[-1].id
+            assigned += len(events)
+            print(f"Clustered {assigned} events...")
+    return assigned
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Cluster existing events into days, trips and places")
+    parser.add_argument("--session-id")
+    args = parser.parse_args()
+    rebuild_clusters(args.session_id)
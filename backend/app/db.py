@@ -1,9 +1,115 @@
+from typing import Dict, Any
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from .settings import settings
+from . import metrics
 
-engine = create_engine(settings.database_url, pool_pre_ping=True)
+# Async drivers used by the request handlers, keyed by the sync URL scheme
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def is_postgres(url: str) -> bool:
+    return url.startswith("postgresql")
+
+
+def to_async_url(url: str) -> str | None:
+    """Map a sync database URL to its async driver equivalent"""
+    scheme, sep, rest = url.partition("://")
+    driver = ASYNC_DRIVERS.get(scheme)
+    return f"{driver}{sep}{rest}" if driver else None
+
+
+def dialect_insert(dialect_name: str, table):
+    """INSERT construct with on_conflict_do_update support for Postgres and SQLite"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def pool_options(url: str) -> Dict[str, Any]:
+    """Pool sizing shared by every engine so API and workers draw from the same budget"""
+    options: Dict[str, Any] = {"pool_pre_ping": True}
+    if is_postgres(url):
+        options.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+        )
+    return options
+
+
+def connect_args(url: str, is_async: bool = False) -> Dict[str, Any]:
+    """Per-connection settings, currently the Postgres statement timeout"""
+    timeout = settings.db_statement_timeout_ms
+    if not is_postgres(url) or not timeout:
+        return {}
+    if is_async:
+        return {"server_settings": {"statement_timeout": str(timeout)}}
+    return {"options": f"-c statement_timeout={timeout}"}
+
+
+engine = create_engine(
+    settings.database_url,
+    connect_args=connect_args(settings.database_url),
+    **pool_options(settings.database_url),
+)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
+# Startup DDL (migrations, create_all, partitioning) may legitimately run longer
+# than DB_STATEMENT_TIMEOUT_MS, e.g. CREATE INDEX or moving rows into partitions
+ddl_engine = create_engine(settings.database_url, poolclass=NullPool)
+
+ASYNC_DATABASE_URL = to_async_url(settings.database_url)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    connect_args=connect_args(settings.database_url, is_async=True),
+    **pool_options(settings.database_url),
+) if ASYNC_DATABASE_URL else None
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+) if async_engine else None
+
+# Read replica for timeline reads; falls back to the primary when not configured
+ASYNC_REPLICA_URL = to_async_url(settings.database_replica_url) if settings.database_replica_url else None
+async_replica_engine = create_async_engine(
+    ASYNC_REPLICA_URL,
+    connect_args=connect_args(settings.database_replica_url, is_async=True),
+    **pool_options(settings.database_replica_url),
+) if ASYNC_REPLICA_URL else None
+AsyncReadSessionLocal = async_sessionmaker(
+    bind=async_replica_engine, autoflush=False, expire_on_commit=False
+) if async_replica_engine else AsyncSessionLocal
+
+
+def _pool_stats(pool) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"status": pool.status()}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+def pool_metrics() -> Dict[str, Any]:
+    """Current state of the sync (worker) and async (API) connection pools"""
+    data = {"sync": _pool_stats(engine.pool)}
+    if async_engine is not None:
+        data["async"] = _pool_stats(async_engine.pool)
+    if async_replica_engine is not None:
+        data["async_replica"] = _pool_stats(async_replica_engine.pool)
+    return data
+
+
+metrics.register_collector("db_pool", pool_metrics)
+
 class Base(DeclarativeBase):
-    pass
\ No newline at end of file
+    pass
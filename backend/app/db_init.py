@@ -3,30 +3,27 @@ Database initialization utilities for startup configuration
 """
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from .db import SessionLocal, engine
+from .db import SessionLocal, ddl_engine
+from .purge import purge_events
 from . import models
 
 
 def clear_all_events():
-    """Clear all events from the database"""
-    with SessionLocal() as db:
-        try:
-            deleted_count = db.query(models.Event).count()
-            db.query(models.Event).delete()
-            db.commit()
-            print(f"Database initialization: Cleared {deleted_count} events from database")
-        except Exception as e:
-            db.rollback()
-            print(f"Failed to clear events: {e}")
-            raise
+    """Clear all events (and their S3 images) in bounded chunks"""
+    try:
+        progress = purge_events()
+        print(f"Database initialization: Cleared {progress['deleted_events']} events from database")
+    except Exception as e:
+        print(f"Failed to clear events: {e}")
+        raise
 
 
 def reset_database():
     """Drop and recreate all tables"""
     try:
         print("Database initialization: Dropping and recreating all tables...")
-        models.Base.metadata.drop_all(bind=engine)
-        models.Base.metadata.create_all(bind=engine)
+        models.Base.metadata.drop_all(bind=ddl_engine)
+        models.Base.metadata.create_all(bind=ddl_engine)
         print("Database initialization: Tables reset successfully")
     except Exception as e:
         print(f"Failed to reset database: {e}")
@@ -0,0 +1,329 @@
+"""
+Streaming timeline export
+Events are read from a server-side cursor EXPORT_CHUNK_SIZE rows at a time
+and written as NDJSON (one event per line), or as a ZIP that interleaves
+each event's JSON with its image streamed from S3:
+
+    events/000123.json, images/000123.jpg, events/000124.json, ..., export.json
+
+The ZIP is written without seeking: sizes and CRCs follow each entry in a
+data descriptor and the central directory is spooled to a temporary file,
+so memory stays flat however large the session is. The next
+EXPORT_PREFETCH images are requested while the current one streams, and a
+stream that breaks is resumed with a Range request from where it stopped.
+
+    python -m app.export --session-id <id> --format zip -o timeline.zip
+"""
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+import orjson
+from sqlalchemy import select
+from .settings import settings
+from .db import SessionLocal
+from .resilience import call
+from .signed_urls import embed_urls
+from . import models, metrics, spool
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "zip": "application/zip"}
+READ_CHUNK_BYTES = 256 * 1024     # S3 body read size
+WRITE_CHUNK_BYTES = 64 * 1024     # small ZIP records are coalesced up to this size
+STREAM_RESUMES = 3                # Range re-requests per image before the export fails
+SPOOL_BYTES = 1024 * 1024         # central directory kept in memory up to this size
+
+
+def iter_event_chunks(session_id: str, chunk_size: Optional[int] = None) -> Iterator[List[Mapping[str, Any]]]:
+    """A session's events in id order, chunk_size rows per fetch from a server-side cursor"""
+    chunk_size = chunk_size or settings.export_chunk_size
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(models.Event.__table__)
+            .where(models.Event.session_id == session_id)
+            .order_by(models.Event.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        for chunk in result.mappings().partitions():
+            yield chunk
+    finally:
+        db.close()
+
+
+def event_json(event: Mapping[str, Any]) -> bytes:
+    return orjson.dumps(dict(event), option=orjson.OPT_UTC_Z)
+
+
+def _coalesce(pieces: Iterable[bytes], size: int = WRITE_CHUNK_BYTES) -> Iterator[bytes]:
+    """Join small pieces so the response is not sent as thousands of tiny writes"""
+    pending = bytearray()
+    for piece in pieces:
+        if len(piece) >= size and not pending:
+            yield piece
+            continue
+        pending += piece
+        if len(pending) >= size:
+            yield bytes(pending)
+            pending.clear()
+    if pending:
+        yield bytes(pending)
+
+
+def ndjson_stream(session_id: str, urls: bool = False, progress: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """One JSON event per line; with urls, image events carry presigned image_url/preview_url"""
+    progress = progress if progress is not None else {}
+    progress.setdefault("events", 0)
+    for chunk in iter_event_chunks(session_id):
+        events = [dict(row) for row in chunk]
+        if urls:
+            embed_urls(events)
+        yield b"".join(event_json(event) + b"\n" for event in events)
+        progress["events"] += len(events)
+        metrics.inc("export_events", len(events))
+
+
+def _dos_datetime(moment: datetime) -> Tuple[int, int]:
+    moment = max(moment, datetime(1980, 1, 1, tzinfo=moment.tzinfo))
+    dos_time = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+    dos_date = ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day
+    return dos_time, dos_date
+
+
+class ZipStream:
+    """
+    Write-once ZIP64 archive for a non-seekable output. Every entry uses a
+    data descriptor (flag bit 3) and ZIP64 sizes, so nothing has to be
+    known before an entry's data has been written.
+    """
+
+    def __init__(self, modified: Optional[datetime] = None):
+        self.dos_time, self.dos_date = _dos_datetime(modified or datetime.now(timezone.utc))
+        self.offset = 0
+        self.entries = 0
+        self.central = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def entry(self, name: str, chunks: Iterable[bytes], compress: bool = False) -> Iterator[bytes]:
+        """Yield the bytes of one entry whose data comes from chunks"""
+        encoded_name = name.encode()
+        method = 8 if compress else 0
+        flags = 0x08 | 0x800  # data descriptor, UTF-8 name
+        header_offset = self.offset
+        yield self._emit(
+            struct.pack("<IHHHHHIIIHH", 0x04034B50, 45, flags, method, self.dos_time, self.dos_date,
+                        0, 0xFFFFFFFF, 0xFFFFFFFF, len(encoded_name), 20)
+            + encoded_name + struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        )
+
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if compress else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed_size += len(chunk)
+                yield self._emit(chunk)
+        if compressor:
+            tail = compressor.flush()
+            compressed_size += len(tail)
+            yield self._emit(tail)
+        yield self._emit(struct.pack("<IIQQ", 0x08074B50, crc, compressed_size, size))
+
+        self.central.write(
+            struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, 0x0300 | 45, 45, flags, method, self.dos_time, self.dos_date,
+                        crc, 0xFFFFFFFF, 0xFFFFFFFF, len(encoded_name), 28, 0, 0, 0, 0o100644 << 16, 0xFFFFFFFF)
+            + encoded_name + struct.pack("<HHQQQ", 0x0001, 24, size, compressed_size, header_offset)
+        )
+        self.entries += 1
+
+    def finish(self) -> Iterator[bytes]:
+        """Yield the central directory and the (ZIP64) end records"""
+        directory_offset = self.offset
+        self.central.seek(0)
+        while True:
+            block = self.central.read(WRITE_CHUNK_BYTES)
+            if not block:
+                break
+            yield self._emit(block)
+        self.central.close()
+        directory_size = self.offset - directory_offset
+        end64_offset = self.offset
+        yield self._emit(
+            struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0,
+                        self.entries, self.entries, directory_size, directory_offset)
+            + struct.pack("<IIQI", 0x07064B50, 0, end64_offset, 1)
+            + struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+        )
+
+
+class _SpooledBody:
+    """An upload still in the spool (see spool.py), read like an S3 body"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self) -> None:
+        self.data = b""
+
+
+def _get_object(client, s3_key: str, **kwargs) -> Dict[str, Any]:
+    if not kwargs:
+        spooled = spool.read(s3_key)
+        if spooled is not None:
+            return {"Body": _SpooledBody(spooled), "ETag": None}
+    # Not hedged: the losing attempt would hold an open body
+    return call("s3", client.get_object, Bucket=settings.aws_bucket_name, Key=s3_key, **kwargs)
+
+
+def object_chunks(client, s3_key: str, response: Dict[str, Any]) -> Iterator[bytes]:
+    """Stream an object's body, resuming from the last byte received if the connection breaks"""
+    received, resumes = 0, 0
+    while True:
+        try:
+            for chunk in response["Body"].iter_chunks(READ_CHUNK_BYTES):
+                received += len(chunk)
+                yield chunk
+            return
+        except Exception as e:
+            if resumes >= STREAM_RESUMES:
+                raise
+            resumes += 1
+            metrics.inc("export_stream_resumes")
+            print(f"Export: resuming {s3_key} at byte {received} after {e.__class__.__name__}: {e}")
+            response["Body"].close()
+            # IfMatch: fail rather than splice two versions of an object
+            response = _get_object(client, s3_key, Range=f"bytes={received}-", IfMatch=response["ETag"])
+
+
+def _has_image(event: Mapping[str, Any]) -> bool:
+    return event["kind"] == "image" and bool(event["source"])
+
+
+def _close_body(future: Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result()["Body"].close()
+
+
+def _prefetched(session_id: str, client, images: bool, prefetch: int) -> Iterator[Tuple[Mapping[str, Any], Optional[Future]]]:
+    """Events paired with their in-flight S3 request, up to prefetch requests ahead"""
+    window: "deque[Tuple[Mapping[str, Any], Optional[Future]]]" = deque()
+    pool = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="export") if images else None
+    try:
+        for chunk in iter_event_chunks(session_id):
+            for event in chunk:
+                future = pool.submit(_get_object, client, event["source"]) if pool and _has_image(event) else None
+                window.append((event, future))
+                if len(window) > prefetch:
+                    yield window.popleft()
+        while window:
+            yield window.popleft()
+    finally:
+        # Abandoned export (client went away): release the bodies opened ahead
+        for _, future in window:
+            if future is not None and not future.cancel():
+                future.add_done_callback(_close_body)
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def zip_stream(session_id: str, images: bool = True, progress: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """
+    events/<id>.json for every event, each followed by images/<id>.jpg when
+    images is set. An image that cannot be fetched is left out (the event's
+    export_image is null) and counted in export.json; one that breaks
+    mid-stream after STREAM_RESUMES attempts aborts the export.
+    """
+    progress = progress if progress is not None else {}
+    progress.update(events=0, images=0, image_bytes=0, missing_images=0)
+    client = None
+    if images:
+        from .s3 import get_s3_client
+        client = get_s3_client()
+    archive = ZipStream()
+    started = time.monotonic()
+
+    for event, future in _prefetched(session_id, client, images, max(settings.export_prefetch, 1)):
+        response = None
+        if future is not None:
+            try:
+                response = future.result()
+            except Exception as e:
+                progress["missing_images"] += 1
+                metrics.inc("export_missing_images")
+                print(f"Export: image {event['source']} of event {event['id']} unavailable: {e}")
+        image_name = f"images/{event['id']:06d}.jpg" if response is not None else None
+
+        document = dict(event)
+        document["export_image"] = image_name
+        yield from archive.entry(f"events/{event['id']:06d}.json", [event_json(document)], compress=True)
+        progress["events"] += 1
+        metrics.inc("export_events")
+
+        if response is not None:
+            before = archive.offset
+            yield from archive.entry(image_name, object_chunks(client, event["source"], response))
+            progress["images"] += 1
+            progress["image_bytes"] += archive.offset - before
+            metrics.inc("export_image_bytes", archive.offset - before)
+
+    manifest = {
+        "session_id": session_id,
+        "exported_at": datetime.now(timezone.utc),
+        "seconds": round(time.monotonic() - started, 3),
+        **progress,
+    }
+    yield from archive.entry("export.json", [orjson.dumps(manifest, option=orjson.OPT_UTC_Z | orjson.OPT_INDENT_2)],
+                             compress=True)
+    yield from archive.finish()
+
+
+def export_stream(session_id: str, format: str = "ndjson", images: bool = True, urls: bool = False,
+                  progress: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """Response body chunks for an export in the given format"""
+    metrics.inc("exports_started")
+    if format == "zip":
+        chunks = zip_stream(session_id, images, progress)
+    else:
+        chunks = ndjson_stream(session_id, urls, progress)
+    yield from _coalesce(chunks)
+    metrics.inc("exports_finished")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export a session's timeline as NDJSON or a ZIP with images")
+    parser.add_argument("--session-id", required=True)
+    parser.add_argument("--format", choices=sorted(MEDIA_TYPES), default="ndjson")
+    parser.add_argument("--no-images", action="store_true", help="ZIP: event JSON only")
+    parser.add_argument("--urls", action="store_true", help="NDJSON: add presigned image URLs")
+    parser.add_argument("-o", "--output", default="-", help="File to write (default: stdout)")
+    args = parser.parse_args()
+
+    progress: Dict[str, Any] = {}
+    started = time.monotonic()
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    written = 0
+    try:
+        for block in export_stream(args.session_id, args.format, not args.no_images, args.urls, progress):
+            output.write(block)
+            written += len(block)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    elapsed = time.monotonic() - started
+    print(f"Exported {progress} ({written / 1024 / 1024:.1f} MB in {elapsed:.1f}s, "
+          f"{written / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)", file=sys.stderr)
@@ -0,0 +1,132 @@
+"""
+Geographic helpers shared by clustering and location queries
+"""
+import math
+from typing import List, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometers"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def valid_coordinates(latitude: Optional[float], longitude: Optional[float]) -> bool:
+    return (
+        latitude is not None and longitude is not None
+        and -90 <= latitude <= 90 and -180 <= longitude <= 180
+        and not (latitude == 0 and longitude == 0)
+    )
+
+
+# Geohash: interleaved lon/lat bisection bits, base32-encoded. Prefixes name
+# nested cells and the alphabet is in ASCII order, so all points in a cell form
+# one contiguous range of an ordinary B-tree index.
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 12
+
+
+def geohash_encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        target, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        value <<= 1
+        if target >= mid:
+            value |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """(height, width) in degrees of a geohash cell"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_upper_bound(prefix: str) -> Optional[str]:
+    """
+    Smallest geohash prefix after every geohash starting with prefix (None
+    past the end). Stays within the alphabet so the range is also correct
+    under locale collations that ignore punctuation.
+    """
+    while prefix and prefix[-1] == GEOHASH_ALPHABET[-1]:
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + GEOHASH_ALPHABET[GEOHASH_ALPHABET.index(prefix[-1]) + 1]
+
+
+def geohash_cover(min_lat: float, min_lon: float, max_lat: float, max_lon: float, max_cells: int = 32) -> List[str]:
+    """
+    Geohash prefixes whose cells together cover the bounding box, using the
+    finest precision that needs at most max_cells prefixes.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        rows = math.floor(max_lat / height) - math.floor(min_lat / height) + 1
+        cols = math.floor(max_lon / width) - math.floor(min_lon / width) + 1
+        if rows * cols <= max_cells or precision == 1:
+            break
+
+    cells = set()
+    lat = math.floor(min_lat / height) * height
+    while lat <= max_lat:
+        lon = math.floor(min_lon / width) * width
+        while lon <= max_lon:
+            center_lat = min(max(lat + height / 2, -90.0), 90.0)
+            center_lon = min(max(lon + width / 2, -180.0), 180.0)
+            cells.add(geohash_encode(center_lat, center_lon, precision))
+            lon += width
+        lat += height
+    return sorted(cells)
+
+
+def radius_bbox(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    (min_lat, min_lon, max_lat, max_lon) enclosing a circle. Longitudes wrap
+    instead of being clamped: a circle across 180 degrees gives
+    min_lon > max_lon (see geo_index.split_antimeridian).
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    min_lat, max_lat = max(latitude - dlat, -90.0), min(latitude + dlat, 90.0)
+    if min_lat == -90.0 or max_lat == 90.0 or angle >= math.pi / 2:
+        return min_lat, -180.0, max_lat, 180.0  # the circle covers a pole: every longitude
+    # Widest point of the circle, which lies poleward of its centre's latitude
+    dlon = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(latitude)), 1.0)))
+    min_lon, max_lon = longitude - dlon, longitude + dlon
+    if min_lon < -180.0:
+        min_lon += 360.0
+    if max_lon > 180.0:
+        max_lon -= 360.0
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def tile_bbox(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(min_lat, min_lon, max_lat, max_lon) of a Web Mercator (slippy map) tile"""
+    n = 2 ** zoom
+
+    def tile_lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return tile_lat(y + 1), x / n * 360.0 - 180.0, tile_lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+def tile_precision(zoom: int, buckets_per_side: int = 8) -> int:
+    """Finest geohash precision with at most buckets_per_side cells across a tile at zoom"""
+    lon_bits = zoom + math.ceil(math.log2(buckets_per_side))
+    return max(1, min(GEOHASH_PRECISION, 2 * lon_bits // 5))
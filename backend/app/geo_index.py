@@ -0,0 +1,165 @@
+"""
+Location queries over event GPS positions without PostGIS
+Each located event stores latitude, longitude and a geohash. Bounding boxes
+are covered by a handful of geohash prefixes, each a contiguous range of the
+(session_id, geohash, latitude, longitude) B-tree index, then filtered
+exactly on the coordinates. Radius queries search the enclosing box,
+let the database rank it by an equirectangular approximation of the
+distance and fetch only a few times the limit (more when too few of those
+fall within the radius), then keep points within the great-circle distance.
+"""
+import math
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import select, update, and_, or_, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import SessionLocal
+from .geo import (
+    geohash_encode, geohash_cover, geohash_upper_bound, haversine_km,
+    radius_bbox, tile_bbox, tile_precision, valid_coordinates,
+)
+from . import models
+
+BBox = Tuple[float, float, float, float]
+NEAR_PREFETCH_FACTOR = 4      # candidates ranked in SQL per requested event
+NEAR_MAX_CANDIDATES = 20000   # hard cap on candidates loaded per radius query
+
+
+def location_columns(gps: Optional[Dict[str, float]]) -> Dict[str, Any]:
+    """Column values for an event's GPS position (all None when unknown)"""
+    latitude, longitude = (gps or {}).get("latitude"), (gps or {}).get("longitude")
+    if not valid_coordinates(latitude, longitude):
+        return {"latitude": None, "longitude": None, "geohash": None}
+    return {"latitude": latitude, "longitude": longitude, "geohash": geohash_encode(latitude, longitude)}
+
+
+def split_antimeridian(bbox: BBox) -> List[BBox]:
+    """A box with min_lon > max_lon wraps across 180 degrees; query it as two"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if min_lon <= max_lon:
+        return [bbox]
+    return [(min_lat, min_lon, max_lat, 180.0), (min_lat, -180.0, max_lat, max_lon)]
+
+
+def geohash_range(prefix: str) -> Any:
+    """Geohashes starting with prefix, as an index range"""
+    upper = geohash_upper_bound(prefix)
+    if upper is None:
+        return models.Event.geohash >= prefix
+    return and_(models.Event.geohash >= prefix, models.Event.geohash < upper)
+
+
+def bbox_criteria(bbox: BBox) -> Any:
+    """Index-friendly geohash ranges plus the exact coordinate check"""
+    boxes = []
+    for min_lat, min_lon, max_lat, max_lon in split_antimeridian(bbox):
+        ranges = [geohash_range(prefix) for prefix in geohash_cover(min_lat, min_lon, max_lat, max_lon)]
+        boxes.append(and_(
+            or_(*ranges),
+            models.Event.latitude.between(min_lat, max_lat),
+            models.Event.longitude.between(min_lon, max_lon),
+        ))
+    return or_(*boxes)
+
+
+async def events_in_bbox(db: AsyncSession, session_id: str, bbox: BBox, limit: int) -> List[models.Event]:
+    result = await db.execute(
+        select(models.Event)
+        .where(models.Event.session_id == session_id, bbox_criteria(bbox))
+        .order_by(models.Event.id.desc())
+        .limit(limit)
+    )
+    return list(result.scalars().all())
+
+
+def approximate_distance(latitude: float, longitude: float) -> Any:
+    """Squared equirectangular distance in degrees from a point, to rank rows in SQL"""
+    dlon = models.Event.longitude - longitude
+    dlon = case((dlon > 180, dlon - 360), (dlon < -180, dlon + 360), else_=dlon)
+    dlat = models.Event.latitude - latitude
+    return dlat * dlat + dlon * dlon * math.cos(math.radians(latitude)) ** 2
+
+
+async def events_near(
+    db: AsyncSession, session_id: str, latitude: float, longitude: float, radius_km: float, limit: int
+) -> List[Tuple[models.Event, float]]:
+    """Events within radius_km, nearest first, with their distance"""
+    # Rank on the narrow index columns first, then load only the rows returned
+    criteria = bbox_criteria(radius_bbox(latitude, longitude, radius_km))
+    fetch = min(limit * NEAR_PREFETCH_FACTOR, NEAR_MAX_CANDIDATES)
+    while True:
+        result = await db.execute(
+            select(models.Event.id, models.Event.latitude, models.Event.longitude)
+            .where(models.Event.session_id == session_id, criteria)
+            .order_by(approximate_distance(latitude, longitude), models.Event.id)
+            .limit(fetch)
+        )
+        candidates = result.tuples().all()
+        nearest = sorted(
+            (distance, event_id)
+            for event_id, event_lat, event_lon in candidates
+            if (distance := haversine_km(latitude, longitude, event_lat, event_lon)) <= radius_km
+        )[:limit]
+        # The box corners lie outside the radius; widen when they crowded out the circle
+        if len(candidates) < fetch or len(nearest) >= limit or fetch >= NEAR_MAX_CANDIDATES:
+            break
+        fetch = min(fetch * NEAR_PREFETCH_FACTOR, NEAR_MAX_CANDIDATES)
+    if not nearest:
+        return []
+
+    events = await db.execute(
+        select(models.Event).where(
+            models.Event.session_id == session_id,
+            models.Event.id.in_([event_id for _, event_id in nearest]),
+        )
+    )
+    by_id = {event.id: event for event in events.scalars().all()}
+    return [(by_id[event_id], distance) for distance, event_id in nearest if event_id in by_id]
+
+
+async def tile_clusters(db: AsyncSession, session_id: str, zoom: int, x: int, y: int) -> List[Dict[str, Any]]:
+    """
+    Photo counts of a map tile grouped into geohash buckets (at most about
+    8x8 per tile), each placed at the mean position of its photos.
+    """
+    bucket = func.substr(models.Event.geohash, 1, tile_precision(zoom))
+    result = await db.execute(
+        select(
+            bucket.label("geohash"),
+            func.count().label("count"),
+            func.avg(models.Event.latitude).label("latitude"),
+            func.avg(models.Event.longitude).label("longitude"),
+        )
+        .where(models.Event.session_id == session_id, bbox_criteria(tile_bbox(zoom, x, y)))
+        .group_by(bucket)
+        .order_by(bucket)
+    )
+    return [dict(row) for row in result.mappings().all()]
+
+
+def backfill_locations(chunk_size: int = 1000) -> int:
+    """Fill location columns of events processed before they existed"""
+    filled, last_id = 0, 0
+    while True:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(models.Event.id, models.Event.ai_results, models.Event.heic_metadata)
+                .where(models.Event.id > last_id, models.Event.kind == "image", models.Event.geohash.is_(None))
+                .order_by(models.Event.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            for row in rows:
+                gps = (row.ai_results or {}).get("gps") or (row.heic_metadata or {}).get("location")
+                columns = location_columns(gps)
+                if columns["geohash"]:
+                    db.execute(update(models.Event).where(models.Event.id == row.id).values(**columns))
+                    filled += 1
+            db.commit()
+            print(f"Backfilled locations for {filled} events...")
+    return filled
+
+
+if __name__ == "__main__":
+    backfill_locations()
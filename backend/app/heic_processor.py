@@ -9,6 +9,7 @@ from typing import Dict, Optional, Tuple
 from PIL import Image, ExifTags
 import pillow_heif
 import exifread
+from .image_formats import to_jpeg, embedded_preview, decoded_preview
 
 class MockExifTag:
     """Mock exifread tag for Pillow EXIF data compatibility"""
@@ -223,21 +224,9 @@ def parse_fraction(fraction_str: str) -> float:
         return float(fraction_str)
 
 def convert_heic_to_jpeg(image_bytes: bytes, quality: int = 95) -> bytes:
-    """Convert HEIC image bytes to JPEG bytes"""
+    """Convert HEIC image bytes to JPEG bytes (one decode, EXIF orientation applied)"""
     try:
-        # Open HEIC image using pillow-heif
-        image_file = io.BytesIO(image_bytes)
-        with Image.open(image_file) as img:
-            # Convert to RGB if necessary (HEIC can have different color modes)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Save as JPEG
-            output = io.BytesIO()
-            img.save(output, format='JPEG', quality=quality, optimize=True)
-            output.seek(0)
-            return output.getvalue()
-    
+        return to_jpeg(image_bytes, quality=quality, optimize=True)
     except Exception as e:
         raise ValueError(f"Failed to convert HEIC to JPEG: {str(e)}")
 
@@ -249,23 +238,30 @@ def is_heic_file(filename: str) -> bool:
     heic_extensions = {'.heic', '.heif', '.hif'}
     return any(filename.lower().endswith(ext) for ext in heic_extensions)
 
-def process_heic_upload(image_bytes: bytes, filename: str) -> Tuple[bytes, Dict]:
+def prepare_heic_upload(image_bytes: bytes, filename: str) -> Tuple[Optional[bytes], Dict]:
     """
-    Process HEIC upload: extract metadata and convert to JPEG
-    Returns: (jpeg_bytes, metadata_dict)
+    Process HEIC upload: extract metadata and a small preview JPEG.
+    Full-resolution conversion is left to the background pipeline.
+    Returns: (preview_bytes, metadata_dict)
     """
     # Extract comprehensive metadata from original HEIC
     metadata = extract_heic_metadata(image_bytes)
     
-    # Convert to JPEG for storage
-    jpeg_bytes = convert_heic_to_jpeg(image_bytes)
+    # Embedded EXIF thumbnail when present, otherwise a downscaled decode
+    preview_bytes = embedded_preview(image_bytes)
+    if preview_bytes is None:
+        try:
+            preview_bytes = decoded_preview(image_bytes)
+        except Exception as e:
+            print(f"HEIC preview generation failed: {e}")
     
     # Add processing info to metadata
     metadata['processing_info'] = {
         'original_format': 'HEIC',
         'converted_to': 'JPEG',
+        'conversion': 'background',
         'original_filename': filename,
         'processed_at': datetime.utcnow().isoformat()
     }
     
-    return jpeg_bytes, metadata
\ No newline at end of file
+    return preview_bytes, metadata
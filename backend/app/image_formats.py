@@ -0,0 +1,320 @@
+"""
+Upload format detection, JPEG normalization and fast previews
+The format is read from the file's magic bytes instead of decoding it.
+Well-formed JPEGs are stored byte-for-byte; every other format is decoded
+once, rotated upright per its EXIF orientation and encoded once to JPEG.
+Previews come from the embedded EXIF thumbnail when there is one.
+Perceptual signatures for burst detection use DCT-scaled decodes too.
+"""
+import struct
+from datetime import datetime
+from io import BytesIO
+from typing import Iterator, Optional, Tuple
+from PIL import Image, ImageFilter, ImageOps, ImageStat
+import pillow_heif
+
+pillow_heif.register_heif_opener()
+
+JPEG = "jpeg"
+PNG = "png"
+GIF = "gif"
+WEBP = "webp"
+HEIF = "heif"
+TIFF = "tiff"
+BMP = "bmp"
+
+# ISO base media "ftyp" brands of HEIF/HEIC still images
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+# JPEG markers without a length field
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+SOS = 0xDA
+APP1 = 0xE1
+EXIF_ORIENTATION = 0x0112
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+EXIF_DATETIME = 0x0132
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_IFD = 0x8769
+
+# Longest side of preview derivatives
+PREVIEW_MAX_SIZE = 320
+PREVIEW_QUALITY = 80
+# Longest side of the grayscale image perceptual signatures are computed on
+SIGNATURE_SIZE = 512
+
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """Image format from the leading magic bytes, or None if unrecognized"""
+    if data[:3] == b"\xff\xd8\xff":
+        return JPEG
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return PNG
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return GIF
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return WEBP
+    if data[4:8] == b"ftyp" and data[8:12] in HEIF_BRANDS:
+        return HEIF
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return TIFF
+    if data[:2] == b"BM":
+        return BMP
+    return None
+
+
+def jpeg_segments(data: bytes) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yield (marker, payload offset, payload length) for each marker segment
+    from SOI up to and including the start of scan. Stops silently at the
+    first malformed segment.
+    """
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return
+        marker = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            offset += 2
+            continue
+        length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+        if length < 2:
+            return
+        yield marker, offset + 4, length - 2
+        if marker == SOS:
+            return
+        offset += 2 + length
+
+
+def is_well_formed_jpeg(data: bytes) -> bool:
+    """
+    Walk the marker segments from SOI to the start of scan. Cheap (no pixel
+    decode) and rejects truncated or mislabeled files before passthrough.
+    """
+    if sniff_format(data) != JPEG:
+        return False
+    for marker, offset, length in jpeg_segments(data):
+        if marker == SOS:
+            return offset + length < len(data)
+    return False
+
+
+def jpeg_exif_probe(head: bytes) -> Tuple[bool, Optional[bytes]]:
+    """
+    (conclusive, EXIF block) from the first bytes of a JPEG. Conclusive once
+    the whole APP1 Exif segment, or the start of scan without one, lies
+    within head; otherwise the caller needs more of the file.
+    """
+    if sniff_format(head) != JPEG:
+        return False, None
+    for marker, offset, length in jpeg_segments(head):
+        if marker == APP1 and head[offset:offset + 6] == b"Exif\x00\x00":
+            if offset + length > len(head):
+                return False, None
+            return True, head[offset + 6:offset + length]
+        if marker == SOS:
+            return True, None
+    return False, None
+
+
+def to_jpeg(data: bytes, quality: int = 90, optimize: bool = False) -> bytes:
+    """
+    Decode once, apply EXIF orientation, encode once. EXIF (minus the now
+    applied orientation) and the ICC profile are carried over so date and GPS
+    extraction still work on the stored JPEG.
+    """
+    with Image.open(BytesIO(data)) as image:
+        exif = image.getexif()
+        icc_profile = image.info.get("icc_profile")
+        upright = ImageOps.exif_transpose(image)
+        if upright.mode != "RGB":
+            upright = upright.convert("RGB")
+        exif.pop(EXIF_ORIENTATION, None)
+        output = BytesIO()
+        save_options = {"format": "JPEG", "quality": quality, "optimize": optimize}
+        if exif:
+            save_options["exif"] = exif.tobytes()
+        if icc_profile:
+            save_options["icc_profile"] = icc_profile
+        upright.save(output, **save_options)
+        return output.getvalue()
+
+
+def normalize_to_jpeg(data: bytes, quality: int = 90) -> bytes:
+    """JPEG bytes for storage: passthrough when already a valid JPEG"""
+    if is_well_formed_jpeg(data):
+        return data
+    return to_jpeg(data, quality)
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Pixel dimensions from the header, without decoding; None when unreadable"""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def fit_short_side(data: bytes, short_side: int, quality: int = 85) -> bytes:
+    """
+    Upright JPEG whose shorter side is at most short_side (data unchanged when
+    it already is). JPEGs are DCT-scaled while decoding, so the full-size
+    image is never held in memory.
+    """
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+        if min(width, height) <= short_side:
+            return data
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        scale = short_side / min(width, height)
+        target = (max(round(width * scale), 1), max(round(height * scale), 1))
+        image.draft("RGB", target)
+        resized = image.convert("RGB").resize(target, Image.Resampling.LANCZOS)
+    if orientation in ORIENTATION_TRANSPOSE:
+        resized = resized.transpose(ORIENTATION_TRANSPOSE[orientation])
+    output = BytesIO()
+    resized.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def _exif_block(data: bytes, image_format: Optional[str]) -> Optional[bytes]:
+    """Raw EXIF (TIFF) block of a JPEG or HEIF file, read without decoding pixels"""
+    if image_format == JPEG:
+        for marker, offset, length in jpeg_segments(data):
+            if marker == APP1 and data[offset:offset + 6] == b"Exif\x00\x00":
+                return data[offset + 6:offset + length]
+        return None
+    if image_format == HEIF:
+        exif = pillow_heif.open_heif(data).info.get("exif")
+        if exif and exif.startswith(b"Exif\x00\x00"):
+            exif = exif[6:]
+        return exif or None
+    return None
+
+
+def _ifd_entries(tiff: bytes, offset: int, endian: str):
+    """{tag: value} of one IFD (inline SHORT/LONG values only) and the next IFD offset"""
+    count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+    entries = {}
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, field_type = struct.unpack(endian + "HH", tiff[entry:entry + 4])
+        if field_type == 3:
+            entries[tag] = struct.unpack(endian + "H", tiff[entry + 8:entry + 10])[0]
+        elif field_type == 4:
+            entries[tag] = struct.unpack(endian + "L", tiff[entry + 8:entry + 12])[0]
+    next_offset = struct.unpack(endian + "L", tiff[offset + 2 + count * 12:offset + 6 + count * 12])[0]
+    return entries, next_offset
+
+
+def exif_thumbnail(tiff: bytes) -> Tuple[Optional[bytes], int]:
+    """(embedded JPEG thumbnail from IFD1, orientation from IFD0) of an EXIF block"""
+    try:
+        endian = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        ifd0, ifd1_offset = _ifd_entries(tiff, struct.unpack(endian + "L", tiff[4:8])[0], endian)
+        orientation = ifd0.get(EXIF_ORIENTATION, 1)
+        if not ifd1_offset:
+            return None, orientation
+        ifd1, _ = _ifd_entries(tiff, ifd1_offset, endian)
+        start, length = ifd1.get(EXIF_THUMBNAIL_OFFSET), ifd1.get(EXIF_THUMBNAIL_LENGTH)
+        if start is None or not length:
+            return None, orientation
+        thumbnail = tiff[start:start + length]
+        return (thumbnail if sniff_format(thumbnail) == JPEG else None), orientation
+    except (KeyError, struct.error):
+        return None, 1
+
+
+def _encode_preview(image: Image.Image, orientation: int = 1) -> bytes:
+    image.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=PREVIEW_QUALITY)
+    return output.getvalue()
+
+
+def embedded_preview(data: bytes) -> Optional[bytes]:
+    """
+    Small upright JPEG preview, cheapest source first: the embedded EXIF
+    thumbnail (returned as-is when no rotation is needed), then for JPEGs a
+    DCT-scaled draft decode at 1/2-1/8 resolution. HEIF files without an
+    EXIF thumbnail return None (pillow-heif cannot decode HEIF thumbnail
+    items); use decoded_preview for those.
+    """
+    image_format = sniff_format(data)
+    try:
+        tiff = _exif_block(data, image_format)
+        thumbnail, orientation = exif_thumbnail(tiff) if tiff else (None, 1)
+        if thumbnail is not None:
+            if orientation == 1:
+                return thumbnail
+            with Image.open(BytesIO(thumbnail)) as image:
+                return _encode_preview(image, orientation)
+        if image_format == JPEG:
+            with Image.open(BytesIO(data)) as image:
+                image.draft("RGB", (PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+                return _encode_preview(image, orientation)
+    except Exception as e:
+        print(f"Embedded preview extraction failed: {e}")
+    return None
+
+
+def decoded_preview(data: bytes) -> bytes:
+    """Preview from a full decode (formats without a cheaper source)"""
+    with Image.open(BytesIO(data)) as image:
+        upright = ImageOps.exif_transpose(image)
+        return _encode_preview(upright)
+
+
+def exif_datetime(data: bytes) -> Optional[datetime]:
+    """Capture time from EXIF (DateTimeOriginal, else DateTime) of a JPEG or HEIF, without decoding pixels"""
+    tiff = _exif_block(data, sniff_format(data))
+    if not tiff:
+        return None
+    exif = Image.Exif()
+    exif.load(tiff)
+    for value in (exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL), exif.get(EXIF_DATETIME)):
+        try:
+            return datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            continue
+    return None
+
+
+def perceptual_signature(data: bytes) -> Tuple[int, float]:
+    """
+    (64-bit difference hash, sharpness) of an image. Each hash bit compares
+    two neighbouring pixels of a 9x8 grayscale thumbnail, so re-encoding,
+    small shifts and exposure changes flip few bits. Sharpness is the
+    variance of the Laplacian at SIGNATURE_SIZE; blur and shake lower it.
+    JPEGs are DCT-scaled while decoding.
+    """
+    with Image.open(BytesIO(data)) as image:
+        image.draft("L", (SIGNATURE_SIZE, SIGNATURE_SIZE))
+        gray = image.convert("L")
+    gray.thumbnail((SIGNATURE_SIZE, SIGNATURE_SIZE))
+    pixels = gray.resize((9, 8), Image.Resampling.BOX).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            value = value << 1 | (left < pixels[row * 9 + col + 1])
+    sharpness = ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).var[0]
+    return value, sharpness
@@ -1,14 +1,20 @@
 import boto3
 import requests
 import json
+import time
+from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
-from openai import OpenAI
-from sqlalchemy.orm import sessionmaker
 from .settings import settings
-from .db import engine
-from . import models
+from .db import SessionLocal
+from . import models, timeline_cache, rollups, clustering, geo_index, vision, planner, memory_budget, bursts, scheduler, spool
+from .partitioning import event_filter
+from .s3 import download_from_s3, download_head_from_s3, delete_objects, original_key
+from .image_formats import jpeg_exif_probe, fit_short_side
+from .resilience import boto_config, call, cached_call
+from .heic_processor import convert_heic_to_jpeg
 from .ai import create_first_person_summary, generate_clarification_questions, create_timeline_narrative
 
 # AWS client factory functions
@@ -17,7 +23,9 @@ def get_rekognition_client():
         'rekognition',
         aws_access_key_id=settings.aws_access_key_id,
         aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.aws_region
+        region_name=settings.aws_region,
+        endpoint_url=settings.aws_endpoint_url,
+        config=boto_config()
     )
 
 def get_textract_client():
@@ -25,26 +33,43 @@ def get_textract_client():
         'textract',
         aws_access_key_id=settings.aws_access_key_id,
         aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.aws_region
+        region_name=settings.aws_region,
+        endpoint_url=settings.aws_endpoint_url,
+        config=boto_config()
     )
 
-def get_s3_client():
-    return boto3.client(
-        's3',
-        aws_access_key_id=settings.aws_access_key_id,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.aws_region
-    )
+TAGS_BY_NAME = {name: tag_id for tag_id, name in TAGS.items()}
 
-openai_client = OpenAI(api_key=settings.openai_api_key) if settings.openai_api_key else None
+@lru_cache(maxsize=1)
+def get_openai_client():
+    """Shared OpenAI client, created (and the openai package imported) on first use"""
+    if not settings.openai_api_key:
+        return None
+    from openai import OpenAI
+    return OpenAI(api_key=settings.openai_api_key, base_url=settings.openai_base_url,
+                  timeout=settings.openai_timeout_seconds, max_retries=1)
+
+# Rekognition accepts inline image bytes up to 5 MB
+AWS_INLINE_IMAGE_BYTES = 5 * 1024 * 1024
 
-SessionLocal = sessionmaker(bind=engine)
+def aws_image(s3_key: str) -> dict:
+    """
+    Rekognition/Textract image argument. An upload still in the spool is
+    sent inline when small enough; a larger one is waited for until S3 has it.
+    """
+    spooled = spool.read(s3_key)
+    if spooled is not None:
+        if len(spooled) <= AWS_INLINE_IMAGE_BYTES:
+            return {"Bytes": spooled}
+        spool.wait(s3_key, settings.upload_spool_wait_seconds)
+    return {"S3Object": {"Bucket": settings.aws_bucket_name, "Name": s3_key}}
 
 def detect_faces(s3_key: str):
     """Detect faces with AWS Rekognition"""
     rekognition = get_rekognition_client()
-    response = rekognition.detect_faces(
-        Image={"S3Object": {"Bucket": settings.aws_bucket_name, "Name": s3_key}},
+    response = call(
+        "rekognition", rekognition.detect_faces, hedge=True,
+        Image=aws_image(s3_key),
         Attributes=["ALL"]
     )
     
@@ -63,8 +88,9 @@ def detect_faces(s3_key: str):
 def detect_labels(s3_key: str):
     """Detect image labels with AWS Rekognition"""
     rekognition = get_rekognition_client()
-    response = rekognition.detect_labels(
-        Image={"S3Object": {"Bucket": settings.aws_bucket_name, "Name": s3_key}},
+    response = call(
+        "rekognition", rekognition.detect_labels, hedge=True,
+        Image=aws_image(s3_key),
         MaxLabels=15,
         MinConfidence=80
     )
@@ -83,8 +109,9 @@ def detect_labels(s3_key: str):
 def extract_text_from_textract(s3_key: str):
     """Extract text from image using AWS Textract"""
     textract = get_textract_client()
-    response = textract.detect_document_text(
-        Document={"S3Object": {"Bucket": settings.aws_bucket_name, "Name": s3_key}}
+    response = call(
+        "textract", textract.detect_document_text, hedge=True,
+        Document=aws_image(s3_key)
     )
     
     text_blocks = []
@@ -94,55 +121,77 @@ def extract_text_from_textract(s3_key: str):
     
     return " ".join(text_blocks)
 
-def extract_exif_gps(s3_key: str):
-    """Extract GPS coordinates from EXIF data"""
-    try:
-        # Download image from S3
-        s3_client = get_s3_client()
-        response = s3_client.get_object(Bucket=settings.aws_bucket_name, Key=s3_key)
-        image_bytes = response['Body'].read()
-        
-        # Extract EXIF data
-        image = Image.open(BytesIO(image_bytes))
-        exif_dict = image._getexif() or {}
-        
-        gps_info = {}
-        for tag_id, value in exif_dict.items():
-            tag = TAGS.get(tag_id, tag_id)
-            if tag == "GPSInfo":
-                for gps_tag_id, gps_value in value.items():
-                    gps_tag = GPSTAGS.get(gps_tag_id, gps_tag_id)
-                    gps_info[gps_tag] = gps_value
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+@lru_cache(maxsize=32)
+def load_exif_tags(s3_key: str):
+    """
+    (flat EXIF tags incl. GPSInfo, where they were read from). Stored JPEGs
+    keep EXIF in the leading APP1 segment, so a ranged read of the head of
+    the object usually suffices; otherwise the whole object is fetched.
+    Cached so the date and GPS steps share one read.
+    """
+    probe_bytes = settings.planner_exif_probe_bytes
+    head = download_head_from_s3(s3_key, probe_bytes)
+    conclusive, tiff = jpeg_exif_probe(head)
+    exif = Image.Exif()
+    if conclusive:
+        source = "header"
+        if tiff:
+            exif.load(tiff)
+    else:
+        source = "full"
+        image_bytes = head if len(head) < probe_bytes else download_from_s3(s3_key)
+        exif = Image.open(BytesIO(image_bytes)).getexif()
+    
+    tags = dict(exif)
+    tags.update(exif.get_ifd(EXIF_IFD))
+    gps = exif.get_ifd(GPS_IFD)
+    if gps:
+        tags[GPS_IFD] = dict(gps)
+    return tags, source
+
+def gps_from_exif(exif_dict: dict):
+    """GPS coordinates from EXIF tags, or None"""
+    gps_info = {}
+    for gps_tag_id, gps_value in (exif_dict.get(GPS_IFD) or {}).items():
+        gps_tag = GPSTAGS.get(gps_tag_id, gps_tag_id)
+        gps_info[gps_tag] = gps_value
+    
+    # Convert GPS coordinates
+    if 'GPSLatitude' in gps_info and 'GPSLongitude' in gps_info:
+        lat = convert_to_degrees(gps_info['GPSLatitude'])
+        lon = convert_to_degrees(gps_info['GPSLongitude'])
         
-        # Convert GPS coordinates
-        if 'GPSLatitude' in gps_info and 'GPSLongitude' in gps_info:
-            lat = convert_to_degrees(gps_info['GPSLatitude'])
-            lon = convert_to_degrees(gps_info['GPSLongitude'])
+        if gps_info.get('GPSLatitudeRef') == 'S':
+            lat = -lat
+        if gps_info.get('GPSLongitudeRef') == 'W':
+            lon = -lon
             
-            if gps_info.get('GPSLatitudeRef') == 'S':
-                lat = -lat
-            if gps_info.get('GPSLongitudeRef') == 'W':
-                lon = -lon
-                
-            return {"latitude": lat, "longitude": lon}
-    
-    except Exception:
-        pass
+        return {"latitude": lat, "longitude": lon}
     
     return None
 
+def extract_exif_gps(s3_key: str):
+    """Extract GPS coordinates from EXIF data"""
+    try:
+        return gps_from_exif(load_exif_tags(s3_key)[0])
+    except Exception:
+        return None
+
 def convert_to_degrees(value):
     """Convert GPS coordinates to degrees"""
     d, m, s = value
     return float(d) + float(m)/60 + float(s)/3600
 
 def reverse_geocode_locationiq(lat: float, lon: float):
-    """Reverse geocode using LocationIQ"""
+    """Reverse geocode using LocationIQ (last good answer for the spot while it is down)"""
     if not settings.locationiq_api_key:
         return None
     
-    try:
-        url = f"https://us1.locationiq.com/v1/reverse.php"
+    def lookup():
+        url = settings.locationiq_url
         params = {
             "key": settings.locationiq_api_key,
             "lat": lat,
@@ -150,21 +199,26 @@ def reverse_geocode_locationiq(lat: float, lon: float):
             "format": "json"
         }
         
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            return {
-                "address": data.get("display_name"),
-                "city": data.get("address", {}).get("city"),
-                "country": data.get("address", {}).get("country")
-            }
-    except Exception:
-        pass
+        response = requests.get(url, params=params, timeout=settings.locationiq_timeout_seconds)
+        response.raise_for_status()
+        data = response.json()
+        return {
+            "address": data.get("display_name"),
+            "city": data.get("address", {}).get("city"),
+            "country": data.get("address", {}).get("country")
+        }
+    
+    try:
+        # ~10 m cells: nearby photos share the cached answer
+        return cached_call("locationiq", (round(lat, 4), round(lon, 4)), lookup, hedge=True)
+    except Exception as e:
+        print(f"LocationIQ lookup failed: {e}")
     
     return None
 
 def infer_event_from_context(labels: list, ocr_text: str, caption: str):
     """Use OpenAI to classify event type"""
+    openai_client = get_openai_client()
     if not openai_client:
         return "personal"
     
@@ -200,7 +254,8 @@ INSTRUCTIONS:
 
 Category:"""
         
-        response = openai_client.chat.completions.create(
+        response = call(
+            "openai", openai_client.chat.completions.create,
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=15,
@@ -223,24 +278,12 @@ Category:"""
 def extract_photo_date(s3_key: str):
     """Extract the date when photo was taken from EXIF data"""
     try:
-        # Download image from S3
-        s3_client = get_s3_client()
-        response = s3_client.get_object(Bucket=settings.aws_bucket_name, Key=s3_key)
-        image_bytes = response['Body'].read()
-        
-        # Extract EXIF data
-        image = Image.open(BytesIO(image_bytes))
-        exif_dict = image._getexif() or {}
+        exif_dict, _ = load_exif_tags(s3_key)
         
-        # Try to find date taken
-        for tag_id, value in exif_dict.items():
-            tag = TAGS.get(tag_id, tag_id)
-            if tag == "DateTimeOriginal":
-                # Parse EXIF datetime format: "2023:03:15 14:30:20"
-                from datetime import datetime
-                return datetime.strptime(str(value), '%Y:%m:%d %H:%M:%S')
-            elif tag == "DateTime":
-                from datetime import datetime
+        # Parse EXIF datetime format: "2023:03:15 14:30:20"
+        for tag in ("DateTimeOriginal", "DateTime"):
+            value = exif_dict.get(TAGS_BY_NAME[tag])
+            if value:
                 return datetime.strptime(str(value), '%Y:%m:%d %H:%M:%S')
     
     except Exception:
@@ -248,243 +291,335 @@ def extract_photo_date(s3_key: str):
     
     return None
 
-def process_image_async(event_id: int, s3_key: str, caption: str):
-    """Process image asynchronously with AI services"""
-    print(f"Starting image processing for event {event_id}, s3_key: {s3_key}, caption: '{caption}'")
-    db = SessionLocal()
+# Pipeline stages that can be re-run on their own (see reprocess.py)
+STAGES = ("vision", "location", "classify", "narrative", "questions")
+
+# Bump a stage's version whenever its prompt or logic changes (e.g. the
+# narrative prompt in ai.create_timeline_narrative or the categories in
+# infer_event_from_context) so stale events can be selected for reprocessing
+STAGE_VERSIONS = {
+    "vision": 1,
+    "location": 1,
+    "classify": 1,
+    "narrative": 1,
+    "questions": 1,
+}
+
+def run_vision_stage(s3_key: str) -> dict:
+    """
+    Labels first, then faces and OCR text only when the planner expects them
+    to find something; each from the provider configured for it (see vision.py)
+    """
+    image = vision.VisionImage(s3_key)
+    degraded = []
     
-    try:
-        # Check if AWS credentials are available
-        aws_available = bool(settings.aws_access_key_id and settings.aws_secret_access_key and settings.aws_bucket_name)
-        print(f"AWS available: {aws_available}")
-        
-        # Detect faces (with fallback)
-        faces = []
-        if aws_available:
-            try:
-                faces = detect_faces(s3_key)
-                print(f"AWS face detection successful: {len(faces)} faces")
-            except Exception as e:
-                print(f"Face detection failed: {e}, using mock data")
-                # Use mock data as fallback
-                faces = [
-                    {"age_range": {"Low": 25, "High": 35}, "gender": "Male", "emotions": []},
-                    {"age_range": {"Low": 28, "High": 38}, "gender": "Female", "emotions": []}
-                ]
-        else:
-            print("AWS not available, using mock face data")
-            # Mock some face data for testing when AWS is unavailable
-            faces = [
-                {"age_range": {"Low": 25, "High": 35}, "gender": "Male", "emotions": []},
-                {"age_range": {"Low": 28, "High": 38}, "gender": "Female", "emotions": []}
-            ]
-        
-        # Detect labels (with fallback)
-        labels = []
-        if aws_available:
-            try:
-                labels = detect_labels(s3_key)
-                print(f"AWS label detection successful: {len(labels)} labels")
-            except Exception as e:
-                print(f"Label detection failed: {e}, using mock data")
-                # Use mock data as fallback
-                labels = [
-                    {"name": "Person", "confidence": 85.0},
-                    {"name": "Outdoor", "confidence": 75.0},
-                    {"name": "Day", "confidence": 90.0}
-                ]
-        else:
-            print("AWS not available, using mock label data")
-            # Mock some common labels for testing when AWS is unavailable
-            labels = [
-                {"name": "Person", "confidence": 85.0},
-                {"name": "Outdoor", "confidence": 75.0},
-                {"name": "Day", "confidence": 90.0}
-            ]
-        
-        # Extract text (with fallback)
-        ocr_text = ""
-        if aws_available:
-            try:
-                ocr_text = extract_text_from_textract(s3_key)
-                print(f"AWS text extraction successful: '{ocr_text}'")
-            except Exception as e:
-                print(f"Text extraction failed: {e}, continuing without OCR")
-                ocr_text = ""
-        
-        # Get the current event to check for HEIC metadata
-        event = db.query(models.Event).filter(models.Event.id == event_id).first()
-        
-        # Extract photo date - prioritize HEIC metadata if available
-        print("Extracting photo date...")
-        print(f"Event ID: {event_id}, has heic_metadata: {event and event.heic_metadata is not None}")
-        if event and event.heic_metadata:
-            print(f"HEIC metadata keys: {list(event.heic_metadata.keys())}")
-            print(f"HEIC timestamp field: {event.heic_metadata.get('timestamp')}")
-            if 'extraction_error' in event.heic_metadata:
-                print(f"HEIC extraction error: {event.heic_metadata['extraction_error']}")
-            # Show all available EXIF tags for debugging
-            if 'all_exif_tags' in event.heic_metadata:
-                all_tags = event.heic_metadata['all_exif_tags']
-                date_related = {k: v for k, v in all_tags.items() if 'date' in k.lower() or 'time' in k.lower()}
-                print(f"HEIC date-related EXIF tags: {date_related}")
-                # Also show first 10 tags to see what's available
-                first_tags = dict(list(all_tags.items())[:10])
-                print(f"First 10 HEIC EXIF tags: {first_tags}")
-        
-        photo_date = None
-        if event and event.heic_metadata and event.heic_metadata.get('timestamp'):
-            print("Using date from HEIC metadata")
-            from datetime import datetime
-            timestamp_value = event.heic_metadata.get('timestamp')
-            print(f"Raw timestamp value: {timestamp_value}, type: {type(timestamp_value)}")
-            try:
-                # HEIC metadata timestamp is in ISO format
-                photo_date = datetime.fromisoformat(timestamp_value)
-                print(f"HEIC date parsed: {photo_date}")
-            except (ValueError, TypeError) as e:
-                print(f"Failed to parse HEIC timestamp '{timestamp_value}': {e}")
-        
-        if not photo_date:
-            print("Extracting photo date from S3 image EXIF...")
-            photo_date = extract_photo_date(s3_key)
-            print(f"S3 photo date extracted: {photo_date}")
-        
-        # Extract GPS coordinates - prioritize HEIC metadata if available
-        print("Extracting GPS coordinates...")
-        gps_coords = None
-        if event and event.heic_metadata and 'location' in event.heic_metadata:
-            heic_location = event.heic_metadata['location']
-            if 'latitude' in heic_location and 'longitude' in heic_location:
-                print("Using GPS from HEIC metadata")
-                gps_coords = {
-                    'latitude': heic_location['latitude'],
-                    'longitude': heic_location['longitude']
-                }
-                print(f"HEIC GPS coords: {gps_coords}")
-        
-        if not gps_coords:
-            print("Extracting GPS coordinates from S3 image EXIF...")
-            gps_coords = extract_exif_gps(s3_key)
-            print(f"S3 GPS coords: {gps_coords}")
-        location_info = None
-        if gps_coords and settings.locationiq_api_key:
-            try:
-                print("Attempting reverse geocoding...")
-                location_info = reverse_geocode_locationiq(
-                    gps_coords["latitude"], 
-                    gps_coords["longitude"]
-                )
-                print(f"Location info: {location_info}")
-            except Exception as e:
-                print(f"Reverse geocoding failed: {e}")
-        
-        # Classify event type (with fallback)
-        print("Classifying event type...")
-        event_type = "personal"  # Default fallback
-        if settings.openai_api_key:
-            try:
-                print("Attempting OpenAI event classification...")
-                event_type = infer_event_from_context(labels, ocr_text, caption)
-                print(f"Event type classified: {event_type}")
-            except Exception as e:
-                print(f"Event classification failed: {e}")
-        else:
-            print("No OpenAI key, using default event type: personal")
-        
-        # Get user profile and create first-person narrative summary
-        print("Getting user profile...")
-        user_profile = settings.user_profile
-        print(f"User profile loaded for: {user_profile.get('name')}")
-        
-        print("Creating timeline narrative using GPT-4 Vision...")
-        
-        # Get image bytes from S3 for GPT-4 Vision
-        image_bytes = None
+    def analyze(stage):
+        provider = vision.provider_for(stage)
         try:
-            s3_client = get_s3_client()
-            response = s3_client.get_object(Bucket=settings.aws_bucket_name, Key=s3_key)
-            image_bytes = response['Body'].read()
-            print("Image bytes retrieved from S3 for GPT-4 Vision")
+            result = vision.analyze(stage, image, provider)
+            print(f"{provider.name} {stage} successful: {len(result)} {'chars' if stage == 'ocr' else 'found'}")
+            return result, provider.name
         except Exception as e:
-            print(f"Failed to get image bytes from S3: {e}")
-        
-        # Format photo datetime for GPT-4 Vision
-        photo_datetime_str = ""
-        if photo_date:
-            photo_datetime_str = photo_date.isoformat()
-        
-        if image_bytes:
-            timeline_narrative = create_timeline_narrative(
-                image_bytes=image_bytes,
-                caption=caption,
-                photo_datetime=photo_datetime_str,
-                location_info=location_info,
-                user_profile=user_profile
-            )
+            # No results rather than demo data; the stage is flagged for reprocessing
+            fallback = vision.fallback_provider(stage)
+            print(f"{provider.name} {stage} failed: {e}, using {fallback.name} provider")
+            degraded.append(stage)
+            return vision.analyze(stage, image, fallback), fallback.name
+    
+    labels, label_provider = analyze("labels")
+    plan = planner.plan_vision(labels, label_provider)
+    results = {"faces": [], "ocr": ""}
+    for stage in ("faces", "ocr"):
+        step = plan[stage]
+        if step["run"]:
+            started = time.monotonic()
+            results[stage], step["provider"] = analyze(stage)
+            step["ms"] = round((time.monotonic() - started) * 1000)
         else:
-            # Fallback to old method if image bytes not available
-            timeline_narrative = create_first_person_summary(
-                caption=caption,
-                labels=labels,
-                location_info=location_info,
-                faces=faces,
-                ocr_text=ocr_text,
-                heic_metadata=None,
-                user_profile=user_profile
-            )
-        
-        print(f"Narrative created: '{timeline_narrative}'")
-        
-        # Generate clarification questions for photos without captions
-        print("Checking for clarification questions...")
-        clarification_questions = []
-        if not caption or len(caption.strip()) <= 3:
-            print(f"Generating questions for empty caption. Labels: {[l.get('name') for l in labels]}, faces: {len(faces)}")
-            clarification_questions = generate_clarification_questions(
-                labels=labels,
-                location_info=location_info,
-                faces=faces,
-                ocr_text=ocr_text,
-                user_profile=user_profile
+            step["provider"] = vision.provider_for(stage).name
+            print(f"Planner skipped {stage}: {step['reason']}")
+    
+    return {"faces": results["faces"], "labels": labels, "ocr_text": results["ocr"],
+            "vision_degraded": degraded, "plan": plan}
+
+def resolve_photo_date(event, s3_key: str):
+    """Photo date - prioritize HEIC metadata if available"""
+    print("Extracting photo date...")
+    print(f"Event ID: {event.id if event else None}, has heic_metadata: {event and event.heic_metadata is not None}")
+    if event and event.heic_metadata:
+        print(f"HEIC metadata keys: {list(event.heic_metadata.keys())}")
+        print(f"HEIC timestamp field: {event.heic_metadata.get('timestamp')}")
+        if 'extraction_error' in event.heic_metadata:
+            print(f"HEIC extraction error: {event.heic_metadata['extraction_error']}")
+        # Show all available EXIF tags for debugging
+        if 'all_exif_tags' in event.heic_metadata:
+            all_tags = event.heic_metadata['all_exif_tags']
+            date_related = {k: v for k, v in all_tags.items() if 'date' in k.lower() or 'time' in k.lower()}
+            print(f"HEIC date-related EXIF tags: {date_related}")
+            # Also show first 10 tags to see what's available
+            first_tags = dict(list(all_tags.items())[:10])
+            print(f"First 10 HEIC EXIF tags: {first_tags}")
+    
+    photo_date = None
+    if event and event.heic_metadata and event.heic_metadata.get('timestamp'):
+        print("Using date from HEIC metadata")
+        from datetime import datetime
+        timestamp_value = event.heic_metadata.get('timestamp')
+        print(f"Raw timestamp value: {timestamp_value}, type: {type(timestamp_value)}")
+        try:
+            # HEIC metadata timestamp is in ISO format
+            photo_date = datetime.fromisoformat(timestamp_value)
+            print(f"HEIC date parsed: {photo_date}")
+        except (ValueError, TypeError) as e:
+            print(f"Failed to parse HEIC timestamp '{timestamp_value}': {e}")
+    
+    if not photo_date:
+        print("Extracting photo date from S3 image EXIF...")
+        photo_date = extract_photo_date(s3_key)
+        print(f"S3 photo date extracted: {photo_date}")
+    return photo_date
+
+def run_location_stage(event, s3_key: str) -> dict:
+    """GPS coordinates - prioritize HEIC metadata if available - and reverse geocoding when there is GPS"""
+    print("Extracting GPS coordinates...")
+    gps_coords = None
+    plan = {}
+    if event and event.heic_metadata and 'location' in event.heic_metadata:
+        heic_location = event.heic_metadata['location']
+        if 'latitude' in heic_location and 'longitude' in heic_location:
+            print("Using GPS from HEIC metadata")
+            gps_coords = {
+                'latitude': heic_location['latitude'],
+                'longitude': heic_location['longitude']
+            }
+            plan["exif"] = {"source": "heic_metadata"}
+            print(f"HEIC GPS coords: {gps_coords}")
+    
+    if not gps_coords:
+        print("Extracting GPS coordinates from S3 image EXIF...")
+        try:
+            exif_dict, source = load_exif_tags(s3_key)
+            gps_coords = gps_from_exif(exif_dict)
+            plan["exif"] = {"source": source}
+        except Exception as e:
+            print(f"EXIF extraction failed: {e}")
+        print(f"S3 GPS coords: {gps_coords}")
+    location_info = None
+    if not gps_coords:
+        plan["geocode"] = planner.decision(False, "no GPS", "locationiq")
+    elif not settings.locationiq_api_key:
+        plan["geocode"] = planner.decision(False, "no LocationIQ key", "locationiq")
+    else:
+        plan["geocode"] = planner.decision(True, "GPS present", "locationiq")
+        started = time.monotonic()
+        try:
+            print("Attempting reverse geocoding...")
+            location_info = reverse_geocode_locationiq(
+                gps_coords["latitude"], 
+                gps_coords["longitude"]
             )
-            print(f"Generated {len(clarification_questions)} questions: {clarification_questions}")
-        
-        # Prepare AI results
-        print("Preparing AI results...")
-        ai_results = {
-            "faces": faces,
-            "labels": labels,
-            "ocr_text": ocr_text,
-            "location": location_info,
-            "event_type": event_type,
-            "clarification_questions": clarification_questions
-        }
-        print("AI results prepared successfully")
-        
-        # Update event in database (event already queried above)
-        if event:
-            event.ai_results = ai_results
-            event.processing_status = "completed"
-            event.summary = timeline_narrative  # Use timeline narrative instead of caption
-            event.photo_taken_at = photo_date  # Store the actual photo date
-            
-            # Update labels field with top labels
-            top_labels = [label["name"] for label in labels[:5]]
-            event.labels = ",".join(top_labels)
-            
-            print(f"Updated event {event_id}: status=completed, summary='{timeline_narrative}', questions={len(clarification_questions)}")
-            db.commit()
-        else:
-            print(f"Event {event_id} not found in database!")
+            print(f"Location info: {location_info}")
+        except Exception as e:
+            print(f"Reverse geocoding failed: {e}")
+        plan["geocode"]["ms"] = round((time.monotonic() - started) * 1000)
+    return {"gps": gps_coords, "location": location_info, "plan": plan}
+
+def merge_stage_results(ai_results: dict, stage_results: dict) -> None:
+    """Add one stage's output to ai_results, merging its planner decisions into ai_results["plan"]"""
+    stage_plan = stage_results.pop("plan", None)
+    ai_results.update(stage_results)
+    if stage_plan:
+        ai_results["plan"] = {**(ai_results.get("plan") or {}), **stage_plan}
+
+def run_classify_stage(results: dict, caption: str) -> str:
+    """Classify event type (with fallback)"""
+    print("Classifying event type...")
+    event_type = "personal"  # Default fallback
+    if settings.openai_api_key:
+        try:
+            print("Attempting OpenAI event classification...")
+            event_type = infer_event_from_context(results.get("labels") or [], results.get("ocr_text") or "", caption)
+            print(f"Event type classified: {event_type}")
+        except Exception as e:
+            print(f"Event classification failed: {e}")
+    else:
+        print("No OpenAI key, using default event type: personal")
+    return event_type
+
+def run_narrative_stage(s3_key: str, caption: str, photo_date, results: dict) -> str:
+    """First-person timeline narrative (GPT-4 Vision, or text-only fallback)"""
+    # Get user profile and create first-person narrative summary
+    print("Getting user profile...")
+    user_profile = settings.user_profile
+    print(f"User profile loaded for: {user_profile.get('name')}")
+    
+    print("Creating timeline narrative using GPT-4 Vision...")
     
+    # Get image bytes from S3 for GPT-4 Vision
+    image_bytes = None
+    try:
+        image_bytes = download_from_s3(s3_key)
+        print("Image bytes retrieved from S3 for GPT-4 Vision")
     except Exception as e:
-        # Mark as failed
-        event = db.query(models.Event).filter(models.Event.id == event_id).first()
-        if event:
-            event.processing_status = "failed"
-            event.ai_results = {"error": str(e)}
-            db.commit()
+        print(f"Failed to get image bytes from S3: {e}")
+    
+    # High detail sees at most a 768 px short side; sending more only costs memory and bandwidth
+    if image_bytes and settings.narrative_image_short_side:
+        try:
+            image_bytes = fit_short_side(image_bytes, settings.narrative_image_short_side)
+        except Exception as e:
+            print(f"Narrative image downscale failed, sending the original: {e}")
+    
+    # Format photo datetime for GPT-4 Vision
+    photo_datetime_str = ""
+    if photo_date:
+        photo_datetime_str = photo_date.isoformat()
+    
+    if image_bytes:
+        timeline_narrative = create_timeline_narrative(
+            image_bytes=image_bytes,
+            caption=caption,
+            photo_datetime=photo_datetime_str,
+            location_info=results.get("location"),
+            user_profile=user_profile
+        )
+    else:
+        # Fallback to old method if image bytes not available
+        timeline_narrative = create_first_person_summary(
+            caption=caption,
+            labels=results.get("labels") or [],
+            location_info=results.get("location"),
+            faces=results.get("faces") or [],
+            ocr_text=results.get("ocr_text") or "",
+            heic_metadata=None,
+            user_profile=user_profile
+        )
+    
+    print(f"Narrative created: '{timeline_narrative}'")
+    return timeline_narrative
+
+def run_questions_stage(caption: str, results: dict) -> list:
+    """Clarification questions for photos without captions"""
+    print("Checking for clarification questions...")
+    clarification_questions = []
+    if not caption or len(caption.strip()) <= 3:
+        labels = results.get("labels") or []
+        faces = results.get("faces") or []
+        print(f"Generating questions for empty caption. Labels: {[l.get('name') for l in labels]}, faces: {len(faces)}")
+        clarification_questions = generate_clarification_questions(
+            labels=labels,
+            location_info=results.get("location"),
+            faces=faces,
+            ocr_text=results.get("ocr_text") or "",
+            user_profile=settings.user_profile
+        )
+        print(f"Generated {len(clarification_questions)} questions: {clarification_questions}")
+    return clarification_questions
+
+def save_results(db, event, ai_results: dict, summary: str, photo_date) -> None:
+    """Store pipeline output on the event and refresh everything derived from it"""
+    # Reprocessing a completed event replaces its rollup contribution
+    if rollups.is_rolled_up(event):
+        rollups.apply_event(db, event, sign=-1)
+    event.ai_results = ai_results
+    event.processing_status = "completed"
+    event.summary = summary  # Use timeline narrative instead of caption
+    event.photo_taken_at = photo_date  # Store the actual photo date
+    gps_coords = ai_results.get("gps")
+    for column, value in geo_index.location_columns(gps_coords).items():
+        setattr(event, column, value)
+    
+    # Update labels field with top labels
+    top_labels = [label["name"] for label in (ai_results.get("labels") or [])[:5]]
+    event.labels = ",".join(top_labels)
+    rollups.apply_event(db, event)
     
-    finally:
-        db.close()
\ No newline at end of file
+    print(f"Updated event {event.id}: status=completed, summary='{summary}', questions={len(ai_results.get('clarification_questions') or [])}")
+    db.commit()
+    timeline_cache.invalidate(event.session_id)
+
+    # Clustering is derived data; a failure here must not fail the event
+    try:
+        moment = clustering.event_moment(event, gps_coords, (ai_results.get("location") or {}).get("city"))
+        if moment:
+            clustering.assign_moment(db, moment)
+            db.commit()
+    except Exception as cluster_error:
+        db.rollback()
+        print(f"Clustering failed for event {event.id}: {cluster_error}")
+
+def process_image_async(event_id: int, s3_key: str, caption: str, session_id: str | None = None,
+                        convert_original: bool = False, memory_estimate: int | None = None):
+    """
+    Process image asynchronously with AI services. With convert_original
+    (HEIC uploads), the full-resolution JPEG is produced from the stored
+    original (s3.original_key) and stored at s3_key first; the upload only
+    stored the original and a preview. The job waits until its memory
+    reservation (memory_estimate, see memory_budget) fits.
+    """
+    print(f"Starting image processing for event {event_id}, s3_key: {s3_key}, caption: '{caption}'")
+    with memory_budget.job(f"event {event_id}", memory_estimate) as memory:
+        db = SessionLocal()
+        
+        try:
+            if convert_original:
+                print("Converting original upload to full-resolution JPEG...")
+                with memory.stage("convert"):
+                    jpeg_bytes = convert_heic_to_jpeg(download_from_s3(original_key(s3_key)))
+                    spool.store(s3_key, jpeg_bytes)
+                # The JPEG is stored; the original is no longer needed
+                delete_objects([original_key(s3_key)])
+                memory.shrink(memory_budget.estimate_job_bytes(len(jpeg_bytes)))
+                jpeg_bytes = None
+                print(f"Stored converted JPEG at {s3_key}")
+            
+            # Get the current event to check for HEIC metadata
+            event = db.query(models.Event).filter(*event_filter(event_id, session_id)).first()
+            # A near-duplicate of a burst's representative shares its results instead
+            if event and bursts.join_burst(db, event) is not None:
+                return
+            
+            ai_results = {}
+            with memory.stage("vision"):
+                merge_stage_results(ai_results, run_vision_stage(s3_key))
+            
+            with memory.stage("location"):
+                photo_date = resolve_photo_date(event, s3_key)
+                merge_stage_results(ai_results, run_location_stage(event, s3_key))
+            with memory.stage("classify"):
+                ai_results["event_type"] = run_classify_stage(ai_results, caption)
+            with memory.stage("narrative"):
+                timeline_narrative = run_narrative_stage(s3_key, caption, photo_date, ai_results)
+            ai_results["clarification_questions"] = run_questions_stage(caption, ai_results)
+            ai_results["stage_versions"] = dict(STAGE_VERSIONS)
+            print("AI results prepared successfully")
+            
+            # Update event in database (event already queried above)
+            if event:
+                save_results(db, event, ai_results, timeline_narrative, photo_date)
+                try:
+                    bursts.share_results(db, event)
+                except Exception as share_error:
+                    db.rollback()
+                    print(f"Sharing results with the burst of event {event.id} failed: {share_error}")
+            else:
+                print(f"Event {event_id} not found in database!")
+        
+        except Exception as e:
+            # Mark as failed
+            db.rollback()
+            event = db.query(models.Event).filter(*event_filter(event_id, session_id)).first()
+            if event:
+                if rollups.is_rolled_up(event):
+                    rollups.apply_event(db, event, sign=-1)
+                clustering.remove_events(db, [event.id])
+                event.processing_status = "failed"
+                event.ai_results = {"error": str(e)}
+                followers = bursts.release_followers(db, event)  # commits
+                timeline_cache.invalidate(event.session_id)
+                for follower in followers:
+                    scheduler.submit(scheduler.IMPORT, follower.session_id, process_image_async,
+                                     follower.id, follower.source, follower.user_caption or "", follower.session_id)
+        
+        finally:
+            db.close()
@@ -0,0 +1,587 @@
+"""
+Bulk import of photo libraries
+Walks directories and ZIP archives (Google Takeout parts, Apple Photos
+exports), reads sidecar metadata when present (Takeout <name>.json or
+<name>.supplemental-metadata.json, XMP <stem>.xmp) and skips files whose
+content hash was already imported into the session. Files are hashed on an
+I/O thread pool, converted to JPEG on a process pool and uploaded on the
+I/O pool; each chunk's events are inserted in one transaction and queued
+for analysis at import priority at a limited rate. The API workers run the
+analysis behind interactive uploads (see analysis_queue.py); --drain runs
+it in this process when no API is running. The checkpoint advances once a
+chunk is stored, so an interrupted import resumes where it left off (a
+repeated chunk is recognised by its hashes), and imported events still
+pending analysis are queued again.
+
+    python -m app.importer ~/Downloads/takeout-*.zip --session-id <id>
+    python -m app.importer ~/Pictures/Export --session-id <id> --no-analyze
+"""
+import argparse
+import hashlib
+import html
+import json
+import os
+import posixpath
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+from sqlalchemy import select, update
+from .settings import settings
+from .db import SessionLocal, engine, dialect_insert
+from .reprocess import RateLimiter, save_checkpoint, format_eta
+from . import models, timeline_cache, geo_index, scheduler, bursts, analysis_queue
+
+DEFAULT_CHECKPOINT = "import.checkpoint.json"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".heic", ".heif", ".webp", ".gif", ".tif", ".tiff", ".bmp"}
+SIDECAR_EXTENSIONS = {".json", ".xmp"}
+TAKEOUT_NAME_LIMIT = 46        # Takeout truncates sidecar names to 46 characters before ".json"
+CHILD_MAX_TASKS = 200          # recycle converter processes (HEIC decodes fragment their heap)
+MAX_RECORDED_FAILURES = 100    # failed file names kept in the checkpoint
+
+
+class SourceFile(NamedTuple):
+    source: str   # directory or ZIP archive
+    member: str   # path inside it, "/"-separated
+
+
+_archives: Dict[str, Tuple[zipfile.ZipFile, threading.Lock]] = {}
+_archives_lock = threading.Lock()
+
+
+def _archive(path: str) -> Tuple[zipfile.ZipFile, threading.Lock]:
+    """One open ZipFile per archive and process; reads are serialized per archive"""
+    with _archives_lock:
+        if path not in _archives:
+            _archives[path] = (zipfile.ZipFile(path), threading.Lock())
+        return _archives[path]
+
+
+def read_file(item: SourceFile) -> bytes:
+    if os.path.isdir(item.source):
+        with open(os.path.join(item.source, *item.member.split("/")), "rb") as f:
+            return f.read()
+    archive, lock = _archive(item.source)
+    with lock:
+        return archive.read(item.member)
+
+
+def _is_hidden(member: str) -> bool:
+    # dotfiles, macOS resource forks ("._IMG.jpg") and "__MACOSX/" folders in ZIPs
+    return any(part.startswith(".") or part == "__MACOSX" for part in member.split("/"))
+
+
+def _members(source: str) -> Iterator[str]:
+    if os.path.isdir(source):
+        for root, dirs, names in os.walk(source):
+            dirs.sort()
+            relative = os.path.relpath(root, source)
+            prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+            for name in sorted(names):
+                yield prefix + name
+    elif zipfile.is_zipfile(source):
+        archive, _ = _archive(source)
+        yield from sorted(info.filename for info in archive.infolist() if not info.is_dir())
+    else:
+        raise ValueError(f"{source} is neither a directory nor a ZIP archive (extract .tgz Takeout exports first)")
+
+
+def scan_sources(sources: Sequence[str]) -> Tuple[List[SourceFile], Dict[str, SourceFile]]:
+    """Photos in a stable order, and sidecar files by their path inside the sources"""
+    photos: List[SourceFile] = []
+    sidecars: Dict[str, SourceFile] = {}
+    for source in sources:
+        for member in _members(source):
+            if _is_hidden(member):
+                continue
+            extension = posixpath.splitext(member)[1].lower()
+            if extension in IMAGE_EXTENSIONS:
+                photos.append(SourceFile(source, member))
+            elif extension in SIDECAR_EXTENSIONS:
+                # Takeout splits large exports over several ZIPs with the same layout
+                sidecars.setdefault(member, SourceFile(source, member))
+    return photos, sidecars
+
+
+def takeout_sidecar_names(name: str) -> Iterator[str]:
+    """Sidecar names Google Takeout uses for a photo file name"""
+    number = ""
+    duplicate = re.match(r"^(.*)\((\d+)\)(\.[^.]+)$", name)
+    if duplicate:  # IMG(1).jpg -> IMG.jpg(1).json
+        name, number = duplicate.group(1) + duplicate.group(3), f"({duplicate.group(2)})"
+    name = re.sub(r"-edited(\.[^.]+)$", r"\1", name)  # edited copies share the original's sidecar
+    for suffix in (".supplemental-metadata", ""):
+        yield name + suffix + number + ".json"
+        yield (name + suffix)[:TAKEOUT_NAME_LIMIT] + number + ".json"
+
+
+def parse_takeout_sidecar(data: bytes) -> Dict[str, Any]:
+    document = json.loads(data)
+    result: Dict[str, Any] = {"format": "takeout"}
+    taken = (document.get("photoTakenTime") or {}).get("timestamp")
+    if taken:
+        result["timestamp"] = datetime.fromtimestamp(int(taken), timezone.utc).isoformat()
+    # geoData holds edits made in Google Photos, geoDataExif the camera's position; 0/0 means none
+    for key in ("geoData", "geoDataExif"):
+        geo = document.get(key) or {}
+        if geo.get("latitude") or geo.get("longitude"):
+            result["latitude"], result["longitude"] = geo["latitude"], geo["longitude"]
+            break
+    if document.get("description"):
+        result["description"] = document["description"]
+    return result
+
+
+def _xmp_value(text: str, tag: str) -> Optional[str]:
+    match = re.search(rf'{tag}="([^"]*)"', text) or re.search(rf"<{tag}>([^<]*)</{tag}>", text)
+    return html.unescape(match.group(1)).strip() if match else None
+
+
+def _xmp_coordinate(value: Optional[str]) -> Optional[float]:
+    """XMP GPS values look like "37,46.2834N" or "37,46,17.0N" """
+    match = re.match(r"^\s*(\d+),(\d+(?:\.\d+)?)(?:,(\d+(?:\.\d+)?))?\s*([NSEW])\s*$", value or "")
+    if not match:
+        return None
+    degrees, minutes, seconds, ref = match.groups()
+    decimal = float(degrees) + float(minutes) / 60 + float(seconds or 0) / 3600
+    return -decimal if ref in "SW" else decimal
+
+
+def parse_xmp_sidecar(data: bytes) -> Dict[str, Any]:
+    text = data.decode("utf-8", errors="replace")
+    result: Dict[str, Any] = {"format": "xmp"}
+    for tag in ("exif:DateTimeOriginal", "photoshop:DateCreated", "xmp:CreateDate"):
+        value = _xmp_value(text, tag)
+        if value:
+            try:
+                result["timestamp"] = datetime.fromisoformat(value.replace("Z", "+00:00")).isoformat()
+                break
+            except ValueError:
+                pass
+    latitude = _xmp_coordinate(_xmp_value(text, "exif:GPSLatitude"))
+    longitude = _xmp_coordinate(_xmp_value(text, "exif:GPSLongitude"))
+    if latitude is not None and longitude is not None:
+        result["latitude"], result["longitude"] = latitude, longitude
+    description = re.search(r"<dc:description>.*?<rdf:li[^>]*>([^<]*)</rdf:li>", text, re.DOTALL)
+    if description and description.group(1).strip():
+        result["description"] = html.unescape(description.group(1)).strip()
+    return result
+
+
+def read_sidecar(item: SourceFile, sidecars: Dict[str, SourceFile]) -> Optional[Dict[str, Any]]:
+    directory, name = posixpath.split(item.member)
+    stem = posixpath.splitext(name)[0]
+    candidates = [(candidate, parse_takeout_sidecar) for candidate in takeout_sidecar_names(name)]
+    candidates += [(candidate, parse_xmp_sidecar) for candidate in (stem + ".xmp", stem + ".XMP", name + ".xmp")]
+    for candidate, parse in candidates:
+        sidecar = sidecars.get(posixpath.join(directory, candidate))
+        if sidecar is not None:
+            try:
+                return {**parse(read_file(sidecar)), "name": sidecar.member}
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Import: unreadable sidecar {sidecar.member}: {e}")
+    return None
+
+
+def inspect_file(item: SourceFile, sidecars: Dict[str, SourceFile]) -> Dict[str, Any]:
+    """Content hash and sidecar metadata (I/O pool); the bytes are read again for conversion"""
+    data = read_file(item)
+    return {
+        "item": item,
+        "hash": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        "sidecar": read_sidecar(item, sidecars),
+    }
+
+
+def convert_file(item: SourceFile, quality: int) -> Dict[str, Any]:
+    """JPEG, preview and HEIC metadata for one file (runs in a converter process)"""
+    from .image_formats import sniff_format, embedded_preview, image_size, normalize_to_jpeg, HEIF, JPEG
+    from .heic_processor import is_heic_file, prepare_heic_upload, convert_heic_to_jpeg
+    data = read_file(item)
+    name = posixpath.basename(item.member)
+    image_format = sniff_format(data)
+    metadata = None
+    if image_format == HEIF or is_heic_file(name):
+        preview, metadata = prepare_heic_upload(data, name)
+        metadata["processing_info"]["conversion"] = "import"
+        jpeg = convert_heic_to_jpeg(data)
+    else:
+        preview = embedded_preview(data) if image_format == JPEG else None
+        jpeg = normalize_to_jpeg(data, quality=quality)
+    width, height = image_size(jpeg) or (0, 0)
+    return {"jpeg": jpeg, "preview": preview, "metadata": metadata, "pixels": width * height,
+            "signature": bursts.image_signature(jpeg)}
+
+
+def store_file(converted: Dict[str, Any], s3_client) -> Dict[str, Any]:
+    """Upload the JPEG and its preview (I/O pool)"""
+    from .s3 import new_image_key, upload_jpeg_to_s3, upload_preview_to_s3
+    from .memory_budget import estimate_job_bytes
+    s3_key = new_image_key()
+    upload_jpeg_to_s3(s3_key, converted["jpeg"], s3_client)
+    preview_key = None
+    if converted["preview"]:
+        try:
+            preview_key = upload_preview_to_s3(converted["preview"], s3_client)
+        except Exception as e:
+            print(f"Preview upload failed: {e}")
+    return {
+        "s3_key": s3_key,
+        "preview_key": preview_key,
+        "metadata": converted["metadata"],
+        "memory_estimate": estimate_job_bytes(len(converted["jpeg"]), converted["pixels"]),
+        "signature": converted["signature"],
+    }
+
+
+def event_metadata(metadata: Optional[Dict[str, Any]], sidecar: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    HEIC metadata with the sidecar's date and position on top. The pipeline
+    prefers heic_metadata's timestamp and location over the JPEG's EXIF, so
+    sidecar values win for every format.
+    """
+    metadata = dict(metadata or {})
+    if sidecar:
+        metadata["sidecar"] = sidecar
+        if sidecar.get("timestamp"):
+            metadata["timestamp"] = sidecar["timestamp"]
+        if sidecar.get("latitude") is not None:
+            metadata["location"] = {**(metadata.get("location") or {}),
+                                    "latitude": sidecar["latitude"], "longitude": sidecar["longitude"]}
+    return metadata or None
+
+
+def imported_hashes(session_id: str, hashes: Sequence[str]) -> Set[str]:
+    if not hashes:
+        return set()
+    with SessionLocal() as db:
+        return set(db.scalars(
+            select(models.ImportedFile.content_hash).where(
+                models.ImportedFile.session_id == session_id,
+                models.ImportedFile.content_hash.in_(hashes),
+            )
+        ))
+
+
+def insert_events(session_id: str, stored: Sequence[Dict[str, Any]]) -> List[Tuple[int, str, str, int]]:
+    """
+    Insert a chunk's content hashes and events in one transaction; returns
+    what to analyze. A hash another run claimed meanwhile gets no event,
+    and its uploaded objects are deleted again.
+    """
+    if not stored:
+        return []
+    with SessionLocal() as db:
+        # Claim the hashes first (event ids are filled in below); the unique key serializes overlapping runs
+        table = models.ImportedFile.__table__
+        claimed = set(db.scalars(
+            dialect_insert(engine.dialect.name, table).values([
+                {"session_id": session_id, "content_hash": entry["hash"], "event_id": 0,
+                 "source_name": entry["item"].member}
+                for entry in stored
+            ]).on_conflict_do_nothing(index_elements=[table.c.session_id, table.c.content_hash])
+            .returning(table.c.content_hash)
+        ).all())
+        fresh = [entry for entry in stored if entry["hash"] in claimed]
+        events = []
+        for entry in fresh:
+            sidecar = entry["sidecar"] or {}
+            metadata = event_metadata(entry["metadata"], sidecar)
+            timestamp = (metadata or {}).get("timestamp")
+            events.append(models.Event(
+                session_id=session_id,
+                kind="image",
+                source=entry["s3_key"],
+                summary="Processing...",
+                user_caption=sidecar.get("description") or "",
+                processing_status="pending",
+                heic_metadata=metadata,
+                original_filename=posixpath.basename(entry["item"].member)[:255],
+                preview_key=entry["preview_key"],
+                photo_taken_at=datetime.fromisoformat(timestamp) if timestamp else None,
+                **geo_index.location_columns((metadata or {}).get("location")),
+            ))
+        db.add_all(events)
+        db.flush()
+        for entry, event in zip(fresh, events):
+            bursts.add_signature(db, event, entry["signature"], (event.heic_metadata or {}).get("timestamp"))
+            db.execute(
+                update(models.ImportedFile)
+                .where(models.ImportedFile.session_id == session_id, models.ImportedFile.content_hash == entry["hash"])
+                .values(event_id=event.id)
+            )
+        db.commit()
+        queued = [(event.id, event.source, event.user_caption, entry["memory_estimate"])
+                  for entry, event in zip(fresh, events)]
+    if len(fresh) < len(stored):
+        from .s3 import delete_objects
+        print(f"Import: {len(stored) - len(fresh)} files were imported by another run meanwhile")
+        delete_objects([key for entry in stored if entry["hash"] not in claimed
+                        for key in (entry["s3_key"], entry["preview_key"]) if key])
+    timeline_cache.invalidate(session_id)
+    return queued
+
+
+def pending_imports(session_id: str) -> List[Tuple[int, str, str, None]]:
+    """Imported events of the session that never finished analysis (an interrupted run)"""
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(models.Event.id, models.Event.source, models.Event.user_caption)
+            .join(models.ImportedFile, models.ImportedFile.event_id == models.Event.id)
+            .where(models.ImportedFile.session_id == session_id,
+                   models.Event.session_id == session_id,
+                   models.Event.processing_status == "pending")
+            .order_by(models.Event.id)
+        ).all()
+    return [(row.id, row.source, row.user_caption or "", None) for row in rows]
+
+
+class AnalysisQueue:
+    """
+    Queues imported events for analysis at import priority (see
+    analysis_queue.py), at most `rate` per second. submit() blocks while
+    `depth` of them are queued or running, so a fast import waits for
+    analysis instead of piling up work.
+    """
+
+    def __init__(self, depth: int, rate: Optional[float], session_id: str):
+        self.session_id = session_id
+        self.depth = max(depth, 1)
+        self.limiter = RateLimiter(rate)
+        self.pending: Set[int] = set()
+        self.submitted = 0
+
+    def _wait(self, room: int) -> None:
+        """Block until at most room jobs are still open"""
+        if len(self.pending) > room:
+            current = analysis_queue.wait(self.pending, room)
+            self.pending = {job_id for job_id, status in current.items() if status in analysis_queue.OPEN}
+
+    def submit(self, event_id: int, s3_key: str, caption: str, memory_estimate: Optional[int]) -> None:
+        self._wait(self.depth - 1)
+        self.limiter.acquire()
+        self.pending.add(analysis_queue.enqueue(
+            scheduler.IMPORT, self.session_id, analysis_queue.ANALYZE, event_id,
+            s3_key=s3_key, caption=caption, memory_estimate=memory_estimate,
+        ))
+        self.submitted += 1
+
+    def close(self, cancel: bool = False) -> None:
+        if cancel:
+            # Jobs already running finish; the rest are queued again by the next run
+            analysis_queue.cancel(self.pending)
+            self.pending.clear()
+        self._wait(0)
+
+
+def import_chunk(
+    chunk: Sequence[SourceFile],
+    session_id: str,
+    sidecars: Dict[str, SourceFile],
+    cpu_pool: ProcessPoolExecutor,
+    io_pool: ThreadPoolExecutor,
+    s3_client,
+) -> Tuple[Dict[str, int], List[Tuple[int, str, str, int]], List[str]]:
+    """(counts, events to analyze, failed file names) for one chunk of files"""
+    counts = {"imported": 0, "duplicates": 0, "failed": 0, "bytes": 0}
+    failures: List[str] = []
+
+    def fail(item: SourceFile, error: Exception) -> None:
+        if isinstance(error, BrokenProcessPool):
+            raise error  # a killed converter (e.g. out of memory) must not mark files as done
+        counts["failed"] += 1
+        failures.append(item.member)
+        print(f"Import: {item.member} failed: {error.__class__.__name__}: {error}")
+
+    inspected = []
+    for item, future in [(item, io_pool.submit(inspect_file, item, sidecars)) for item in chunk]:
+        try:
+            inspected.append(future.result())
+        except Exception as e:
+            fail(item, e)
+
+    # Duplicates of earlier imports, and within the chunk, where a copy with a
+    # sidecar (e.g. the year folder rather than an album) is preferred
+    known = imported_hashes(session_id, [entry["hash"] for entry in inspected])
+    by_hash: Dict[str, Dict[str, Any]] = {}
+    for index, entry in enumerate(inspected):
+        entry["index"] = index
+        if entry["hash"] in known:
+            counts["duplicates"] += 1
+        elif entry["hash"] in by_hash:
+            counts["duplicates"] += 1
+            if entry["sidecar"] and not by_hash[entry["hash"]]["sidecar"]:
+                by_hash[entry["hash"]] = entry
+        else:
+            by_hash[entry["hash"]] = entry
+    fresh = list(by_hash.values())
+
+    # Each file is uploaded as soon as its conversion finishes
+    conversions = {cpu_pool.submit(convert_file, entry["item"], settings.upload_jpeg_quality): entry for entry in fresh}
+    uploads = {}
+    for future in as_completed(conversions):
+        entry = conversions[future]
+        try:
+            uploads[io_pool.submit(store_file, future.result(), s3_client)] = entry
+        except Exception as e:
+            fail(entry["item"], e)
+    stored = []
+    for future in as_completed(uploads):
+        entry = uploads[future]
+        try:
+            entry.update(future.result())
+            stored.append(entry)
+        except Exception as e:
+            fail(entry["item"], e)
+
+    stored.sort(key=lambda entry: entry["index"])
+    queued = insert_events(session_id, stored)
+    counts["imported"] = len(queued)
+    counts["duplicates"] += len(stored) - len(queued)  # claimed by an overlapping run meanwhile
+    counts["bytes"] = sum(entry["size"] for entry in inspected)
+    return counts, queued, failures
+
+
+def load_checkpoint(path: str, run: Dict[str, Any]) -> Dict[str, Any]:
+    """Resume state for the same sources and session; a different import starts over"""
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("run") == run:
+            print(f"Resuming from checkpoint {path}: {checkpoint['position']} files done, "
+                  f"{checkpoint['imported']} imported, {checkpoint['duplicates']} duplicates, {checkpoint['failed']} failed")
+            return checkpoint
+        print(f"Checkpoint {path} is for a different import; starting over")
+    return {"run": run, "position": 0, "imported": 0, "duplicates": 0, "failed": 0, "bytes": 0,
+            "failed_files": [], "finished": False}
+
+
+def import_library(
+    sources: Sequence[str],
+    session_id: str,
+    cpu_workers: Optional[int] = None,
+    io_workers: int = 8,
+    chunk_size: Optional[int] = None,
+    analyze: bool = True,
+    analysis_workers: int = 2,
+    rate: Optional[float] = None,
+    checkpoint_path: str = DEFAULT_CHECKPOINT,
+    restart: bool = False,
+) -> Dict[str, Any]:
+    """
+    Import every photo under sources into the session. Conversion runs on
+    cpu_workers processes, reads and uploads on io_workers threads; at most
+    chunk_size files are in flight, which bounds memory.
+    """
+    sources = [os.path.abspath(source) for source in sources]
+    run = {"sources": sources, "session_id": session_id}
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, run)
+    if checkpoint["finished"]:
+        print("Checkpoint says this import already finished; use --restart to run it again")
+        return checkpoint
+
+    cpu_workers = cpu_workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(cpu_workers, io_workers) * 2
+    photos, sidecars = scan_sources(sources)
+    total = len(photos)
+    analysis = f"{analysis_workers} workers at {rate or 'unlimited'}/s" if analyze else "off"
+    print(f"Importing {total} photos ({len(sidecars)} sidecar files) into session {session_id}: "
+          f"{cpu_workers} converter processes, {io_workers} I/O threads, analysis {analysis}")
+
+    from .s3 import get_s3_client
+    s3_client = get_s3_client()
+    cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers, max_tasks_per_child=CHILD_MAX_TASKS)
+    io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="import")
+    queue = AnalysisQueue(analysis_workers * 4, rate, session_id) if analyze else None
+    interrupted = False
+    started = time.monotonic()
+    done_files, done_bytes = 0, 0
+    try:
+        if queue:
+            pending = pending_imports(session_id)
+            if pending:
+                print(f"Queueing {len(pending)} imported events still pending analysis")
+            for entry in pending:
+                queue.submit(*entry)
+
+        for position in range(checkpoint["position"], total, chunk_size):
+            chunk = photos[position:position + chunk_size]
+            counts, queued, failures = import_chunk(chunk, session_id, sidecars, cpu_pool, io_pool, s3_client)
+            for key, value in counts.items():
+                checkpoint[key] += value
+            room = MAX_RECORDED_FAILURES - len(checkpoint["failed_files"])
+            checkpoint["failed_files"] += failures[:max(room, 0)]
+            checkpoint["position"] = position + len(chunk)
+            save_checkpoint(checkpoint_path, checkpoint)
+            if queue:
+                for entry in queued:
+                    queue.submit(*entry)
+
+            done_files += len(chunk)
+            done_bytes += counts["bytes"]
+            elapsed = time.monotonic() - started
+            files_per_second = done_files / elapsed if elapsed else 0.0
+            eta = format_eta((total - checkpoint["position"]) / files_per_second) if files_per_second else "unknown"
+            print(f"Imported {checkpoint['imported']} new / {checkpoint['duplicates']} duplicates / "
+                  f"{checkpoint['failed']} failed ({checkpoint['position']}/{total} files), "
+                  f"{files_per_second:.1f} files/s, {done_bytes / elapsed / 1024 / 1024:.1f} MB/s, ETA {eta}")
+        else:
+            checkpoint["finished"] = True
+            save_checkpoint(checkpoint_path, checkpoint)
+    except KeyboardInterrupt:
+        interrupted = True
+        print("Import interrupted; run the same command again to resume")
+    finally:
+        io_pool.shutdown(wait=True, cancel_futures=True)
+        cpu_pool.shutdown(wait=True, cancel_futures=True)
+        if queue:
+            if not interrupted:
+                print(f"Waiting for analysis of {queue.submitted} events...")
+            # Events left pending are queued again by the next run
+            queue.close(cancel=interrupted)
+
+    print(f"Import {'finished' if checkpoint['finished'] else 'stopped'}: {checkpoint['imported']} imported, "
+          f"{checkpoint['duplicates']} duplicates, {checkpoint['failed']} failed")
+    return checkpoint
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import photos from directories or ZIP archives (Google Takeout, Apple Photos exports)")
+    parser.add_argument("sources", nargs="+", help="Directories or ZIP archives (pass every takeout-*.zip part)")
+    parser.add_argument("--session-id", required=True)
+    parser.add_argument("--cpu-workers", type=int, help="Converter processes (default: CPU count)")
+    parser.add_argument("--io-workers", type=int, default=8, help="Threads reading, hashing and uploading")
+    parser.add_argument("--chunk-size", type=int, help="Files per checkpointed chunk")
+    parser.add_argument("--no-analyze", action="store_true",
+                        help="Only upload; analyze later with python -m app.reprocess --status pending")
+    parser.add_argument("--analysis-workers", type=int, default=2,
+                        help="Analysis jobs this import keeps in flight (4 queued per worker); with --drain, run here at once")
+    parser.add_argument("--rate", type=float, help="Maximum analysis jobs queued per second")
+    parser.add_argument("--drain", action="store_true",
+                        help="Also run queued analysis in this process (when no API workers are running)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args()
+    if args.drain and not args.no_analyze:
+        # This process only analyzes bulk work: no interactive reserve
+        scheduler.configure(workers=args.analysis_workers, reserved_interactive=0, session_concurrency=args.analysis_workers)
+        analysis_queue.start_drainer()
+    import_library(
+        args.sources,
+        args.session_id,
+        cpu_workers=args.cpu_workers,
+        io_workers=args.io_workers,
+        chunk_size=args.chunk_size,
+        analyze=not args.no_analyze,
+        analysis_workers=args.analysis_workers,
+        rate=args.rate,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart,
+    )
@@ -0,0 +1,100 @@
+"""
+Background job registry
+Long-running maintenance work runs in a daemon thread and reports its
+progress here so it can be polled through /api/jobs/{job_id}.
+"""
+import threading
+import traceback
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+# Finished jobs kept around for status polling
+MAX_FINISHED_JOBS = 100
+
+
+class Job:
+    def __init__(self, kind: str, params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "pending"  # "pending" | "running" | "completed" | "failed" | "cancelled"
+        self.progress: Dict[str, Any] = {}
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self._cancel = threading.Event()
+
+    def update(self, **progress: Any) -> None:
+        self.progress.update(progress)
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+_lock = threading.Lock()
+_jobs: Dict[str, Job] = {}
+
+
+def _run(job: Job, target: Callable[..., Any]) -> None:
+    job.status = "running"
+    try:
+        job.result = target(job=job, **job.params)
+        job.status = "cancelled" if job.cancelled else "completed"
+    except Exception as e:
+        print(f"Job {job.kind} {job.id} failed: {e}")
+        traceback.print_exc()
+        job.error = str(e)
+        job.status = "failed"
+    finally:
+        job.finished_at = datetime.now(timezone.utc)
+
+
+def _prune() -> None:
+    finished = [job for job in _jobs.values() if job.finished]
+    finished.sort(key=lambda job: job.finished_at)
+    for job in finished[:-MAX_FINISHED_JOBS]:
+        del _jobs[job.id]
+
+
+def start_job(kind: str, target: Callable[..., Any], **params: Any) -> Job:
+    """Run target(job=job, **params) in a daemon thread and register the job"""
+    job = Job(kind, params)
+    with _lock:
+        _prune()
+        _jobs[job.id] = job
+    threading.Thread(target=_run, args=(job, target), daemon=True).start()
+    return job
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs(kind: Optional[str] = None) -> List[Job]:
+    with _lock:
+        jobs = list(_jobs.values())
+    return [job for job in jobs if kind is None or job.kind == kind]
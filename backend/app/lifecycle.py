@@ -0,0 +1,280 @@
+"""
+Application lifecycle: startup work, pre-warming and readiness
+Schema migration, DB_INIT_MODE, create_all and events partitioning run from
+the FastAPI lifespan hook instead of at import, and only once per
+deployment: the first worker takes a lock, does the work and records a
+fingerprint (schema, partitioning, init mode, deployment id). Other workers
+and restarts of the same deployment find the fingerprint and skip it.
+The fingerprint is only recorded when every step succeeded; otherwise
+/ready reports the failure and the next start retries the work. DDL runs
+on db.ddl_engine, without DB_STATEMENT_TIMEOUT_MS.
+Provider modules (boto3, openai, Pillow, pillow-heif, exifread) are
+imported on first use; with PREWARM they are loaded and the connection
+pools filled in the background, and /ready waits for that.
+
+    python -m app.lifecycle   # run the startup work as a release step
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select, text
+from sqlalchemy.exc import DBAPIError
+from .settings import settings
+from .db import Base, engine, ddl_engine, async_engine, async_replica_engine, is_postgres, dialect_insert
+from . import models, spool, analysis_queue
+
+STARTUP_LOCK_ID = 7305120411  # pg advisory lock key for startup work
+FINGERPRINT_KEY = "startup_fingerprint"
+READY_CHECK_TIMEOUT = 2.0  # seconds per dependency check in /ready
+
+# Modules with heavy provider imports, loaded on first use or by prewarm
+PROVIDER_MODULES = ("image_processor", "heic_processor", "image_formats", "vision", "s3")
+
+_state: Dict[str, Any] = {"startup": "pending", "warm": "disabled"}
+_lock = threading.Lock()
+
+
+def _set_state(**values: Any) -> None:
+    with _lock:
+        _state.update(values)
+
+
+def startup_fingerprint() -> str:
+    """Identifies the startup work: changes with the schema, partitioning, init mode or deployment"""
+    parts = [
+        settings.deployment_id or os.environ.get("RENDER_GIT_COMMIT") or "",
+        settings.events_partitioning or "",
+        settings.db_init_mode or "",
+    ]
+    for table in sorted(Base.metadata.tables.values(), key=lambda table: table.name):
+        parts.append(table.name + ":" + ",".join(sorted(column.name for column in table.columns)))
+        parts.append(",".join(sorted(index.name for index in table.indexes if index.name)))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:32]
+
+
+def _applied_fingerprint() -> Optional[str]:
+    """Fingerprint of the last applied startup work (None on a new database)"""
+    try:
+        with engine.connect() as conn:
+            return conn.scalar(select(models.AppState.value).where(models.AppState.key == FINGERPRINT_KEY))
+    except DBAPIError:
+        return None
+
+
+def _record_fingerprint(fingerprint: str) -> None:
+    models.AppState.__table__.create(bind=ddl_engine, checkfirst=True)
+    table = models.AppState.__table__
+    statement = dialect_insert(engine.dialect.name, table).values(key=FINGERPRINT_KEY, value=fingerprint)
+    with engine.begin() as conn:
+        conn.execute(statement.on_conflict_do_update(index_elements=[table.c.key], set_={"value": fingerprint}))
+
+
+def _startup_work() -> List[str]:
+    """What main.py used to run at import time; returns the steps that failed"""
+    failed = []
+    try:
+        from .migrate import migrate_database
+        migrate_database()
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        failed.append("migration")
+
+    try:
+        from .db_init import run_database_initialization
+        run_database_initialization(settings.db_init_mode)
+    except Exception as e:
+        print(f"Database initialization failed: {e}")
+        failed.append("initialization")
+
+    try:
+        Base.metadata.create_all(bind=ddl_engine)
+    except Exception as e:
+        print(f"create_all failed: {e}")
+        failed.append("create_all")
+
+    try:
+        from .partitioning import migrate_partitioning
+        migrate_partitioning()
+    except Exception as e:
+        print(f"Events partitioning failed: {e}")
+        failed.append("partitioning")
+    return failed
+
+
+def prepare_database() -> bool:
+    """Run the startup work unless this deployment already did; True if it ran here"""
+    fingerprint = startup_fingerprint()
+    if _applied_fingerprint() == fingerprint:
+        print("Startup work already applied for this deployment")
+        return False
+
+    lock_conn = None
+    if is_postgres(settings.database_url):
+        # Workers starting together wait here; all but the first then find the fingerprint
+        lock_conn = engine.connect()
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": STARTUP_LOCK_ID})
+    try:
+        if _applied_fingerprint() == fingerprint:
+            print("Startup work applied by another worker")
+            return False
+        started = time.monotonic()
+        failed = _startup_work()
+        if failed:
+            # Not recorded, so the next start (or release step) retries it
+            raise RuntimeError(f"startup work failed: {', '.join(failed)}")
+        _record_fingerprint(fingerprint)
+        print(f"Startup work finished in {time.monotonic() - started:.2f}s")
+        return True
+    finally:
+        if lock_conn is not None:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": STARTUP_LOCK_ID})
+            lock_conn.close()
+
+
+def _warm_modules() -> None:
+    import importlib
+    for name in PROVIDER_MODULES:
+        importlib.import_module(f".{name}", __package__)
+    from . import signed_urls
+    if settings.aws_bucket_name:
+        signed_urls._signing_client()
+
+
+def _warm_sync_pool(connections: int) -> None:
+    held = []
+    try:
+        for _ in range(connections):
+            held.append(engine.connect())
+    finally:
+        for conn in held:
+            conn.close()
+
+
+async def _warm_async_pool(async_db_engine, connections: int) -> None:
+    held = []
+    try:
+        for _ in range(connections):
+            held.append(await async_db_engine.connect())
+    finally:
+        for conn in held:
+            await conn.close()
+
+
+async def prewarm() -> None:
+    """Import provider modules, create clients and open pool connections ahead of traffic"""
+    _set_state(warm="pending")
+    started = time.monotonic()
+    try:
+        connections = max(min(settings.prewarm_db_connections, settings.db_pool_size), 1)
+        await asyncio.to_thread(_warm_modules)
+        await asyncio.to_thread(_warm_sync_pool, connections)
+        for async_db_engine in (async_engine, async_replica_engine):
+            if async_db_engine is not None:
+                await _warm_async_pool(async_db_engine, connections)
+        _set_state(warm="ready")
+        print(f"Pre-warm finished in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        _set_state(warm=f"failed: {e}")
+        print(f"Pre-warm failed: {e}")
+
+
+async def startup() -> Optional[asyncio.Task]:
+    """Lifespan startup; returns the background pre-warm task, if any"""
+    if settings.run_startup_migrations:
+        try:
+            await asyncio.to_thread(prepare_database)
+            _set_state(startup="ready")
+        except Exception as e:
+            _set_state(startup=f"failed: {e}")
+            print(f"Startup work failed: {e}")
+    else:
+        _set_state(startup="external")
+    # Uploads an earlier run left in the spool
+    await asyncio.to_thread(spool.start)
+    if settings.analysis_queue_drain:
+        analysis_queue.start_drainer()
+    if settings.prewarm:
+        return asyncio.create_task(prewarm())
+    return None
+
+
+async def shutdown() -> None:
+    returned = await asyncio.to_thread(analysis_queue.stop_drainer)
+    if returned:
+        print(f"Shutdown: {returned} running bulk analysis jobs are queued again")
+    left = await asyncio.to_thread(spool.flush, settings.upload_spool_shutdown_seconds)
+    if left:
+        print(f"Shutdown: {left} uploads stay in the spool until the next start")
+    for async_db_engine in (async_engine, async_replica_engine):
+        if async_db_engine is not None:
+            await async_db_engine.dispose()
+    engine.dispose()
+
+
+async def _check_async_engine(async_db_engine) -> str:
+    try:
+        async with asyncio.timeout(READY_CHECK_TIMEOUT):
+            async with async_db_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        return "ok"
+    except Exception as e:
+        return f"error: {e.__class__.__name__}: {e}"
+
+
+def _select_one(db_engine) -> None:
+    with db_engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+async def _check_sync_engine(db_engine) -> str:
+    """The same check without an async driver, in a thread (which finishes on its own after a timeout)"""
+    try:
+        await asyncio.wait_for(asyncio.to_thread(_select_one, db_engine), READY_CHECK_TIMEOUT)
+        return "ok"
+    except Exception as e:
+        return f"error: {e.__class__.__name__}: {e}"
+
+
+async def _check_redis() -> str:
+    try:
+        from . import timeline_cache
+        client = getattr(timeline_cache.backend, "client", None)
+        if client is None:
+            return "error: redis backend not active"
+        await asyncio.wait_for(asyncio.to_thread(client.ping), READY_CHECK_TIMEOUT)
+        return "ok"
+    except Exception as e:
+        return f"error: {e.__class__.__name__}: {e}"
+
+
+async def readiness() -> Dict[str, Any]:
+    """Live dependency checks plus startup and pre-warm state"""
+    with _lock:
+        state = dict(_state)
+    checks: Dict[str, Any] = {"startup": state["startup"], "warm": state["warm"]}
+    if async_engine is not None:
+        checks["database"] = await _check_async_engine(async_engine)
+    else:
+        checks["database"] = await _check_sync_engine(engine)
+    if async_replica_engine is not None:
+        checks["replica"] = await _check_async_engine(async_replica_engine)
+    if settings.timeline_cache_backend == "redis":
+        checks["cache"] = await _check_redis()
+
+    # External providers are reported but never block readiness (the pipeline degrades)
+    from .resilience import breaker_metrics
+    checks["providers"] = breaker_metrics()
+
+    ready = (
+        state["startup"] in ("ready", "external")
+        and state["warm"] in ("ready", "disabled")
+        and all(checks[name] == "ok" for name in ("database", "replica", "cache") if name in checks)
+    )
+    return {"ready": ready, "checks": checks}
+
+
+if __name__ == "__main__":
+    prepare_database()
@@ -1,33 +1,29 @@
-from fastapi import FastAPI, Depends, UploadFile, File, Form, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, UploadFile, File, Form, HTTPException, Request, Query
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-import threading
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date
+from typing import Literal
 from .settings import settings
-from .db import Base, engine, SessionLocal
-from . import models, schemas
-from .ai import extract_keywords, summarize
-from .s3 import upload_image_to_s3, get_s3_url
-from .image_processor import process_image_async
-from .heic_processor import is_heic_file, process_heic_upload
-
-# Run database migration first
-try:
-    from .migrate import migrate_database
-    migrate_database()
-except Exception as e:
-    print(f"Migration failed: {e}")
-
-# Run database initialization if configured
-try:
-    from .db_init import run_database_initialization
-    run_database_initialization(settings.db_init_mode)
-except Exception as e:
-    print(f"Database initialization failed: {e}")
-    # Don't raise here to allow app to continue if initialization fails
-
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="Life Moments AI Backend")
+from .db import SessionLocal, AsyncSessionLocal, AsyncReadSessionLocal
+from . import models, schemas, metrics, timeline_cache, serialization, jobs, rollups, clustering, geo_index, resilience, signed_urls, lifecycle, scheduler, bursts
+from .text_ingest import ingest_texts
+# Image, storage and AI modules (boto3, openai, Pillow, pillow-heif) are
+# imported inside the handlers that need them to keep cold starts fast
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Migrations etc. once per deployment, then optional background pre-warm (see lifecycle.py)
+    warm_task = await lifecycle.startup()
+    yield
+    if warm_task:
+        warm_task.cancel()
+    await lifecycle.shutdown()
+
+app = FastAPI(title="Life Moments AI Backend", lifespan=lifespan)
 
 # Debug CORS settings
 print(f"CORS allowed origins: {settings.allowed_origins_list}")
@@ -47,19 +43,49 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Async session for request handlers so DB waits don't block the event loop"""
+    if AsyncSessionLocal is None:
+        raise HTTPException(status_code=503, detail="No async driver configured for DATABASE_URL")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def open_read_session(session_id: str) -> AsyncSession:
+    """Replica session for reads, or primary while the session's last write may still be replicating"""
+    if AsyncSessionLocal is None:
+        raise HTTPException(status_code=503, detail="No async driver configured for DATABASE_URL")
+    if timeline_cache.recently_written(session_id):
+        return AsyncSessionLocal()
+    return AsyncReadSessionLocal()
+
 @app.get("/health")
 async def health():
+    """Liveness: the process is up"""
     return {"status": "ok"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness: startup work done, pools warm (with PREWARM) and the databases reachable"""
+    status = await lifecycle.readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+def get_metrics():
+    # Collectors query the DB and scan the spool; run them in the threadpool, off the event loop
+    return metrics.snapshot()
+
 @app.post("/api/process", response_model=schemas.EventOut)
-async def process_text(payload: schemas.ProcessTextRequest, session_id: str, db: Session = Depends(get_db)):
-    labels = ",".join(extract_keywords(payload.text))
-    summary = await summarize(payload.text)
-    ev = models.Event(session_id=session_id, kind="text", source=payload.text[:2000], summary=summary, labels=labels)
-    db.add(ev)
-    db.commit()
-    db.refresh(ev)
-    return ev
+async def process_text(payload: schemas.ProcessTextRequest, session_id: str, db: AsyncSession = Depends(get_async_db)):
+    [event_id] = await ingest_texts(db, session_id, [payload.text])
+    timeline_cache.invalidate(session_id)
+    return await db.get(models.Event, event_id)
+
+@app.post("/api/process/batch", response_model=schemas.ProcessTextBatchOut)
+async def process_text_batch(payload: schemas.ProcessTextBatchRequest, session_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Import many text moments in one transaction (e.g. a journal export)"""
+    event_ids = await ingest_texts(db, session_id, payload.texts)
+    timeline_cache.invalidate(session_id)
+    return {"created": len(event_ids), "event_ids": event_ids}
 
 @app.post("/api/upload", response_model=schemas.EventOut)
 async def upload_image(
@@ -68,29 +94,60 @@ async def upload_image(
     session_id: str = Form(...),
     db: Session = Depends(get_db)
 ):
+    from .s3 import upload_image_to_s3, upload_preview_to_s3, new_image_key, store_original
+    from .spool import SpoolFull
+    from .image_processor import process_image_async
+    from .heic_processor import is_heic_file, prepare_heic_upload
+    from .image_formats import sniff_format, embedded_preview, image_size, HEIF, JPEG
+    from .memory_budget import estimate_job_bytes
+
+    # Read file content; the format comes from its magic bytes, not the client
+    image_bytes = await file.read()
+    image_format = sniff_format(image_bytes)
+    
     # Validate file type (accept both regular images and HEIC)
-    is_heic = is_heic_file(file.filename or "")
-    if not (file.content_type and file.content_type.startswith('image/')) and not is_heic:
+    is_heic = image_format == HEIF or is_heic_file(file.filename or "")
+    if not (file.content_type and file.content_type.startswith('image/')) and not is_heic and image_format is None:
         raise HTTPException(status_code=400, detail="File must be an image (including HEIC/HEIF)")
     
-    # Read file content
-    image_bytes = await file.read()
     heic_metadata = None
-    final_filename = file.filename
+    preview_bytes = None
     
     # Process HEIC files
     if is_heic:
         try:
-            # Extract metadata and convert to JPEG
-            image_bytes, heic_metadata = process_heic_upload(image_bytes, file.filename or "")
-            # Change filename extension to .jpg for S3 storage
-            base_name = (file.filename or "image").rsplit('.', 1)[0]
-            final_filename = f"{base_name}.jpg"
+            # Extract metadata and a fast preview; full conversion runs in the background
+            preview_bytes, heic_metadata = prepare_heic_upload(image_bytes, file.filename or "")
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Failed to process HEIC image: {str(e)}")
+        # The original is stored before the event exists; the background job converts that copy
+        s3_key = new_image_key()
+        try:
+            store_original(s3_key, image_bytes)
+        except SpoolFull as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    else:
+        if image_format == JPEG:
+            preview_bytes = embedded_preview(image_bytes)
+        # Upload to S3 (converted to JPEG unless it already is one)
+        try:
+            s3_key = upload_image_to_s3(image_bytes, file.filename or "image")
+        except SpoolFull as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+        except (OSError, SyntaxError, ValueError) as e:
+            # Pillow raises these for undecodable or unsupported image data
+            raise HTTPException(status_code=400, detail=f"Unsupported or corrupt image: {str(e)}")
+    
+    # The preview makes the returned event viewable before processing finishes
+    preview_key = None
+    if preview_bytes:
+        try:
+            preview_key = upload_preview_to_s3(preview_bytes)
+        except Exception as e:
+            print(f"Preview upload failed: {e}")
     
-    # Upload to S3 (now JPEG if converted from HEIC)
-    s3_key = upload_image_to_s3(image_bytes, final_filename)
+    # Perceptual hash and capture time, so a burst is analyzed once (see bursts.py)
+    signature = bursts.image_signature(image_bytes, preview_bytes)
     
     # Create event with pending status
     event = models.Event(
@@ -101,18 +158,23 @@ async def upload_image(
         user_caption=caption,     # Store original user caption
         processing_status="pending",
         heic_metadata=heic_metadata,
-        original_filename=file.filename
+        original_filename=file.filename,
+        preview_key=preview_key
     )
     db.add(event)
+    db.flush()
+    bursts.add_signature(db, event, signature, (heic_metadata or {}).get("timestamp"))
     db.commit()
     db.refresh(event)
+    timeline_cache.invalidate(session_id)
     
-    # Start background processing
-    threading.Thread(
-        target=process_image_async,
-        args=(event.id, s3_key, caption),
-        daemon=True
-    ).start()
+    # Queue background processing ahead of bulk work (it also waits for memory headroom)
+    width, height = image_size(image_bytes) or (0, 0)
+    memory_estimate = estimate_job_bytes(len(image_bytes), width * height, heic=is_heic)
+    scheduler.submit(
+        scheduler.INTERACTIVE, session_id, process_image_async,
+        event.id, s3_key, caption, session_id, is_heic, memory_estimate,
+    )
     
     return event
 
@@ -123,49 +185,218 @@ async def get_s3_config():
         "region": settings.aws_region
     }
 
+def wants_urls(urls: bool | None) -> bool:
+    return settings.embed_image_urls if urls is None else urls
+
+def events_out(events, urls: bool | None) -> list:
+    """Serialized events, with presigned image URLs when requested"""
+    out = [schemas.EventOut.model_validate(event).model_dump() for event in events]
+    return signed_urls.embed_urls(out) if wants_urls(urls) else out
+
 @app.get("/api/events", response_model=list[schemas.EventOut])
-async def list_events(session_id: str, db: Session = Depends(get_db)):
-    return db.query(models.Event).filter(models.Event.session_id == session_id).order_by(models.Event.id.desc()).limit(50).all()
+async def list_events(session_id: str, request: Request, urls: bool | None = None):
+    media_type = serialization.negotiate_media_type(request.headers.get("accept"))
+    encoding = serialization.negotiate_encoding(request.headers.get("accept-encoding"))
+    with_urls = wants_urls(urls)
+    # Pages with URLs are cached per signing window so they never outlive their URLs
+    base_variant = f"{media_type};urls={signed_urls.current_window()}" if with_urls else media_type
+    variant = f"{base_variant}+{encoding}" if encoding else base_variant
+
+    # Read the version before querying so a concurrent write can never be cached under it
+    version = timeline_cache.session_version(session_id)
+    if timeline_cache.needs_watermark():
+        # Writes by other processes never bump this process's in-memory version
+        async with open_read_session(session_id) as db:
+            count, updated_at = (await db.execute(timeline_cache.watermark_query(session_id))).one()
+        version = timeline_cache.with_watermark(version, count, updated_at)
+    headers = {
+        "ETag": timeline_cache.etag_for(session_id, version, variant),
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    # Compressed variants are cached separately; small pages are only cached raw
+    body = timeline_cache.get_page(session_id, version, variant) if encoding else None
+    if body is None:
+        body = timeline_cache.get_page(session_id, version, base_variant)
+        if body is None:
+            async with open_read_session(session_id) as db:
+                result = await db.execute(
+                    select(models.Event.__table__).where(models.Event.session_id == session_id).order_by(models.Event.id.desc()).limit(50)
+                )
+                body = serialization.encode_events(result.mappings().all(), media_type, with_urls)
+            timeline_cache.store_page(session_id, version, body, base_variant)
+        if encoding and len(body) >= serialization.MIN_COMPRESS_BYTES:
+            body = serialization.compress(body, encoding)
+            timeline_cache.store_page(session_id, version, body, variant)
+        else:
+            encoding = None
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+@app.get("/api/rollups", response_model=list[schemas.RollupOut])
+async def list_rollups(
+    session_id: str,
+    period: Literal["day", "week", "month"] = "month",
+    start: date | None = None,
+    end: date | None = None,
+):
+    """Timeline overview: one precomputed aggregate per day/week/month"""
+    query = select(models.TimelineRollup).where(
+        models.TimelineRollup.session_id == session_id,
+        models.TimelineRollup.period == period,
+    )
+    if start:
+        query = query.where(models.TimelineRollup.period_start >= start)
+    if end:
+        query = query.where(models.TimelineRollup.period_start <= end)
+    async with open_read_session(session_id) as db:
+        result = await db.execute(query.order_by(models.TimelineRollup.period_start.desc()))
+        return [rollups.rollup_out(rollup) for rollup in result.scalars().all()]
+
+@app.get("/api/clusters", response_model=list[schemas.ClusterOut])
+async def list_clusters(session_id: str, level: Literal["day", "trip", "place"] = "day"):
+    """Moments grouped into outings, trips or places"""
+    query = select(models.MomentCluster).where(
+        models.MomentCluster.session_id == session_id,
+        models.MomentCluster.level == level,
+    )
+    async with open_read_session(session_id) as db:
+        result = await db.execute(query.order_by(models.MomentCluster.start_at.desc()))
+        return [clustering.cluster_out(cluster) for cluster in result.scalars().all()]
+
+@app.get("/api/clusters/{cluster_id}/events", response_model=list[schemas.EventOut])
+async def list_cluster_events(cluster_id: int, session_id: str, urls: bool | None = None):
+    async with open_read_session(session_id) as db:
+        result = await db.execute(
+            select(models.Event)
+            .join(models.ClusterMember, models.ClusterMember.event_id == models.Event.id)
+            .where(
+                models.ClusterMember.cluster_id == cluster_id,
+                models.ClusterMember.session_id == session_id,
+                models.Event.session_id == session_id,
+            )
+            .order_by(models.ClusterMember.taken_at)
+        )
+        return events_out(result.scalars().all(), urls)
+
+@app.get("/api/geo/bbox", response_model=list[schemas.EventOut])
+async def events_in_bbox(
+    session_id: str,
+    min_lat: float = Query(ge=-90, le=90),
+    min_lon: float = Query(ge=-180, le=180),
+    max_lat: float = Query(ge=-90, le=90),
+    max_lon: float = Query(ge=-180, le=180),
+    limit: int = Query(500, ge=1, le=5000),
+    urls: bool | None = None,
+):
+    """Located events inside a bounding box (min_lon > max_lon crosses the antimeridian)"""
+    if min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="min_lat must not exceed max_lat")
+    async with open_read_session(session_id) as db:
+        events = await geo_index.events_in_bbox(db, session_id, (min_lat, min_lon, max_lat, max_lon), limit)
+        return events_out(events, urls)
+
+@app.get("/api/geo/near", response_model=list[schemas.NearbyEventOut])
+async def events_near(
+    session_id: str,
+    latitude: float = Query(ge=-90, le=90),
+    longitude: float = Query(ge=-180, le=180),
+    radius_km: float = Query(1.0, gt=0, le=500),
+    limit: int = Query(100, ge=1, le=1000),
+    urls: bool | None = None,
+):
+    """Events taken within radius_km of a point, nearest first"""
+    async with open_read_session(session_id) as db:
+        nearby = await geo_index.events_near(db, session_id, latitude, longitude, radius_km, limit)
+        events = events_out([event for event, _ in nearby], urls)
+        return [
+            {**event, "distance_km": round(distance, 4)}
+            for event, (_, distance) in zip(events, nearby)
+        ]
+
+@app.get("/api/geo/tiles/{zoom}/{x}/{y}", response_model=list[schemas.TileClusterOut])
+async def map_tile(session_id: str, zoom: int, x: int, y: int):
+    """Clustered photo counts for one slippy-map tile"""
+    if not 0 <= zoom <= 22 or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+    async with open_read_session(session_id) as db:
+        return await geo_index.tile_clusters(db, session_id, zoom, x, y)
+
+@app.get("/api/export")
+async def export_timeline(
+    session_id: str,
+    format: Literal["ndjson", "zip"] = "ndjson",
+    images: bool = True,
+    urls: bool = False,
+):
+    """Stream a session's events as NDJSON, or as a ZIP with the images (see export.py)"""
+    from .export import MEDIA_TYPES, export_stream
+    return StreamingResponse(
+        export_stream(session_id, format, images=images, urls=urls),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="timeline-{session_id}.{format}"'},
+    )
 
 @app.post("/api/truncate-events")
-async def truncate_events(db: Session = Depends(get_db)):
+async def truncate_events(session_id: str | None = None):
     """
-    DEBUG ENDPOINT: Truncate all events from the database.
+    DEBUG ENDPOINT: Purge all events (or one session's) and their S3 images in the background.
     TODO: Add proper authentication/authorization for this endpoint in production.
-    TODO: Consider adding S3 cleanup to also delete associated image files.
     """
-    try:
-        # Delete all events
-        count = db.query(models.Event).count()
-        db.query(models.Event).delete()
-        db.commit()
-        
-        return {"message": f"Successfully deleted {count} events", "deleted_count": count}
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to truncate events: {str(e)}")
+    from .purge import purge_events
+    job = jobs.start_job("purge", purge_events, session_id=session_id)
+    return {"message": "Purge started", "job_id": job.id}
+
+@app.post("/api/purge")
+async def purge(session_id: str | None = None, older_than_days: int | None = None, dry_run: bool = False):
+    """Start a chunked purge of events by session and/or age; poll /api/jobs/{job_id} for progress"""
+    if not session_id and older_than_days is None:
+        raise HTTPException(status_code=400, detail="Specify session_id and/or older_than_days")
+    from .purge import purge_events
+    job = jobs.start_job("purge", purge_events, session_id=session_id, older_than_days=older_than_days, dry_run=dry_run)
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
-from fastapi.responses import Response
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.cancel()
+    return job.to_dict()
 
 @app.get("/api/image-url/{s3_key:path}")
 async def get_image_url(s3_key: str):
     """Get presigned URL for S3 image"""
-    try:
-        url = get_s3_url(s3_key)
-        return {"url": url}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate image URL: {str(e)}")
+    url = signed_urls.signed_url(s3_key)
+    if url is None:
+        raise HTTPException(status_code=503, detail="Image storage is not available for signing")
+    return {"url": url, "expires_at": signed_urls.expires_at()}
+
+@app.post("/api/image-urls", response_model=schemas.ImageUrlsOut)
+async def get_image_urls(payload: schemas.ImageUrlsRequest):
+    """Presigned URLs for many keys at once (e.g. a whole timeline page); null where signing failed"""
+    return {"urls": signed_urls.signed_urls(payload.keys), "expires_at": signed_urls.expires_at()}
 
 @app.get("/api/image/{s3_key:path}")
 async def get_image_proxy(s3_key: str):
     """Proxy S3 images through backend"""
     try:
-        from .s3 import get_s3_client
-        s3_client = get_s3_client()
+        from .s3 import download_from_s3
         
         # Get image from S3
-        response = s3_client.get_object(Bucket=settings.aws_bucket_name, Key=s3_key)
-        image_data = response['Body'].read()
+        image_data = download_from_s3(s3_key)
         
         # Return image with appropriate headers
         return Response(
@@ -175,5 +406,7 @@ async def get_image_proxy(s3_key: str):
                 "Cache-Control": "public, max-age=3600"
             }
         )
+    except (resilience.CircuitOpenError, resilience.DeadlineExceeded) as e:
+        raise HTTPException(status_code=503, detail=f"Image storage unavailable: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Image not found: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""
+Memory budget for image pipeline jobs
+Every job reserves its estimated peak (estimate_job_bytes) before it starts
+and waits while either the budget (JOB_MEMORY_BUDGET_MB, by default half
+of the container's or machine's memory) or the memory actually free
+(keeping JOB_MEMORY_MIN_FREE_MB) cannot take it. A job larger than the
+whole budget still runs once nothing else holds a reservation, so huge
+photos are serialized rather than rejected. Jobs shrink their reservation
+as stages finish and drop their buffers.
+
+With MEMORY_PROFILE_SAMPLE_RATE a share of jobs is traced with tracemalloc,
+one at a time, and the peak per stage goes to /metrics. tracemalloc sees
+Python objects (downloaded bytes, base64 strings, request bodies) but not
+Pillow/libheif pixel buffers, which the estimate covers by pixel count;
+allocations of concurrent jobs are included, so read the numbers as upper
+bounds when jobs overlap.
+"""
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from .settings import settings
+from . import metrics
+
+MB = 1024 * 1024
+BASE_JOB_BYTES = 16 * MB          # results, clients, responses, DB objects
+HEIC_BYTES_PER_PIXEL = 12         # decode + RGB copy + optimized JPEG encode (~136 MB at 12 MP, bench_hot_paths)
+DECODE_BYTES_PER_PIXEL = 3        # one decoded RGB image (local vision providers)
+DRAFT_BYTES_PER_PIXEL = 0.75      # DCT-scaled decode at 1/2 for the narrative image
+REQUEST_COPIES_FACTOR = 8         # base64 string, JSON body and the HTTP client's copies (~42 MB for a 4.8 MB JPEG)
+PIXELS_PER_ENCODED_BYTE = 4       # when only the file size is known (phone JPEG/HEIC)
+FALLBACK_BUDGET_BYTES = 1024 * MB
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def _meminfo(field: str) -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def memory_limit() -> Optional[int]:
+    """The container's memory limit (cgroup v2 or v1), else the machine's memory"""
+    limit = _read_int("/sys/fs/cgroup/memory.max") or _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    total = _meminfo("MemTotal")
+    if limit and total:
+        return min(limit, total)  # v1 reports a huge number when unlimited
+    return limit or total
+
+
+def available_memory() -> Optional[int]:
+    """Bytes that can still be allocated before hitting the limit (None where unknown)"""
+    available = _meminfo("MemAvailable")
+    for limit_path, usage_path in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        limit, usage = _read_int(limit_path), _read_int(usage_path)
+        if limit and usage is not None and (available is None or limit - usage < available):
+            available = max(limit - usage, 0)
+            break
+    return available
+
+
+def estimate_job_bytes(encoded_bytes: Optional[int] = None, pixels: Optional[int] = None, heic: bool = False) -> int:
+    """
+    Peak memory of one job. Stages run one after another, so the peak is the
+    largest stage plus what every stage holds, not the sum.
+    """
+    if not encoded_bytes:
+        return settings.job_memory_default_mb * MB
+    pixels = pixels or encoded_bytes * PIXELS_PER_ENCODED_BYTE
+    jpeg_bytes = encoded_bytes
+    stages = []
+    if heic:
+        stages.append(encoded_bytes + pixels * HEIC_BYTES_PER_PIXEL)
+        jpeg_bytes = pixels // 3  # q95 optimized JPEG of the converted image
+    # EXIF fallback and local vision providers read the whole object
+    stages.append(jpeg_bytes + pixels * DECODE_BYTES_PER_PIXEL)
+    if settings.narrative_image_short_side:
+        stages.append(jpeg_bytes + int(pixels * DRAFT_BYTES_PER_PIXEL))
+    else:
+        stages.append(jpeg_bytes * (1 + REQUEST_COPIES_FACTOR))
+    return BASE_JOB_BYTES + max(stages)
+
+
+class MemoryBudget:
+    def __init__(self, capacity: int, min_free: int):
+        self.capacity = capacity
+        self.min_free = min_free
+        self.reserved = 0
+        self.running = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def _admissible(self, nbytes: int) -> bool:
+        if self.running == 0:
+            return True
+        if self.reserved + nbytes > self.capacity:
+            return False
+        free = available_memory()
+        return free is None or free - nbytes >= self.min_free
+
+    def acquire(self, nbytes: int) -> float:
+        """Block until nbytes can be reserved; returns the seconds waited"""
+        started = time.monotonic()
+        with self.condition:
+            if not self._admissible(nbytes):
+                self.waiting += 1
+                metrics.inc("job_memory_waited")
+                metrics.set_gauge("job_memory_waiting_jobs", self.waiting)
+                try:
+                    # Re-check periodically too: other processes free memory without notifying
+                    while not self._admissible(nbytes):
+                        self.condition.wait(timeout=0.5)
+                finally:
+                    self.waiting -= 1
+                    metrics.set_gauge("job_memory_waiting_jobs", self.waiting)
+            self.reserved += nbytes
+            self.running += 1
+            metrics.inc("job_memory_admitted")
+            metrics.set_gauge("job_memory_reserved_bytes", self.reserved)
+        return time.monotonic() - started
+
+    def give_back(self, nbytes: int, finished: bool = False) -> None:
+        with self.condition:
+            self.reserved -= nbytes
+            if finished:
+                self.running -= 1
+            metrics.set_gauge("job_memory_reserved_bytes", self.reserved)
+            self.condition.notify_all()
+
+    def status(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                "capacity_bytes": self.capacity,
+                "reserved_bytes": self.reserved,
+                "running_jobs": self.running,
+                "waiting_jobs": self.waiting,
+                "available_bytes": available_memory(),
+            }
+
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+_profiling = threading.Lock()   # one traced job at a time: tracemalloc peaks are process-wide
+_profiles: "deque[Dict[str, Any]]" = deque(maxlen=20)
+
+
+def budget() -> MemoryBudget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            if settings.job_memory_budget_mb:
+                capacity = settings.job_memory_budget_mb * MB
+            else:
+                limit = memory_limit()
+                capacity = limit // 2 if limit else FALLBACK_BUDGET_BYTES
+            _budget = MemoryBudget(capacity, settings.job_memory_min_free_mb * MB)
+        return _budget
+
+
+class JobMemory:
+    """A job's reservation, plus per-stage tracemalloc peaks when the job is sampled"""
+
+    def __init__(self, label: str, nbytes: int, profiled: bool):
+        self.label = label
+        self.estimate = nbytes
+        self.reserved = nbytes
+        self.profiled = profiled
+        self.stages: Dict[str, int] = {}
+
+    def shrink(self, nbytes: int) -> None:
+        """Lower the reservation to nbytes once the larger stages are done"""
+        if nbytes < self.reserved:
+            budget().give_back(self.reserved - nbytes)
+            self.reserved = nbytes
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.profiled:
+            yield
+            return
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1] - start
+            self.stages[name] = max(self.stages.get(name, 0), peak)
+
+
+@contextmanager
+def job(label: str, nbytes: Optional[int] = None) -> Iterator[JobMemory]:
+    """Reserve memory for one pipeline job (waits for headroom); nbytes defaults to JOB_MEMORY_DEFAULT_MB"""
+    nbytes = nbytes or estimate_job_bytes()
+    waited = budget().acquire(nbytes)
+    if waited >= 0.01:
+        metrics.max_gauge("job_memory_max_wait_ms", round(waited * 1000))
+    metrics.max_gauge("job_memory_max_estimate_bytes", nbytes)
+
+    profiled = bool(settings.memory_profile_sample_rate) and random.random() < settings.memory_profile_sample_rate \
+        and _profiling.acquire(blocking=False)
+    started_tracing = profiled and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    memory = JobMemory(label, nbytes, profiled)
+    try:
+        yield memory
+    finally:
+        budget().give_back(memory.reserved, finished=True)
+        if profiled:
+            if started_tracing:
+                tracemalloc.stop()
+            _profiling.release()
+            _record_profile(memory)
+
+
+def _record_profile(memory: JobMemory) -> None:
+    peak = max(memory.stages.values(), default=0)
+    profile = {"job": memory.label, "estimate_bytes": memory.estimate, "peak_bytes": peak, "stages": dict(memory.stages)}
+    _profiles.append(profile)
+    metrics.inc("job_memory_profiled")
+    metrics.max_gauge("job_memory_profiled_peak_bytes", peak)
+    for stage, stage_peak in memory.stages.items():
+        metrics.max_gauge(f"job_memory_{stage}_peak_bytes", stage_peak)
+    print(f"Memory profile {memory.label}: peak {peak / MB:.1f} MB (estimate {memory.estimate / MB:.1f} MB), "
+          + ", ".join(f"{stage} {stage_peak / MB:.1f}" for stage, stage_peak in memory.stages.items()))
+
+
+def memory_metrics() -> Dict[str, Any]:
+    status = budget().status()
+    status["recent_profiles"] = list(_profiles)
+    return status
+
+
+metrics.register_collector("memory", memory_metrics)
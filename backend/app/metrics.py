@@ -0,0 +1,53 @@
+"""
+In-process metrics registry
+Counters, gauges and pluggable collectors served by the /metrics endpoint
+"""
+import threading
+from typing import Callable, Dict, Any
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def inc(name: str, value: float = 1) -> None:
+    """Increment a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def max_gauge(name: str, value: float) -> None:
+    """Raise a gauge to value if it is higher than the stored one (high-water marks)"""
+    with _lock:
+        if value > _gauges.get(name, float("-inf")):
+            _gauges[name] = value
+
+
+def register_collector(name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+    """Register a callable whose dict is included in every snapshot under name"""
+    with _lock:
+        _collectors[name] = collector
+
+
+def snapshot() -> Dict[str, Any]:
+    """Return a point-in-time copy of all metrics"""
+    with _lock:
+        data: Dict[str, Any] = {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+        }
+        collectors = dict(_collectors)
+
+    for name, collector in collectors.items():
+        try:
+            data[name] = collector()
+        except Exception as e:
+            data[name] = {"error": str(e)}
+    return data
@@ -1,12 +1,17 @@
 """
 Database migration script to add new columns to existing events table
 """
-from sqlalchemy import text
-from .db import engine
+from sqlalchemy import inspect, text
+from .db import ddl_engine, is_postgres
+from .settings import settings
 
 def migrate_database():
     """Add new columns to events table if they don't exist"""
-    with engine.connect() as conn:
+    if not is_postgres(settings.database_url):
+        return  # other databases are only created fresh by create_all
+    with ddl_engine.connect() as conn:
+        if not inspect(conn).has_table("events"):
+            return  # new database: create_all builds the current schema
         # Check if processing_status column exists
         result = conn.execute(text("""
             SELECT column_name 
@@ -115,6 +120,59 @@ def migrate_database():
             """))
             conn.commit()
         
+        # Check if preview_key column exists
+        result = conn.execute(text("""
+            SELECT column_name 
+            FROM information_schema.columns 
+            WHERE table_name = 'events' AND column_name = 'preview_key'
+        """))
+        
+        if not result.fetchone():
+            print("Adding preview_key column...")
+            conn.execute(text("""
+                ALTER TABLE events 
+                ADD COLUMN preview_key TEXT
+            """))
+            conn.commit()
+        
+        # Check if geospatial columns exist
+        result = conn.execute(text("""
+            SELECT column_name 
+            FROM information_schema.columns 
+            WHERE table_name = 'events' AND column_name = 'geohash'
+        """))
+        
+        if not result.fetchone():
+            print("Adding latitude, longitude and geohash columns...")
+            conn.execute(text("""
+                ALTER TABLE events 
+                ADD COLUMN latitude DOUBLE PRECISION,
+                ADD COLUMN longitude DOUBLE PRECISION,
+                ADD COLUMN geohash VARCHAR(12)
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_events_session_geohash ON events(session_id, geohash, latitude, longitude)
+            """))
+            conn.commit()
+        
+        # Check if updated_at column exists
+        result = conn.execute(text("""
+            SELECT column_name 
+            FROM information_schema.columns 
+            WHERE table_name = 'events' AND column_name = 'updated_at'
+        """))
+        
+        if not result.fetchone():
+            print("Adding updated_at column...")
+            conn.execute(text("""
+                ALTER TABLE events 
+                ADD COLUMN updated_at TIMESTAMPTZ DEFAULT now()
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_events_session_updated ON events(session_id, updated_at)
+            """))
+            conn.commit()
+        
         print("Database migration completed!")
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Date, Text, JSON, Float, Index
 from sqlalchemy.sql import func
 from .db import Base
 
@@ -15,5 +15,124 @@ class Event(Base):
     ai_results = Column(JSON, nullable=True)            # faces, labels, ocr_text, location, event_type
     heic_metadata = Column(JSON, nullable=True)         # original HEIC metadata (EXIF, device info, etc)
     original_filename = Column(String(255), nullable=True)  # original filename with extension
+    preview_key = Column(Text, nullable=True)           # S3 key of a small preview JPEG
     photo_taken_at = Column(DateTime(timezone=True), nullable=True)  # when photo was actually taken (from EXIF)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())  # timeline cache watermark
+    latitude = Column(Float, nullable=True)             # photo GPS position
+    longitude = Column(Float, nullable=True)
+    geohash = Column(String(12), nullable=True)         # geohash of latitude/longitude for range lookups
+    __table_args__ = (
+        # Geohash prefix ranges per session; lat/lon included for index-only bbox checks
+        Index("idx_events_session_geohash", "session_id", "geohash", "latitude", "longitude"),
+        # Index-only count/max(updated_at) per session for the timeline cache watermark
+        Index("idx_events_session_updated", "session_id", "updated_at"),
+    )
+
+class SessionCorpus(Base):
+    """Number of text documents ingested per session (TF-IDF corpus size)"""
+    __tablename__ = "session_corpus"
+    session_id = Column(String(36), primary_key=True)
+    doc_count = Column(Integer, nullable=False, default=0)
+
+class SessionTerm(Base):
+    """Per-session document frequency of each term, maintained incrementally"""
+    __tablename__ = "session_terms"
+    session_id = Column(String(36), primary_key=True)
+    term = Column(String(64), primary_key=True)
+    doc_freq = Column(Integer, nullable=False, default=0)
+
+class TimelineRollup(Base):
+    """Per-session aggregates for one day/week/month, maintained as events complete or are purged"""
+    __tablename__ = "timeline_rollups"
+    session_id = Column(String(36), primary_key=True)
+    period = Column(String(8), primary_key=True)        # "day" | "week" | "month"
+    period_start = Column(Date, primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+    event_types = Column(JSON, nullable=False, default=dict)   # {event_type: count}
+    label_counts = Column(JSON, nullable=False, default=dict)  # {label: count}
+    city_counts = Column(JSON, nullable=False, default=dict)   # {city: count}
+    first_photo_at = Column(DateTime(timezone=True), nullable=True)
+    last_photo_at = Column(DateTime(timezone=True), nullable=True)
+
+class MomentCluster(Base):
+    """A group of moments: an outing ("day"), a trip away from home, or a recurring place"""
+    __tablename__ = "moment_clusters"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String(36), nullable=False)
+    level = Column(String(8), nullable=False)           # "day" | "trip" | "place"
+    start_at = Column(DateTime(timezone=True), nullable=True)
+    end_at = Column(DateTime(timezone=True), nullable=True)
+    event_count = Column(Integer, nullable=False, default=0)
+    lat_sum = Column(Float, nullable=False, default=0)  # centroid = lat_sum / geo_count
+    lon_sum = Column(Float, nullable=False, default=0)
+    geo_count = Column(Integer, nullable=False, default=0)
+    cell_lat = Column(Integer, nullable=True)           # grid cell of a "place" cluster
+    cell_lon = Column(Integer, nullable=True)
+    city_counts = Column(JSON, nullable=False, default=dict)
+    __table_args__ = (
+        Index("idx_moment_clusters_session", "session_id", "level", "start_at"),
+        Index("idx_moment_clusters_cell", "session_id", "level", "cell_lat", "cell_lon"),
+    )
+
+class ClusterMember(Base):
+    """Cluster membership of an event per level, with the fields clustering decides on"""
+    __tablename__ = "cluster_members"
+    event_id = Column(Integer, primary_key=True)
+    level = Column(String(8), primary_key=True)
+    cluster_id = Column(Integer, nullable=False, index=True)
+    session_id = Column(String(36), nullable=False)
+    taken_at = Column(DateTime(timezone=True), nullable=False)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    city = Column(String(128), nullable=True)
+    __table_args__ = (
+        Index("idx_cluster_members_time", "session_id", "level", "taken_at"),
+    )
+
+class ImportedFile(Base):
+    """Content hash of every file brought in by the bulk importer, so re-runs skip duplicates"""
+    __tablename__ = "imported_files"
+    session_id = Column(String(36), primary_key=True)
+    content_hash = Column(String(64), primary_key=True)  # sha256 of the original file
+    event_id = Column(Integer, nullable=False, index=True)
+    source_name = Column(Text, nullable=True)            # path inside the import source
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class PhotoSignature(Base):
+    """Capture time and perceptual hash of an image event, for burst detection (see bursts.py)"""
+    __tablename__ = "photo_signatures"
+    event_id = Column(Integer, primary_key=True)
+    session_id = Column(String(36), nullable=False)
+    taken_at = Column(DateTime(timezone=True), nullable=False)
+    phash = Column(BigInteger, nullable=False)          # 64-bit difference hash, stored signed
+    sharpness = Column(Float, nullable=False)           # variance of the Laplacian; the sharpest shot represents a burst
+    burst_of = Column(Integer, nullable=True, index=True)  # representative analyzed for this event (itself when it is one)
+    __table_args__ = (
+        Index("idx_photo_signatures_time", "session_id", "taken_at"),
+    )
+
+class AppState(Base):
+    """Small key/value store for deployment bookkeeping (e.g. the applied startup fingerprint)"""
+    __tablename__ = "app_state"
+    key = Column(String(64), primary_key=True)
+    value = Column(Text, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class AnalysisJob(Base):
+    """Bulk analysis queued by the import and reprocess CLIs for the API workers' scheduler (see analysis_queue.py)"""
+    __tablename__ = "analysis_jobs"
+    id = Column(Integer, primary_key=True)
+    priority = Column(String(16), nullable=False)       # scheduler class: "import" | "reprocess"
+    session_id = Column(String(36), nullable=False)
+    task = Column(String(16), nullable=False)           # "analyze" | "reprocess"
+    event_id = Column(Integer, nullable=False)
+    params = Column(JSON, nullable=False, default=dict)
+    status = Column(String(16), nullable=False, default="queued")  # "queued" | "running" | "completed" | "failed"
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        Index("idx_analysis_jobs_status", "status", "id"),
+        Index("idx_analysis_jobs_event", "event_id", "task"),
+    )
@@ -0,0 +1,223 @@
+"""
+Declarative Postgres partitioning for the events table
+Two schemes are supported:
+- "session_hash": HASH (session_id) - per-session reads and writes touch one partition
+- "month": RANGE (created_at) by calendar month - retention purges drop whole partitions
+Only "session_hash" speeds up the request path. Timeline reads, the
+pipeline's status updates and ORM updates by id do not know created_at,
+so under "month" they probe every partition's index; choose it for cheap
+retention, not for latency.
+"""
+from datetime import datetime, timezone
+from typing import Any, List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from .settings import settings
+from .db import ddl_engine, is_postgres
+from . import models
+
+SCHEMES = {
+    "session_hash": ("HASH (session_id)", "session_id"),
+    "month": ("RANGE (created_at)", "created_at"),
+}
+
+LEGACY_TABLE = "events_unpartitioned"
+MOVE_CHUNK_SIZE = 5000
+# Serializes the migration when several workers start at once
+ADVISORY_LOCK_ID = 720_301
+
+
+def configured_scheme() -> Optional[str]:
+    scheme = (settings.events_partitioning or "").strip().lower() or None
+    if scheme and scheme not in SCHEMES:
+        print(f"Warning: Unknown EVENTS_PARTITIONING '{scheme}'. Available: {', '.join(SCHEMES)}")
+        return None
+    return scheme
+
+
+def active_scheme(conn: Connection) -> Optional[str]:
+    """Scheme the events table is actually partitioned by, if any"""
+    keydef = conn.execute(text("""
+        SELECT pg_get_partkeydef(c.oid)
+        FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = 'events'
+    """)).scalar()
+    if not keydef:
+        return None
+    for scheme, (partition_by, _) in SCHEMES.items():
+        if keydef.lower() == partition_by.lower():
+            return scheme
+    return keydef
+
+
+def month_partition_name(year: int, month: int) -> str:
+    return f"events_y{year:04d}m{month:02d}"
+
+
+def _add_months(year: int, month: int, months: int):
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def ensure_month_partitions(conn: Connection, start: Optional[datetime] = None, months_ahead: Optional[int] = None) -> None:
+    """Create monthly partitions from start through months_ahead past the current month"""
+    now = datetime.now(timezone.utc)
+    start = start or now
+    months_ahead = settings.events_partition_months_ahead if months_ahead is None else months_ahead
+    year, month = start.year, start.month
+    end_year, end_month = _add_months(now.year, now.month, months_ahead)
+    while (year, month) <= (end_year, end_month):
+        next_year, next_month = _add_months(year, month, 1)
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {month_partition_name(year, month)} PARTITION OF events
+            FOR VALUES FROM ('{year:04d}-{month:02d}-01 00:00:00+00') TO ('{next_year:04d}-{next_month:02d}-01 00:00:00+00')
+        """))
+        year, month = next_year, next_month
+
+
+def _create_partitions(conn: Connection, scheme: str, oldest: Optional[datetime]) -> None:
+    if scheme == "session_hash":
+        modulus = settings.events_hash_partitions
+        for remainder in range(modulus):
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS events_h{remainder:02d} PARTITION OF events
+                FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})
+            """))
+    else:
+        ensure_month_partitions(conn, start=oldest)
+        # Catches rows outside the pre-created months instead of failing the insert
+        conn.execute(text("CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT"))
+
+
+def partition_events_table(scheme: str) -> None:
+    """
+    Convert events into a partitioned table: rename the heap table, create the
+    partitioned parent with the same columns, then move rows over in chunks.
+    New inserts land in the partitioned table while old rows are being moved.
+    """
+    _, key_column = SCHEMES[scheme]
+    with ddl_engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            current = active_scheme(conn)
+            if current:
+                if current != scheme:
+                    print(f"Warning: events is partitioned by {current}, not {scheme}; leaving it unchanged")
+                elif scheme == "month":
+                    ensure_month_partitions(conn)
+                    conn.commit()
+                return
+
+            legacy_exists = conn.execute(text("SELECT to_regclass(:name)"), {"name": LEGACY_TABLE}).scalar()
+            if not legacy_exists:
+                print(f"Partitioning events table by {SCHEMES[scheme][0]}...")
+                sequence = conn.execute(text("SELECT pg_get_serial_sequence('events', 'id')")).scalar()
+                conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+                conn.execute(text(f"ALTER TABLE events RENAME TO {LEGACY_TABLE}"))
+                conn.execute(text(f"""
+                    CREATE TABLE events (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS)
+                    PARTITION BY {SCHEMES[scheme][0]}
+                """))
+                conn.execute(text("UPDATE {0} SET created_at = now() WHERE created_at IS NULL".format(LEGACY_TABLE)))
+                conn.execute(text("ALTER TABLE events ALTER COLUMN created_at SET NOT NULL"))
+                # The partition key must be part of the primary key
+                conn.execute(text(f"ALTER TABLE events ADD PRIMARY KEY (id, {key_column})"))
+                conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY events.id"))
+                oldest = conn.execute(text(f"SELECT min(created_at) FROM {LEGACY_TABLE}")).scalar()
+                _create_partitions(conn, scheme, oldest)
+                create_partitioned_indexes(conn)
+                conn.commit()
+
+            move_legacy_rows(conn)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+            conn.commit()
+
+
+def create_partitioned_indexes(conn: Connection) -> None:
+    """Indexes on the parent cascade to every partition"""
+    # Serves list_events: WHERE session_id = ? ORDER BY id DESC LIMIT 50
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_events_part_session_recent ON events (session_id, id DESC)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_events_part_id ON events (id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_events_part_created_at ON events (created_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_events_part_geohash ON events (session_id, geohash, latitude, longitude)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_events_part_session_updated ON events (session_id, updated_at)"))
+
+
+def move_legacy_rows(conn: Connection) -> None:
+    """Move rows from the renamed heap table in id chunks, then drop it"""
+    columns = ", ".join(
+        row[0] for row in conn.execute(text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = :name ORDER BY ordinal_position
+        """), {"name": LEGACY_TABLE})
+    )
+    moved = 0
+    while True:
+        # Moving (insert + delete) per chunk makes the copy resumable after a crash
+        count = conn.execute(text(f"""
+            WITH chunk AS (
+                DELETE FROM {LEGACY_TABLE}
+                WHERE id IN (SELECT id FROM {LEGACY_TABLE} ORDER BY id LIMIT :limit)
+                RETURNING {columns}
+            )
+            INSERT INTO events ({columns}) SELECT {columns} FROM chunk
+        """), {"limit": MOVE_CHUNK_SIZE}).rowcount
+        conn.commit()
+        if not count:
+            break
+        moved += count
+        print(f"Moved {moved} events into partitions...")
+
+    conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+    conn.commit()
+    print(f"Events table partitioning completed ({moved} rows moved)")
+
+
+def expired_month_partitions(conn: Connection, cutoff: datetime) -> List[str]:
+    """Monthly partitions whose whole range lies before cutoff"""
+    if active_scheme(conn) != "month":
+        return []
+    names = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'events' AND c.relname LIKE 'events_y%'
+    """)).scalars().all()
+    expired = []
+    for name in names:
+        year, month = int(name[8:12]), int(name[13:15])
+        next_year, next_month = _add_months(year, month, 1)
+        if datetime(next_year, next_month, 1, tzinfo=timezone.utc) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def detach_partition(conn: Connection, name: str) -> None:
+    conn.execute(text(f"ALTER TABLE events DETACH PARTITION {name}"))
+
+
+def detached_month_tables(conn: Connection) -> List[str]:
+    """Monthly tables a retention purge detached but did not finish emptying (it was interrupted)"""
+    return sorted(conn.execute(text("""
+        SELECT relname FROM pg_class
+        WHERE relname ~ '^events_y[0-9]{4}m[0-9]{2}$' AND relkind = 'r' AND NOT relispartition
+    """)).scalars().all())
+
+
+def event_filter(event_id: int, session_id: Optional[str] = None) -> List[Any]:
+    """
+    Criteria for looking up one event. Including session_id lets Postgres
+    prune to a single partition under "session_hash"; "month" cannot prune
+    these lookups (see the module docstring).
+    """
+    criteria = [models.Event.id == event_id]
+    if session_id is not None:
+        criteria.append(models.Event.session_id == session_id)
+    return criteria
+
+
+def migrate_partitioning() -> None:
+    scheme = configured_scheme()
+    if scheme and is_postgres(settings.database_url):
+        partition_events_table(scheme)
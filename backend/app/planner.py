@@ -0,0 +1,116 @@
+"""
+Adaptive stage planner
+Decides per image which analysis steps are worth running from cheap early
+signals, instead of paying for every call on every photo:
+- labels run first; OCR only runs when a text-like label is present
+  (PLANNER_OCR_LABELS) and face detection only when a person-like label is
+  (PLANNER_FACE_LABELS)
+- EXIF is read from the first PLANNER_EXIF_PROBE_BYTES of the object, and
+  reverse geocoding only runs when it (or the HEIC metadata) has GPS
+Without a usable label signal every step runs, as before: when labels
+failed, or came from a provider whose classes cannot rule out people or
+text. Only Rekognition's do; the local ImageNet-style classifier has no
+person or text classes, so a missing label says nothing there. Each decision is recorded in
+ai_results["plan"]; summarize() and the CLI total the skipped work.
+
+    python -m app.planner --session-id <id>
+"""
+import argparse
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select
+from .settings import settings
+from .db import SessionLocal
+from . import models
+
+# Approximate list price per image of the cloud call behind each step (USD)
+STEP_COSTS = {
+    ("faces", "aws"): 0.001,    # Rekognition DetectFaces
+    ("ocr", "aws"): 0.0015,     # Textract DetectDocumentText
+    ("geocode", "locationiq"): 0.0,
+}
+
+
+# Label providers whose vocabulary covers PLANNER_FACE_LABELS and PLANNER_OCR_LABELS
+GATING_LABEL_PROVIDERS = ("aws",)
+
+
+def _names(setting: str) -> List[str]:
+    return [name.strip().lower() for name in setting.split(",") if name.strip()]
+
+
+def matching_label(labels: List[Dict[str, Any]], names: List[str]) -> Optional[Dict[str, Any]]:
+    for label in labels:
+        if (label.get("name") or "").lower() in names and (label.get("confidence") or 0) >= settings.planner_label_min_confidence:
+            return label
+    return None
+
+
+def decision(run: bool, reason: str, provider: Optional[str] = None) -> Dict[str, Any]:
+    step = {"run": run, "reason": reason}
+    if provider:
+        step["provider"] = provider
+    return step
+
+
+def plan_vision(labels: List[Dict[str, Any]], label_provider: str) -> Dict[str, Dict[str, Any]]:
+    """Whether to run face detection and OCR given the image's labels and who produced them"""
+    if not settings.planner_enabled:
+        return {"faces": decision(True, "planner disabled"), "ocr": decision(True, "planner disabled")}
+    if label_provider not in GATING_LABEL_PROVIDERS:
+        reason = "no label signal" if label_provider in ("mock", "none") else f"{label_provider} labels cannot rule it out"
+        return {"faces": decision(True, reason), "ocr": decision(True, reason)}
+    plan = {}
+    for step, setting in (("faces", settings.planner_face_labels), ("ocr", settings.planner_ocr_labels)):
+        label = matching_label(labels, _names(setting))
+        if label:
+            plan[step] = decision(True, f"label {label['name']} ({label.get('confidence', 0):.0f})")
+        else:
+            plan[step] = decision(False, "no matching label")
+    return plan
+
+
+def summarize(session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Counts of run/skipped steps, estimated cost saved and average time of steps that ran"""
+    query = select(models.Event.ai_results).where(models.Event.kind == "image")
+    if session_id:
+        query = query.where(models.Event.session_id == session_id)
+
+    steps: Dict[str, Dict[str, Any]] = {}
+    images = 0
+    with SessionLocal() as db:
+        for ai_results in db.scalars(query.execution_options(yield_per=500)):
+            plan = (ai_results or {}).get("plan")
+            if not plan:
+                continue
+            images += 1
+            for step, taken in plan.items():
+                if "run" not in taken:
+                    continue
+                totals = steps.setdefault(step, {"run": 0, "skipped": 0, "usd_saved": 0.0, "ms": 0})
+                if taken["run"]:
+                    totals["run"] += 1
+                    totals["ms"] += taken.get("ms", 0)
+                else:
+                    totals["skipped"] += 1
+                    totals["usd_saved"] += STEP_COSTS.get((step, taken.get("provider")), 0.0)
+
+    for totals in steps.values():
+        ms = totals.pop("ms")
+        totals["avg_ms"] = round(ms / totals["run"]) if totals["run"] else None
+        # Skipped steps would have taken about as long as the ones that ran
+        totals["ms_saved"] = totals["skipped"] * (totals["avg_ms"] or 0)
+        totals["usd_saved"] = round(totals["usd_saved"], 4)
+    return {"images": images, "steps": steps}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize stage planner decisions")
+    parser.add_argument("--session-id")
+    args = parser.parse_args()
+
+    summary = summarize(args.session_id)
+    print(f"{summary['images']} planned images")
+    print(f"{'step':<10}{'run':>8}{'skipped':>9}{'avg ms':>9}{'ms saved':>11}{'USD saved':>11}")
+    for step, totals in summary["steps"].items():
+        print(f"{step:<10}{totals['run']:>8}{totals['skipped']:>9}{totals['avg_ms'] or 0:>9}"
+              f"{totals['ms_saved']:>11}{totals['usd_saved']:>11.4f}")
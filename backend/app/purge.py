@@ -0,0 +1,205 @@
+"""
+Session- and age-scoped purge of events and their S3 objects
+Rows are deleted in bounded chunks (one short transaction each) so a purge
+never holds locks on the whole events table, and the matching S3 objects
+are removed with batched delete_objects calls after each chunk commits.
+Expired monthly partitions are detached first and then emptied the same
+way, chunk by chunk, before the empty table is dropped.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select, delete, func, table, column, text
+from .settings import settings
+from .db import SessionLocal, ddl_engine, is_postgres
+from .s3 import delete_objects, original_key
+from .partitioning import configured_scheme, expired_month_partitions, detach_partition, detached_month_tables
+from . import models, timeline_cache, rollups, clustering, bursts
+
+
+# Everything needed to remove an event's S3 objects, rollup and cluster contribution
+PURGE_COLUMNS = (
+    models.Event.id, models.Event.session_id, models.Event.kind, models.Event.source, models.Event.preview_key,
+    models.Event.processing_status, models.Event.labels, models.Event.ai_results,
+    models.Event.photo_taken_at, models.Event.created_at,
+)
+
+
+def purge_criteria(session_id: Optional[str] = None, cutoff: Optional[datetime] = None) -> List[Any]:
+    criteria = []
+    if session_id:
+        criteria.append(models.Event.session_id == session_id)
+    if cutoff is not None:
+        criteria.append(models.Event.created_at < cutoff)
+    return criteria
+
+
+def event_object_keys(row) -> List[str]:
+    """S3 objects owned by an event"""
+    if row.kind != "image":
+        return []
+    keys = [key for key in (row.source, row.preview_key) if key]
+    if row.source and row.processing_status != "completed":
+        keys.append(original_key(row.source))  # a HEIC upload whose conversion never finished
+    return keys
+
+
+def purge_events(
+    session_id: Optional[str] = None,
+    older_than_days: Optional[int] = None,
+    dry_run: bool = False,
+    chunk_size: Optional[int] = None,
+    job=None,
+) -> Dict[str, Any]:
+    """
+    Delete matching events chunk by chunk and remove their S3 objects.
+    With dry_run, only counts what would be deleted.
+    """
+    chunk_size = chunk_size or settings.purge_chunk_size
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days) if older_than_days is not None else None
+    criteria = purge_criteria(session_id, cutoff)
+    progress = {
+        "dry_run": dry_run,
+        "matched_events": 0,
+        "matched_objects": 0,
+        "deleted_events": 0,
+        "deleted_objects": 0,
+        "failed_objects": 0,
+    }
+    print(f"Purge started: session_id={session_id}, older_than_days={older_than_days}, dry_run={dry_run}")
+
+    # Age-only purges on month-partitioned tables drop whole expired partitions first
+    if cutoff is not None and not session_id and configured_scheme() == "month" and is_postgres(settings.database_url):
+        drop_expired_partitions(cutoff, dry_run, progress, job, chunk_size)
+
+    last_id = 0
+    while not (job and job.cancelled):
+        with SessionLocal() as db:
+            # Keyset pagination on the primary key keeps each chunk an index range scan
+            rows = db.execute(
+                select(*PURGE_COLUMNS)
+                .where(models.Event.id > last_id, *criteria)
+                .order_by(models.Event.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            keys = [key for row in rows for key in event_object_keys(row)]
+            progress["matched_events"] += len(rows)
+            progress["matched_objects"] += len(keys)
+
+            followers = []
+            if not dry_run:
+                followers = bursts.release_purged(db, [row.id for row in rows], {row.session_id for row in rows})
+                db.execute(delete(models.Event).where(models.Event.id.in_([row.id for row in rows])))
+                # A purged photo can be imported again
+                db.execute(delete(models.ImportedFile).where(models.ImportedFile.event_id.in_([row.id for row in rows])))
+                db.execute(delete(models.PhotoSignature).where(models.PhotoSignature.event_id.in_([row.id for row in rows])))
+                rollups.remove_events(db, rows)
+                clustering.remove_events(db, [row.id for row in rows])
+                db.commit()
+
+        if not dry_run:
+            bursts.analyze_again(followers)
+            for purged_session in {row.session_id for row in rows}:
+                timeline_cache.invalidate(purged_session)
+            deleted, failed = delete_objects(keys)
+            progress["deleted_events"] += len(rows)
+            progress["deleted_objects"] += deleted
+            progress["failed_objects"] += failed
+
+        if job:
+            job.update(**progress)
+
+    # A fully purged session (or table) starts a fresh TF-IDF corpus
+    if cutoff is None and not dry_run and not (job and job.cancelled):
+        with SessionLocal() as db:
+            for table in (models.SessionTerm, models.SessionCorpus):
+                stmt = delete(table)
+                if session_id:
+                    stmt = stmt.where(table.session_id == session_id)
+                db.execute(stmt)
+            db.commit()
+
+    print(f"Purge finished: {progress}")
+    return progress
+
+
+def drop_expired_partitions(cutoff: datetime, dry_run: bool, progress: Dict[str, Any], job=None,
+                            chunk_size: Optional[int] = None) -> None:
+    """
+    Remove monthly partitions entirely older than cutoff, plus their S3
+    objects. A partition is detached, then emptied in chunks like any other
+    purge (derived data and S3 objects per chunk), then dropped; tables left
+    detached by an interrupted run are finished first.
+    """
+    chunk_size = chunk_size or settings.purge_chunk_size
+    with ddl_engine.connect() as conn:
+        leftovers = [] if dry_run else detached_month_tables(conn)
+        expired = expired_month_partitions(conn, cutoff)
+    for name in leftovers + expired:
+        if job and job.cancelled:
+            break
+        partition = table(name, *(column(col.key, col.type) for col in PURGE_COLUMNS))
+        if dry_run:
+            # The chunked pass after this one counts the rows, which are still attached
+            with SessionLocal() as db:
+                events = db.scalar(select(func.count()).select_from(partition))
+            print(f"Purge: would drop partition {name} ({events} events)")
+            continue
+
+        if name in expired:
+            with ddl_engine.connect() as conn:
+                detach_partition(conn, name)
+                conn.commit()
+        print(f"Purge: emptying detached partition {name}")
+        last_id = 0
+        while not (job and job.cancelled):
+            with SessionLocal() as db:
+                rows = db.execute(
+                    select(partition).where(partition.c.id > last_id).order_by(partition.c.id).limit(chunk_size)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                ids = [row.id for row in rows]
+                keys = [key for row in rows for key in event_object_keys(row)]
+                # Rows leave the detached table with their derived data, so a rerun never subtracts twice
+                followers = bursts.release_purged(db, ids, {row.session_id for row in rows})
+                db.execute(delete(partition).where(partition.c.id.in_(ids)))
+                db.execute(delete(models.ImportedFile).where(models.ImportedFile.event_id.in_(ids)))
+                db.execute(delete(models.PhotoSignature).where(models.PhotoSignature.event_id.in_(ids)))
+                rollups.remove_events(db, rows)
+                clustering.remove_events(db, ids)
+                db.commit()
+            bursts.analyze_again(followers)
+            deleted, failed = delete_objects(keys)
+            progress["matched_events"] += len(rows)
+            progress["matched_objects"] += len(keys)
+            progress["deleted_events"] += len(rows)
+            progress["deleted_objects"] += deleted
+            progress["failed_objects"] += failed
+            if job:
+                job.update(**progress)
+        if job and job.cancelled:
+            break  # the detached table is finished by the next purge
+        with ddl_engine.connect() as conn:
+            conn.execute(text(f"DROP TABLE {name}"))
+            conn.commit()
+
+    if not dry_run:
+        timeline_cache.invalidate_all()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Purge events and their S3 images in chunks")
+    parser.add_argument("--session-id")
+    parser.add_argument("--older-than-days", type=int)
+    parser.add_argument("--all", action="store_true", help="Purge every event")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--chunk-size", type=int)
+    args = parser.parse_args()
+    if not (args.session_id or args.older_than_days is not None or args.all):
+        parser.error("Specify --session-id, --older-than-days or --all")
+    purge_events(args.session_id, args.older_than_days, args.dry_run, args.chunk_size)
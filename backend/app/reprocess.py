@@ -0,0 +1,303 @@
+"""
+Bulk reprocessing of existing image events
+Selects events by session, photo date range, processing status and stale
+stage versions, then queues the chosen pipeline stages at reprocessing
+priority under a global rate limit. The API workers run them behind
+interactive uploads (see analysis_queue.py); --drain runs them in this
+process when no API is running. Progress is checkpointed after every chunk
+so an interrupted run resumes where it left off.
+
+    python -m app.reprocess --stages narrative --stale
+    python -m app.reprocess --status failed --workers 4 --rate 2
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from sqlalchemy import select, func
+from .db import SessionLocal
+from .s3 import has_original
+from .image_processor import (
+    STAGES, STAGE_VERSIONS, process_image_async, resolve_photo_date, run_vision_stage,
+    run_location_stage, run_classify_stage, run_narrative_stage, run_questions_stage, save_results,
+    merge_stage_results,
+)
+from . import models, memory_budget, scheduler, analysis_queue, bursts
+
+DEFAULT_CHECKPOINT = "reprocess.checkpoint.json"
+
+
+class RateLimiter:
+    """Token bucket shared by all workers: at most `rate` acquisitions per second"""
+
+    def __init__(self, rate: Optional[float], burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def selection_criteria(filters: Dict[str, Any]) -> List[Any]:
+    taken = func.coalesce(models.Event.photo_taken_at, models.Event.created_at)
+    criteria = [models.Event.kind == "image"]
+    if filters.get("session_id"):
+        criteria.append(models.Event.session_id == filters["session_id"])
+    if filters.get("since"):
+        criteria.append(taken >= datetime.fromisoformat(filters["since"]))
+    if filters.get("until"):
+        criteria.append(taken < datetime.fromisoformat(filters["until"]))
+    if filters.get("status"):
+        criteria.append(models.Event.processing_status == filters["status"])
+    return criteria
+
+
+def is_stale(ai_results: Optional[Dict[str, Any]], stages: Sequence[str]) -> bool:
+    """True if any of the stages ran with an older version than the current one, or vision degraded"""
+    if "vision" in stages and (ai_results or {}).get("vision_degraded"):
+        return True
+    recorded = (ai_results or {}).get("stage_versions") or {}
+    return any(recorded.get(stage, 0) < STAGE_VERSIONS[stage] for stage in stages)
+
+
+def candidate_chunks(
+    filters: Dict[str, Any], stages: Sequence[str], after_id: int, chunk_size: int
+) -> Iterator[Tuple[List[Tuple[int, str]], int, int]]:
+    """((event id, session id) pairs to reprocess, last scanned id, rows scanned) per chunk, in id order"""
+    criteria = selection_criteria(filters)
+    last_id = after_id
+    while True:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(models.Event.id, models.Event.session_id, models.Event.ai_results)
+                .where(models.Event.id > last_id, *criteria)
+                .order_by(models.Event.id)
+                .limit(chunk_size)
+            ).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        ids = [(row.id, row.session_id) for row in rows if not filters.get("stale") or is_stale(row.ai_results, stages)]
+        # A chunk with nothing stale still advances the checkpoint
+        yield ids, last_id, len(rows)
+
+
+def count_candidates(filters: Dict[str, Any], after_id: int) -> int:
+    """Upper bound of remaining events (stale-version filtering happens per chunk)"""
+    with SessionLocal() as db:
+        return db.scalar(
+            select(func.count()).select_from(models.Event)
+            .where(models.Event.id > after_id, *selection_criteria(filters))
+        ) or 0
+
+
+def reprocess_event(event_id: int, stages: Sequence[str]) -> str:
+    """
+    Re-run the given stages for one event, keeping the other stages'
+    stored results. Events without usable results (failed or never
+    completed) run the whole pipeline. Returns "completed" or "failed".
+    """
+    db = SessionLocal()
+    try:
+        event = db.get(models.Event, event_id)
+        if event is None:
+            return "failed"
+        previous = event.ai_results or {}
+        if event.processing_status != "completed" or not previous or "error" in previous:
+            session_id, source, caption = event.session_id, event.source, event.user_caption or ""
+            # A HEIC upload interrupted before its conversion still has only the original
+            convert = event.heic_metadata is not None and has_original(source)
+            db.close()
+            process_image_async(event_id, source, caption, session_id, convert)
+            with SessionLocal() as check:
+                status = check.scalar(select(models.Event.processing_status).where(models.Event.id == event_id))
+            return "completed" if status == "completed" else "failed"
+
+        caption = event.user_caption or ""
+        results = dict(previous)
+        photo_date = event.photo_taken_at
+        summary = event.summary
+        with memory_budget.job(f"event {event_id}") as memory:
+            if "vision" in stages:
+                with memory.stage("vision"):
+                    merge_stage_results(results, run_vision_stage(event.source))
+            if "location" in stages:
+                with memory.stage("location"):
+                    photo_date = resolve_photo_date(event, event.source) or photo_date
+                    merge_stage_results(results, run_location_stage(event, event.source))
+            if "classify" in stages:
+                with memory.stage("classify"):
+                    results["event_type"] = run_classify_stage(results, caption)
+            if "narrative" in stages:
+                with memory.stage("narrative"):
+                    summary = run_narrative_stage(event.source, caption, photo_date, results)
+            if "questions" in stages:
+                results["clarification_questions"] = run_questions_stage(caption, results)
+        results["stage_versions"] = {
+            **(previous.get("stage_versions") or {}),
+            **{stage: STAGE_VERSIONS[stage] for stage in stages},
+        }
+        save_results(db, event, results, summary, photo_date)
+        # Followers of a burst hold copies of this event's results
+        try:
+            bursts.share_results(db, event, refresh=True)
+        except Exception as share_error:
+            db.rollback()
+            print(f"Sharing results with the burst of event {event.id} failed: {share_error}")
+        return "completed"
+    except Exception as e:
+        db.rollback()
+        print(f"Reprocessing event {event_id} failed: {e}")
+        return "failed"
+    finally:
+        db.close()
+
+
+def load_checkpoint(path: str, run: Dict[str, Any]) -> Dict[str, Any]:
+    """Resume state for the same filters and stages; a different run starts over"""
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("run") == run:
+            print(f"Resuming from checkpoint {path}: after event {checkpoint['last_id']}, "
+                  f"{checkpoint['completed']} completed, {checkpoint['failed']} failed")
+            return checkpoint
+        print(f"Checkpoint {path} is for a different selection; starting over")
+    return {"run": run, "last_id": 0, "completed": 0, "failed": 0, "finished": False}
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    """Write atomically so a crash mid-write never corrupts the checkpoint"""
+    checkpoint["updated_at"] = datetime.now(timezone.utc).isoformat()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+
+def reprocess(
+    filters: Dict[str, Any],
+    stages: Sequence[str],
+    workers: int = 4,
+    rate: Optional[float] = None,
+    chunk_size: Optional[int] = None,
+    checkpoint_path: str = DEFAULT_CHECKPOINT,
+    restart: bool = False,
+    job=None,
+) -> Dict[str, Any]:
+    """
+    Reprocess matching events. Each chunk is queued at once and the
+    checkpoint only advances past it once all of its events finished, so a
+    resumed run repeats at most one chunk.
+    """
+    stages = [stage for stage in STAGES if stage in stages]
+    run = {"filters": filters, "stages": stages}
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, run)
+    if checkpoint["finished"]:
+        print("Checkpoint says this run already finished; use --restart to run it again")
+        return checkpoint
+
+    chunk_size = chunk_size or max(workers * 4, 1)
+    limiter = RateLimiter(rate, burst=workers)
+    remaining = count_candidates(filters, checkpoint["last_id"])
+    print(f"Reprocessing stages {', '.join(stages)} for up to {remaining} events "
+          f"({workers} workers, rate {rate or 'unlimited'}/s)")
+
+    def queue(candidate: Tuple[int, str]) -> int:
+        event_id, session_id = candidate
+        limiter.acquire()
+        return analysis_queue.enqueue(scheduler.REPROCESS, session_id, analysis_queue.REPROCESS, event_id, stages=stages)
+
+    started = time.monotonic()
+    scanned = 0
+    for ids, last_id, chunk_rows in candidate_chunks(filters, stages, checkpoint["last_id"], chunk_size):
+        if job and job.cancelled:
+            break
+        for status in analysis_queue.wait([queue(candidate) for candidate in ids]).values():
+            checkpoint["completed" if status == "completed" else "failed"] += 1
+        checkpoint["last_id"] = last_id
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        scanned += chunk_rows
+        elapsed = time.monotonic() - started
+        done = checkpoint["completed"] + checkpoint["failed"]
+        rows_per_second = scanned / elapsed if elapsed else 0.0
+        eta = format_eta(max(remaining - scanned, 0) / rows_per_second) if rows_per_second else "unknown"
+        print(f"Reprocessed {checkpoint['completed']} ok / {checkpoint['failed']} failed "
+              f"(through event {last_id}, {scanned}/{remaining} scanned), "
+              f"{rows_per_second:.2f} events/s, ETA {eta}")
+        if job:
+            job.update(last_id=last_id, completed=checkpoint["completed"], failed=checkpoint["failed"],
+                       done=done, events_per_second=round(rows_per_second, 2), eta=eta)
+    else:
+        checkpoint["finished"] = True
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    print(f"Reprocessing {'finished' if checkpoint['finished'] else 'stopped'}: "
+          f"{checkpoint['completed']} completed, {checkpoint['failed']} failed")
+    return checkpoint
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run pipeline stages for existing image events")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"Comma-separated subset of: {', '.join(STAGES)} (default: all)")
+    parser.add_argument("--session-id")
+    parser.add_argument("--since", help="Photo date lower bound (ISO date), inclusive")
+    parser.add_argument("--until", help="Photo date upper bound (ISO date), exclusive")
+    parser.add_argument("--status", choices=["pending", "completed", "failed"])
+    parser.add_argument("--stale", action="store_true",
+                        help="Only events whose selected stages ran with an older stage version "
+                             "(or whose vision providers failed)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Sizes chunks (4 events per worker); with --drain, jobs run here at once")
+    parser.add_argument("--rate", type=float, help="Maximum events queued per second")
+    parser.add_argument("--drain", action="store_true",
+                        help="Also run the queued jobs in this process (when no API workers are running)")
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args()
+    if args.drain:
+        # This process only reprocesses: no interactive reserve, and --workers may go to one session
+        scheduler.configure(workers=args.workers, reserved_interactive=0, session_concurrency=args.workers)
+        analysis_queue.start_drainer()
+
+    selected = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(selected) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    reprocess(
+        {"session_id": args.session_id, "since": args.since, "until": args.until,
+         "status": args.status, "stale": args.stale},
+        selected,
+        workers=args.workers,
+        rate=args.rate,
+        chunk_size=args.chunk_size,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart,
+    )
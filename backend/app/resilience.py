@@ -0,0 +1,298 @@
+"""
+Resilience for external provider calls (S3, Rekognition, Textract,
+LocationIQ, OpenAI)
+Every call goes through call(provider, fn, ...), which adds:
+- a circuit breaker per provider: after PROVIDER_BREAKER_FAILURES
+  consecutive failures calls fail immediately with CircuitOpenError for
+  PROVIDER_BREAKER_RESET_SECONDS, then a single half-open probe decides
+  whether to close it again
+- a deadline: the caller stops waiting after the provider's timeout (the
+  clients themselves are configured with matching connect/read timeouts
+  and fewer retries, see boto_config)
+- optional hedging for idempotent reads: if the first attempt has not
+  answered after PROVIDER_HEDGE_AFTER_MS a duplicate is sent and the first
+  answer wins
+Callers degrade on errors as before (empty/partial vision results, default
+event type, template narrative); cached_call additionally serves the last
+good answer for the same key while a provider is down.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, Optional
+from .settings import settings
+from . import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Error codes that mean "back off" even though the HTTP status is 4xx
+THROTTLING_CODES = ("Throttling", "ThrottlingException", "ProvisionedThroughputExceededException",
+                    "LimitExceededException", "SlowDown", "RequestLimitExceeded")
+
+
+class CircuitOpenError(Exception):
+    """The provider's breaker is open; the call was not attempted"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """The provider did not answer within its deadline"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead (in half-open state, only one probe at a time)"""
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_neutral(self) -> None:
+        """
+        The call ended in an error that says nothing about the provider's
+        health (see counts_as_failure): free the half-open probe slot but
+        neither close the breaker nor reset the failure count
+        """
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != OPEN:
+                    self._set_state(OPEN)
+
+    def _set_state(self, state: str) -> None:
+        print(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        metrics.inc(f"provider_{self.name}_breaker_{state}")
+        metrics.set_gauge(f"provider_{self.name}_breaker_state", STATE_CODES[state])
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            status = {"state": self.state, "consecutive_failures": self.failures}
+            if self.state == OPEN:
+                status["retry_in_seconds"] = round(max(self.reset_timeout - (time.monotonic() - self.opened_at), 0), 1)
+            return status
+
+
+class ResultCache:
+    """Bounded LRU of the last good answer per key"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_caches: Dict[str, ResultCache] = {}
+_registry_lock = threading.Lock()
+# Attempts run here so the caller can stop waiting at the deadline
+_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="provider")
+
+
+def breaker(provider: str) -> CircuitBreaker:
+    with _registry_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(
+                provider, settings.provider_breaker_failures, settings.provider_breaker_reset_seconds
+            )
+        return _breakers[provider]
+
+
+def provider_timeout(provider: str) -> float:
+    if provider == "openai":
+        return settings.openai_timeout_seconds
+    if provider == "locationiq":
+        return settings.locationiq_timeout_seconds
+    return settings.aws_timeout_seconds
+
+
+def hedge_delay(provider: str) -> Optional[float]:
+    hedged = {name.strip() for name in settings.provider_hedge_providers.split(",")}
+    if settings.provider_hedge_after_ms and provider in hedged:
+        return settings.provider_hedge_after_ms / 1000
+    return None
+
+
+def boto_config():
+    """botocore timeouts and retries matching the call deadline"""
+    from botocore.config import Config
+    return Config(
+        connect_timeout=min(settings.aws_timeout_seconds, 5),
+        read_timeout=settings.aws_timeout_seconds,
+        retries={"max_attempts": settings.aws_max_attempts, "mode": "standard"},
+    )
+
+
+_transport_errors: Optional[tuple] = None
+
+
+def transport_errors() -> tuple:
+    """Exception types of the clients we use that mean the request never got an answer"""
+    global _transport_errors
+    if _transport_errors is None:
+        errors = [TimeoutError, ConnectionError]  # DeadlineExceeded, socket errors
+        try:
+            from botocore.exceptions import ConnectionError as BotoConnectionError, HTTPClientError
+            errors += [BotoConnectionError, HTTPClientError]
+        except ImportError:
+            pass
+        try:
+            from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+            errors += [RequestsConnectionError, Timeout]
+        except ImportError:
+            pass
+        try:
+            from openai import APIConnectionError
+            errors.append(APIConnectionError)
+        except ImportError:
+            pass
+        _transport_errors = tuple(errors)
+    return _transport_errors
+
+
+def counts_as_failure(error: Exception) -> bool:
+    """
+    Timeouts, connection errors, 5xx and throttling count against the
+    breaker; client errors (bad image, invalid parameters) and bugs on our
+    side (TypeError, ParamValidationError, ...) do not.
+    """
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):  # botocore ClientError
+        if response.get("Error", {}).get("Code") in THROTTLING_CODES:
+            return True
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    elif status is None and response is not None:  # requests HTTPError
+        status = getattr(response, "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    return isinstance(error, transport_errors())
+
+
+def _first_result(provider: str, attempt: Callable[[], Any], deadline: float, hedge_after: Optional[float]) -> Any:
+    started = time.monotonic()
+    primary = _pool.submit(attempt)
+    pending = {primary}
+    hedged = hedge_after is None
+    error: Optional[BaseException] = None
+    while pending:
+        now = time.monotonic()
+        if now >= started + deadline:
+            raise DeadlineExceeded(f"{provider} did not answer within {deadline:g}s")
+        until = started + deadline if hedged else min(started + deadline, started + hedge_after)
+        done, pending = wait(pending, timeout=until - now, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    metrics.inc(f"provider_{provider}_hedge_wins")
+                return future.result()
+            error = error or future.exception()
+        if not hedged and pending and time.monotonic() >= started + hedge_after:
+            hedged = True
+            metrics.inc(f"provider_{provider}_hedges")
+            pending.add(_pool.submit(attempt))
+    raise error
+
+
+def call(provider: str, fn: Callable[..., Any], *args, deadline: Optional[float] = None,
+         hedge: bool = False, **kwargs) -> Any:
+    """
+    Call fn(*args, **kwargs) under the provider's breaker and deadline.
+    hedge=True allows a duplicate request (only for idempotent reads).
+    """
+    provider_breaker = breaker(provider)
+    if not provider_breaker.allow():
+        metrics.inc(f"provider_{provider}_short_circuits")
+        raise CircuitOpenError(f"{provider} circuit is open")
+
+    metrics.inc(f"provider_{provider}_calls")
+    started = time.monotonic()
+    try:
+        result = _first_result(
+            provider,
+            lambda: fn(*args, **kwargs),
+            deadline if deadline is not None else provider_timeout(provider),
+            hedge_delay(provider) if hedge else None,
+        )
+    except Exception as e:
+        if counts_as_failure(e):
+            provider_breaker.record_failure()
+            metrics.inc(f"provider_{provider}_{'timeouts' if isinstance(e, DeadlineExceeded) else 'failures'}")
+        else:
+            provider_breaker.record_neutral()
+        raise
+    provider_breaker.record_success()
+    metrics.max_gauge(f"provider_{provider}_max_latency_ms", round((time.monotonic() - started) * 1000))
+    return result
+
+
+def cached_call(provider: str, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """call() that remembers good answers and serves them when the provider fails"""
+    with _registry_lock:
+        cache = _caches.setdefault(provider, ResultCache(settings.provider_cache_entries))
+    try:
+        result = call(provider, fn, *args, **kwargs)
+    except Exception as e:
+        cached = cache.get(key)
+        if cached is None:
+            raise
+        metrics.inc(f"provider_{provider}_stale_served")
+        print(f"{provider} unavailable ({e}), using cached result")
+        return cached
+    if result is not None:
+        cache.put(key, result)
+    return result
+
+
+def breaker_metrics() -> Dict[str, Any]:
+    with _registry_lock:
+        breakers = dict(_breakers)
+    return {name: provider_breaker.status() for name, provider_breaker in breakers.items()}
+
+
+metrics.register_collector("circuit_breakers", breaker_metrics)
@@ -0,0 +1,197 @@
+"""
+Precomputed timeline rollups per session and day / week / month
+Each completed image event is folded into its three period rows when the
+pipeline finishes, and subtracted again when it is purged, so overview
+screens read O(periods) rows instead of scanning and decoding every event.
+"""
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import Session
+from .db import SessionLocal, dialect_insert
+from . import models
+
+PERIODS = ("day", "week", "month")
+TOP_LABELS = 10
+
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """EXIF times are naive; treat them (and SQLite's naive values) as UTC"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def period_start(period: str, day: date) -> date:
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def period_end(period: str, start: date) -> date:
+    if period == "week":
+        return start + timedelta(days=7)
+    if period == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def event_time(event) -> Optional[datetime]:
+    return as_utc(event.photo_taken_at or event.created_at)
+
+
+def is_rolled_up(event) -> bool:
+    """Only completed image events are counted"""
+    return event.kind == "image" and event.processing_status == "completed"
+
+
+def event_facets(event) -> Tuple[str, List[str], Optional[str]]:
+    """(event_type, labels, city) of an event as stored by the pipeline"""
+    ai_results = event.ai_results or {}
+    labels = [label for label in (event.labels or "").split(",") if label]
+    city = (ai_results.get("location") or {}).get("city")
+    return ai_results.get("event_type") or "personal", labels, city
+
+
+def _bump(counts: Dict[str, int], key: Optional[str], delta: int) -> Dict[str, int]:
+    counts = dict(counts or {})
+    if key:
+        value = counts.get(key, 0) + delta
+        if value > 0:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+    return counts
+
+
+def _locked_rollup(db: Session, session_id: str, period: str, start: date) -> models.TimelineRollup:
+    """Fetch (creating if needed) a rollup row locked for update"""
+    stmt = dialect_insert(db.bind.dialect.name, models.TimelineRollup).values(
+        session_id=session_id, period=period, period_start=start,
+        event_count=0, event_types={}, label_counts={}, city_counts={},
+    ).on_conflict_do_nothing()
+    db.execute(stmt)
+    return db.execute(
+        select(models.TimelineRollup)
+        .where(
+            models.TimelineRollup.session_id == session_id,
+            models.TimelineRollup.period == period,
+            models.TimelineRollup.period_start == start,
+        )
+        .with_for_update()
+    ).scalar_one()
+
+
+def _recompute_bounds(db: Session, rollup: models.TimelineRollup, leaving_id: int) -> None:
+    """
+    Recompute first/last photo time of a period after event leaving_id left
+    it (on reprocessing or failure that event is still completed in the DB)
+    """
+    start = datetime.combine(rollup.period_start, datetime.min.time(), tzinfo=timezone.utc)
+    end = datetime.combine(period_end(rollup.period, rollup.period_start), datetime.min.time(), tzinfo=timezone.utc)
+    taken = func.coalesce(models.Event.photo_taken_at, models.Event.created_at)
+    first, last = db.execute(
+        select(func.min(taken), func.max(taken)).where(
+            models.Event.session_id == rollup.session_id,
+            models.Event.kind == "image",
+            models.Event.processing_status == "completed",
+            models.Event.id != leaving_id,
+            taken >= start,
+            taken < end,
+        )
+    ).one()
+    rollup.first_photo_at, rollup.last_photo_at = first, last
+
+
+def apply_event(db: Session, event, sign: int = 1) -> None:
+    """
+    Add (sign=1) or subtract (sign=-1) one event from its day, week and month
+    rollups. Runs inside the caller's transaction; the caller commits.
+    """
+    taken = event_time(event)
+    if taken is None or not is_rolled_up(event):
+        return
+    event_type, labels, city = event_facets(event)
+
+    for period in PERIODS:
+        rollup = _locked_rollup(db, event.session_id, period, period_start(period, taken.date()))
+        rollup.event_count = max(rollup.event_count + sign, 0)
+        if rollup.event_count == 0:
+            db.delete(rollup)
+            continue
+
+        rollup.event_types = _bump(rollup.event_types, event_type, sign)
+        label_counts = rollup.label_counts
+        for label in labels:
+            label_counts = _bump(label_counts, label, sign)
+        rollup.label_counts = label_counts
+        rollup.city_counts = _bump(rollup.city_counts, city, sign)
+
+        first, last = as_utc(rollup.first_photo_at), as_utc(rollup.last_photo_at)
+        if sign > 0:
+            rollup.first_photo_at = min(first, taken) if first else taken
+            rollup.last_photo_at = max(last, taken) if last else taken
+        elif taken in (first, last):
+            db.flush()
+            _recompute_bounds(db, rollup, event.id)
+
+
+def remove_events(db: Session, events: Iterable[Any]) -> None:
+    """Subtract purged events; call after they were deleted, in the same transaction"""
+    for event in events:
+        apply_event(db, event, sign=-1)
+
+
+def rollup_out(rollup: models.TimelineRollup) -> Dict[str, Any]:
+    top_labels = sorted(rollup.label_counts.items(), key=lambda item: -item[1])[:TOP_LABELS]
+    return {
+        "period": rollup.period,
+        "period_start": rollup.period_start,
+        "event_count": rollup.event_count,
+        "event_types": rollup.event_types,
+        "top_labels": [{"label": label, "count": count} for label, count in top_labels],
+        "cities": rollup.city_counts,
+        "first_photo_at": as_utc(rollup.first_photo_at),
+        "last_photo_at": as_utc(rollup.last_photo_at),
+    }
+
+
+def rebuild_rollups(session_id: Optional[str] = None, chunk_size: int = 1000) -> int:
+    """Recompute rollups from scratch (backfill for events processed before rollups existed)"""
+    with SessionLocal() as db:
+        stmt = delete(models.TimelineRollup)
+        if session_id:
+            stmt = stmt.where(models.TimelineRollup.session_id == session_id)
+        db.execute(stmt)
+        db.commit()
+
+    applied, last_id = 0, 0
+    while True:
+        with SessionLocal() as db:
+            query = select(models.Event).where(
+                models.Event.id > last_id,
+                models.Event.kind == "image",
+                models.Event.processing_status == "completed",
+            )
+            if session_id:
+                query = query.where(models.Event.session_id == session_id)
+            events = db.execute(query.order_by(models.Event.id).limit(chunk_size)).scalars().all()
+            if not events:
+                break
+            for event in events:
+                apply_event(db, event)
+            db.commit()
+            last_id = events[-1].id
+            applied += len(events)
+            print(f"Rebuilt rollups for {applied} events...")
+    return applied
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuild timeline rollups from the events table")
+    parser.add_argument("--session-id")
+    args = parser.parse_args()
+    rebuild_rollups(args.session_id)
@@ -1,64 +1,135 @@
-import boto3
+import posixpath
 import uuid
-from io import BytesIO
-from PIL import Image
+from typing import List, Tuple
 from .settings import settings
+from .resilience import boto_config, call
+from . import spool
 
 def get_s3_client():
     """Get S3 client with current settings"""
+    import boto3
     return boto3.client(
         's3',
         aws_access_key_id=settings.aws_access_key_id,
         aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.aws_region
+        region_name=settings.aws_region,
+        endpoint_url=settings.aws_endpoint_url,
+        config=boto_config()
     )
 
 def convert_to_jpeg(image_bytes: bytes) -> bytes:
-    """Convert image to JPEG format"""
-    image = Image.open(BytesIO(image_bytes))
-    if image.format == 'JPEG':
-        return image_bytes
-    
-    # Convert to RGB if needed (for PNG with transparency, etc.)
-    if image.mode in ('RGBA', 'LA', 'P'):
-        image = image.convert('RGB')
-    
-    output = BytesIO()
-    image.save(output, format='JPEG', quality=90)
-    return output.getvalue()
+    """Convert image to JPEG format (valid JPEGs are passed through untouched)"""
+    from .image_formats import normalize_to_jpeg
+    return normalize_to_jpeg(image_bytes, quality=settings.upload_jpeg_quality)
 
-def upload_image_to_s3(image_bytes: bytes, filename: str) -> str:
-    """Upload image to S3 and return the S3 key"""
-    # Convert to JPEG
-    jpeg_bytes = convert_to_jpeg(image_bytes)
-    
-    # Generate unique S3 key
-    unique_id = str(uuid.uuid4())
-    s3_key = f"images/{unique_id}.jpg"
-    
-    # Upload to S3
-    s3_client = get_s3_client()
+def new_image_key() -> str:
+    """Generate unique S3 key for a stored JPEG"""
+    return f"images/{uuid.uuid4()}.jpg"
+
+def upload_jpeg_to_s3(s3_key: str, jpeg_bytes: bytes, s3_client=None) -> None:
+    """Store a JPEG (or a HEIC original); bulk callers pass one shared (thread-safe) client"""
+    s3_client = s3_client or get_s3_client()
     s3_client.put_object(
         Bucket=settings.aws_bucket_name,
         Key=s3_key,
         Body=jpeg_bytes,
-        ContentType='image/jpeg'
+        ContentType='image/heic' if s3_key.endswith('.heic') else 'image/jpeg'
     )
+
+def original_key(s3_key: str) -> str:
+    """Where a HEIC upload waits for conversion into the JPEG at s3_key (removed once converted)"""
+    return f"originals/{posixpath.splitext(posixpath.basename(s3_key))[0]}.heic"
+
+def store_original(s3_key: str, heic_bytes: bytes) -> None:
+    """Write-ahead store of a HEIC upload until the background job has converted it"""
+    spool.store(original_key(s3_key), heic_bytes)
+
+def has_original(s3_key: str) -> bool:
+    """Whether a HEIC upload still waits for conversion into s3_key (e.g. interrupted by a restart)"""
+    from botocore.exceptions import ClientError
+    key = original_key(s3_key)
+    if spool.read(key, 1) is not None:
+        return True
+    try:
+        call("s3", lambda: get_s3_client().head_object(Bucket=settings.aws_bucket_name, Key=key))
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+def upload_image_to_s3(image_bytes: bytes, filename: str) -> str:
+    """Store image as JPEG through the upload spool and return the S3 key"""
+    # Convert to JPEG
+    jpeg_bytes = convert_to_jpeg(image_bytes)
+    
+    # Spool under a unique key; it reaches S3 in the background
+    s3_key = new_image_key()
+    spool.store(s3_key, jpeg_bytes)
     
     return s3_key
 
-def get_s3_url(s3_key: str) -> str:
-    """Generate presigned S3 URL for displaying image"""
-    s3_client = get_s3_client()
-    
-    try:
-        # Generate presigned URL that expires in 1 hour
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': settings.aws_bucket_name, 'Key': s3_key},
-            ExpiresIn=3600  # 1 hour
+def upload_preview_to_s3(preview_bytes: bytes, s3_client=None) -> str:
+    """
+    Store a preview derivative and return its S3 key. Bulk callers pass
+    their shared client and upload directly; otherwise it is spooled.
+    """
+    s3_key = f"previews/{uuid.uuid4()}.jpg"
+    if s3_client is not None:
+        upload_jpeg_to_s3(s3_key, preview_bytes, s3_client)
+    else:
+        spool.store(s3_key, preview_bytes)
+    return s3_key
+
+def download_from_s3(s3_key: str) -> bytes:
+    """Object bytes (from the upload spool while still in flight), read under the S3 deadline and circuit breaker"""
+    spooled = spool.read(s3_key)
+    if spooled is not None:
+        return spooled
+    def read() -> bytes:
+        response = get_s3_client().get_object(Bucket=settings.aws_bucket_name, Key=s3_key)
+        return response['Body'].read()
+    return call("s3", read, hedge=True)
+
+def download_head_from_s3(s3_key: str, length: int) -> bytes:
+    """The first length bytes of an object (all of it if shorter)"""
+    spooled = spool.read(s3_key, length)
+    if spooled is not None:
+        return spooled
+    def read() -> bytes:
+        response = get_s3_client().get_object(
+            Bucket=settings.aws_bucket_name, Key=s3_key, Range=f"bytes=0-{length - 1}"
         )
-        return presigned_url
-    except Exception as e:
-        # Fallback to direct URL if presigned generation fails
-        return f"https://{settings.aws_bucket_name}.s3.{settings.aws_region}.amazonaws.com/{s3_key}"
\ No newline at end of file
+        return response['Body'].read()
+    return call("s3", read, hedge=True)
+
+# S3 DeleteObjects accepts at most 1,000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+def delete_objects(s3_keys: List[str]) -> Tuple[int, int]:
+    """Delete S3 objects in batches; returns (deleted, failed) counts"""
+    if not s3_keys:
+        return 0, 0
+    # Never upload what was deleted before it left the spool
+    spool.discard(s3_keys)
+    if not settings.aws_bucket_name:
+        return 0, 0
+
+    s3_client = get_s3_client()
+    deleted, failed = 0, 0
+    for start in range(0, len(s3_keys), DELETE_BATCH_SIZE):
+        batch = s3_keys[start:start + DELETE_BATCH_SIZE]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=settings.aws_bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            errors = response.get("Errors", [])
+            for error in errors[:5]:
+                print(f"S3 delete failed for {error.get('Key')}: {error.get('Message')}")
+            failed += len(errors)
+            deleted += len(batch) - len(errors)
+        except Exception as e:
+            print(f"S3 batch delete failed: {e}")
+            failed += len(batch)
+    return deleted, failed
@@ -0,0 +1,229 @@
+"""
+Scheduling of background image analysis
+Pipeline jobs run on ANALYSIS_WORKERS threads instead of a thread per
+upload. Every job has a priority class (interactive upload, bulk import,
+reprocessing) and a session; each (class, session) pair is a flow, and
+flows share the workers by start-time fair queuing: a job's tag is its
+flow's previous tag plus 1 / weight of its class (ANALYSIS_WEIGHTS), and
+the queued job with the smallest tag runs next. One session's 10,000
+queued imports therefore wait behind a single new upload from another
+session instead of in front of it, and no class ever starves.
+
+On top of that a session runs at most ANALYSIS_SESSION_CONCURRENCY jobs at
+once, and ANALYSIS_RESERVED_INTERACTIVE workers only take interactive jobs,
+so an upload starts promptly even while every other worker is busy with
+long import or reprocessing jobs. Queue waits and time to completion per
+class are reported under "analysis" in /metrics. Bulk jobs of the import
+and reprocess CLIs reach the API processes' schedulers through the shared
+queue in analysis_queue.py.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from .settings import settings
+from . import metrics
+
+INTERACTIVE = "interactive"
+IMPORT = "import"
+REPROCESS = "reprocess"
+PRIORITY_CLASSES = (INTERACTIVE, IMPORT, REPROCESS)
+LATENCY_SAMPLES = 500  # recent jobs per class for the percentiles in /metrics
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """"interactive=16,import=2,reprocess=1" -> weights (missing classes get 1)"""
+    weights = {priority: 1.0 for priority in PRIORITY_CLASSES}
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = part.partition("=")
+        if name.strip() not in weights:
+            raise ValueError(f"Unknown priority class in ANALYSIS_WEIGHTS: {name.strip()!r}")
+        weights[name.strip()] = max(float(value), 0.001)
+    return weights
+
+
+class _Task:
+    __slots__ = ("priority", "session_id", "fn", "args", "kwargs", "future", "tag", "queued_at", "started_at")
+
+    def __init__(self, priority: str, session_id: Optional[str], fn: Callable[..., Any], args, kwargs):
+        self.priority = priority
+        self.session_id = session_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.tag = 0.0
+        self.queued_at = time.monotonic()
+        self.started_at = 0.0
+
+
+class _Flow:
+    __slots__ = ("tasks", "last_tag")
+
+    def __init__(self):
+        self.tasks: Deque[_Task] = deque()
+        self.last_tag = 0.0
+
+
+class FairScheduler:
+    def __init__(self, workers: int, reserved_interactive: int, session_concurrency: int, weights: Dict[str, float]):
+        self.workers = max(workers, 1)
+        self.reserved_interactive = min(max(reserved_interactive, 0), self.workers - 1)
+        self.session_concurrency = max(session_concurrency, 1)
+        self.weights = weights
+        self.virtual_time = 0.0
+        self.flows: Dict[Tuple[str, Optional[str]], _Flow] = {}
+        self.running_by_session: Dict[Optional[str], int] = {}
+        self.running_by_class = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.queued_by_class = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.latencies = {priority: deque(maxlen=LATENCY_SAMPLES) for priority in PRIORITY_CLASSES}
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
+
+    def submit(self, priority: str, session_id: Optional[str], fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs) for the session at the given priority class"""
+        if priority not in self.weights:
+            raise ValueError(f"Unknown priority class: {priority!r}")
+        task = _Task(priority, session_id, fn, args, kwargs)
+        with self.condition:
+            if not self.threads:
+                self._start()
+            flow = self.flows.setdefault((priority, session_id), _Flow())
+            task.tag = max(self.virtual_time, flow.last_tag)
+            flow.last_tag = task.tag + 1.0 / self.weights[priority]
+            flow.tasks.append(task)
+            self.queued_by_class[priority] += 1
+            metrics.inc(f"analysis_{priority}_queued")
+            self.condition.notify()
+        return task.future
+
+    def _start(self) -> None:
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"analysis-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _eligible(self, task: _Task) -> bool:
+        if self.running_by_session.get(task.session_id, 0) >= self.session_concurrency:
+            return False
+        if task.priority != INTERACTIVE:
+            background = sum(self.running_by_class.values()) - self.running_by_class[INTERACTIVE]
+            return background < self.workers - self.reserved_interactive
+        return True
+
+    def _next_task(self) -> Optional[_Task]:
+        """Pop the eligible flow head with the smallest tag (caller holds the lock)"""
+        best_key, best = None, None
+        for key, flow in self.flows.items():
+            head = flow.tasks[0]
+            if (best is None or head.tag < best.tag) and self._eligible(head):
+                best_key, best = key, head
+        if best is None:
+            return None
+        flow = self.flows[best_key]
+        flow.tasks.popleft()
+        if not flow.tasks:
+            # An idle flow keeps no credit: it restarts at the virtual time when it returns
+            del self.flows[best_key]
+        self.virtual_time = max(self.virtual_time, best.tag)
+        self.queued_by_class[best.priority] -= 1
+        return best
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                task = self._next_task()
+                while task is None:
+                    self.condition.wait()
+                    task = self._next_task()
+                if not task.future.set_running_or_notify_cancel():
+                    continue
+                self.running_by_class[task.priority] += 1
+                self.running_by_session[task.session_id] = self.running_by_session.get(task.session_id, 0) + 1
+            task.started_at = time.monotonic()
+            try:
+                task.future.set_result(task.fn(*task.args, **task.kwargs))
+            except Exception as e:
+                print(f"Analysis job for session {task.session_id} failed: {e}")
+                task.future.set_exception(e)
+            finally:
+                finished = time.monotonic()
+                with self.condition:
+                    self.running_by_class[task.priority] -= 1
+                    remaining = self.running_by_session[task.session_id] - 1
+                    if remaining:
+                        self.running_by_session[task.session_id] = remaining
+                    else:
+                        del self.running_by_session[task.session_id]
+                    self.latencies[task.priority].append((task.started_at - task.queued_at, finished - task.queued_at))
+                    # A finished job can unblock a capped session or the background share
+                    self.condition.notify_all()
+                metrics.max_gauge(f"analysis_{task.priority}_max_wait_ms", round((task.started_at - task.queued_at) * 1000))
+
+    def status(self) -> Dict[str, Any]:
+        with self.condition:
+            latency = {}
+            for priority, samples in self.latencies.items():
+                if not samples:
+                    continue
+                waits = sorted(wait for wait, _ in samples)
+                totals = sorted(total for _, total in samples)
+                latency[priority] = {
+                    "samples": len(samples),
+                    "wait_p50_ms": round(waits[len(waits) // 2] * 1000),
+                    "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000),
+                    "total_p95_ms": round(totals[int(len(totals) * 0.95)] * 1000),
+                }
+            return {
+                "workers": self.workers,
+                "reserved_interactive": self.reserved_interactive,
+                "session_concurrency": self.session_concurrency,
+                "running": dict(self.running_by_class),
+                "queued": dict(self.queued_by_class),
+                "queued_sessions": len({session_id for _, session_id in self.flows}),
+                "latency": latency,
+            }
+
+
+_scheduler: Optional[FairScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def _build(workers: Optional[int], reserved_interactive: Optional[int], session_concurrency: Optional[int]) -> FairScheduler:
+    return FairScheduler(
+        workers if workers is not None else settings.analysis_workers,
+        reserved_interactive if reserved_interactive is not None else settings.analysis_reserved_interactive,
+        session_concurrency if session_concurrency is not None else settings.analysis_session_concurrency,
+        parse_weights(settings.analysis_weights),
+    )
+
+
+def configure(workers: Optional[int] = None, reserved_interactive: Optional[int] = None,
+              session_concurrency: Optional[int] = None) -> FairScheduler:
+    """Override the settings for this process (CLIs call this before submitting anything)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None and _scheduler.threads:
+            raise RuntimeError("The analysis scheduler is already running")
+        _scheduler = _build(workers, reserved_interactive, session_concurrency)
+        return _scheduler
+
+
+def scheduler() -> FairScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = _build(None, None, None)
+        return _scheduler
+
+
+def submit(priority: str, session_id: Optional[str], fn: Callable[..., Any], *args, **kwargs) -> Future:
+    return scheduler().submit(priority, session_id, fn, *args, **kwargs)
+
+
+def analysis_metrics() -> Dict[str, Any]:
+    return scheduler().status()
+
+
+metrics.register_collector("analysis", analysis_metrics)
@@ -1,10 +1,17 @@
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
-from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Dict, Any, Optional, List
+from datetime import datetime, date
 
 class ProcessTextRequest(BaseModel):
     text: str
 
+class ProcessTextBatchRequest(BaseModel):
+    texts: List[str] = Field(..., min_length=1, max_length=10000)
+
+class ProcessTextBatchOut(BaseModel):
+    created: int
+    event_ids: List[int]
+
 class UploadImageRequest(BaseModel):
     caption: str
 
@@ -20,8 +27,55 @@ class EventOut(BaseModel):
     ai_results: Dict[str, Any] | None
     heic_metadata: Dict[str, Any] | None
     original_filename: str | None
+    preview_key: str | None = None
     photo_taken_at: Optional[datetime]
     created_at: datetime
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    # Presigned storage URLs, only present when requested (?urls=true or EMBED_IMAGE_URLS)
+    image_url: Optional[str] = None
+    preview_url: Optional[str] = None
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class LabelCount(BaseModel):
+    label: str
+    count: int
+
+class RollupOut(BaseModel):
+    period: str
+    period_start: date
+    event_count: int
+    event_types: Dict[str, int]
+    top_labels: List[LabelCount]
+    cities: Dict[str, int]
+    first_photo_at: Optional[datetime]
+    last_photo_at: Optional[datetime]
+
+class ClusterOut(BaseModel):
+    id: int
+    level: str
+    start_at: datetime
+    end_at: datetime
+    event_count: int
+    latitude: Optional[float]
+    longitude: Optional[float]
+    city: Optional[str]
+    cities: Dict[str, int]
+
+class NearbyEventOut(EventOut):
+    distance_km: float
+
+class ImageUrlsRequest(BaseModel):
+    keys: List[str] = Field(..., min_length=1, max_length=500)
+
+class ImageUrlsOut(BaseModel):
+    urls: Dict[str, Optional[str]]
+    expires_at: int
+
+class TileClusterOut(BaseModel):
+    geohash: str
+    count: int
+    latitude: float
+    longitude: float
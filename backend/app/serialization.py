@@ -0,0 +1,84 @@
+"""
+Fast response encoding for event lists
+Rows are encoded straight to bytes with orjson (or MessagePack) instead of
+going through Pydantic validation and the stdlib JSON encoder, and the
+result can be compressed with gzip or brotli based on Accept-Encoding.
+"""
+import gzip
+from datetime import datetime
+from typing import Any, Dict, Iterable, Mapping, List
+import orjson
+import msgpack
+from .schemas import EventOut
+from .signed_urls import embed_urls
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Presigned URLs are not columns: null unless encode_events embeds them on request
+URL_FIELDS = ("image_url", "preview_url")
+EVENT_FIELDS = tuple(field for field in EventOut.model_fields if field not in URL_FIELDS)
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = {MSGPACK, "application/x-msgpack"}
+
+# Bodies smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+
+
+def event_row(row: Mapping[str, Any]) -> Dict[str, Any]:
+    """The EventOut fields of a result mapping or ORM object (URL fields null until embed_urls)"""
+    if isinstance(row, Mapping):
+        event = {field: row[field] for field in EVENT_FIELDS}
+    else:
+        event = {field: getattr(row, field) for field in EVENT_FIELDS}
+    event.update(dict.fromkeys(URL_FIELDS))
+    return event
+
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__} as MessagePack")
+
+
+def encode_events(rows: Iterable[Mapping[str, Any]], media_type: str = JSON, with_urls: bool = False) -> bytes:
+    """Encode event rows as a JSON array or MessagePack list, optionally with presigned image URLs"""
+    events: List[Dict[str, Any]] = [event_row(row) for row in rows]
+    if with_urls:
+        embed_urls(events)
+    if media_type == MSGPACK:
+        return msgpack.packb(events, default=_msgpack_default, datetime=False)
+    return orjson.dumps(events, option=orjson.OPT_UTC_Z)
+
+
+def negotiate_media_type(accept: str | None) -> str:
+    """MessagePack only when the client asks for it, JSON otherwise"""
+    if accept and any(t in accept for t in MSGPACK_TYPES):
+        return MSGPACK
+    return JSON
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    """Pick brotli over gzip when the client accepts both"""
+    accepted = {
+        part.split(";")[0].strip().lower()
+        for part in (accept_encoding or "").split(",")
+        if not part.strip().endswith(";q=0")
+    }
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str | None) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    return body
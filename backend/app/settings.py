@@ -13,6 +13,120 @@ class Settings(BaseSettings):
     locationiq_api_key: str | None = None
     db_init_mode: str | None = None
 
+    # Connection pool shared by the API and background workers
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: int = 30          # seconds to wait for a free connection
+    db_pool_recycle: int = 1800        # seconds before a connection is replaced
+    db_statement_timeout_ms: int = 15000  # Postgres statement_timeout, 0 disables
+
+    # Timeline reads: optional replica and response cache
+    database_replica_url: str | None = None
+    replica_lag_window: int = 5        # seconds a session reads from primary after a write
+    timeline_cache_backend: str = "memory"  # "memory" | "redis"
+    timeline_cache_ttl: int = 300
+    timeline_cache_max_entries: int = 1000
+    redis_url: str | None = None
+
+    # Purge: rows deleted per transaction
+    purge_chunk_size: int = 500
+
+    # Export (see export.py)
+    export_chunk_size: int = 500       # rows per fetch from the server-side cursor
+    export_prefetch: int = 4           # S3 images requested ahead of the one streaming
+
+    # Postgres partitioning of events: "session_hash" | "month" | None
+    events_partitioning: str | None = None
+    events_hash_partitions: int = 16
+    events_partition_months_ahead: int = 3
+
+    # JPEG quality when converting non-JPEG uploads (PNG, WebP, ...)
+    upload_jpeg_quality: int = 90
+
+    # Moment clustering thresholds
+    cluster_day_gap_hours: float = 4
+    cluster_day_distance_km: float = 10
+    cluster_trip_gap_hours: float = 48
+    cluster_place_radius_km: float = 1.0
+
+    # Vision providers per stage: "auto" | "aws" | "local" | "mock" | "none"
+    vision_face_provider: str = "auto"
+    vision_label_provider: str = "auto"
+    vision_ocr_provider: str = "auto"
+    vision_threads: int = 2            # CPU threads for local inference
+    vision_batch_size: int = 8         # images per local inference batch
+    vision_batch_wait_ms: int = 20     # how long a batch waits to fill
+    vision_label_model: str | None = None   # ONNX image classifier
+    vision_label_names: str | None = None   # class names, one per line
+    vision_label_min_confidence: float = 10
+    vision_face_model: str | None = None    # OpenCV YuNet ONNX; Haar cascade if unset
+
+    # External providers: deadlines, circuit breakers, hedging
+    aws_timeout_seconds: float = 10
+    aws_max_attempts: int = 2          # botocore attempts per call, including the first
+    locationiq_timeout_seconds: float = 5
+    openai_timeout_seconds: float = 45
+    provider_breaker_failures: int = 5        # consecutive failures that open a breaker
+    provider_breaker_reset_seconds: float = 30  # open time before a half-open probe
+    provider_hedge_after_ms: int = 0   # send a duplicate read after this long, 0 disables
+    provider_hedge_providers: str = "s3,rekognition,textract,locationiq"
+    provider_cache_entries: int = 1000  # last good answers kept for degraded mode
+
+    # Provider endpoints, for S3-compatible storage or local stand-ins
+    # (benchmarks/fake_providers.py); unset means the public services
+    aws_endpoint_url: str | None = None
+    openai_base_url: str | None = None
+    locationiq_url: str = "https://us1.locationiq.com/v1/reverse.php"
+
+    # Adaptive stage planner (see planner.py)
+    planner_enabled: bool = True
+    planner_ocr_labels: str = "Text,Document,Page,Paper,Letter,Menu,Sign,Poster,Book,Receipt,Handwriting,Label,Screen,Word"
+    planner_face_labels: str = "Person,Human,Face,People,Portrait,Selfie,Head,Child,Baby,Man,Woman,Boy,Girl,Crowd"
+    planner_label_min_confidence: float = 50
+    planner_exif_probe_bytes: int = 131072  # head of the object read for EXIF
+
+    # Write-ahead upload spool (see spool.py)
+    upload_spool_dir: str = "/var/lib/lifetrails/upload-spool"  # put it on persistent disk; "" stores uploads in S3 within the request
+    upload_spool_max_mb: int = 2048        # queued bytes before uploads go straight to S3 again
+    upload_spool_workers: int = 4          # concurrent S3 uploads while draining
+    upload_spool_batch: int = 32           # entries taken per pass, oldest first
+    upload_spool_max_attempts: int = 20    # failed uploads of one entry before it is quarantined (about 2 h of backoff)
+    upload_spool_wait_seconds: int = 120   # how long the pipeline waits for an upload AWS must read from S3
+    upload_spool_shutdown_seconds: int = 10  # drain time at shutdown; the rest is uploaded after the restart
+
+    # Burst / near-duplicate detection (see bursts.py)
+    burst_detection: bool = True
+    burst_window_seconds: int = 10     # capture times this close can belong to one burst
+    burst_max_distance: int = 8        # differing hash bits (of 64) still counted as the same shot
+
+    # Presigned image URLs
+    signed_url_ttl_seconds: int = 3600
+    signed_url_min_validity_seconds: int = 900  # a URL handed out stays valid at least this long
+    signed_url_cache_entries: int = 10000
+    embed_image_urls: bool = False     # add image_url/preview_url to event lists by default
+
+    # Background analysis scheduling (see scheduler.py)
+    analysis_workers: int = 8                # pipeline jobs running at once per process
+    analysis_reserved_interactive: int = 2   # workers that only take interactive uploads
+    analysis_session_concurrency: int = 2    # running jobs per session
+    analysis_weights: str = "interactive=16,import=2,reprocess=1"  # fair-queuing share per priority class
+    analysis_queue_drain: bool = True        # run bulk jobs queued by the import/reprocess CLIs (see analysis_queue.py)
+    analysis_queue_poll_seconds: float = 1   # how often an idle drainer looks for queued jobs
+    analysis_queue_lease_seconds: int = 1800  # a claimed job still running after this is queued again
+
+    # Memory budget for image jobs (see memory_budget.py)
+    job_memory_budget_mb: int = 0        # 0 = half of the container's/machine's memory
+    job_memory_min_free_mb: int = 256    # a job waits unless this much stays free
+    job_memory_default_mb: int = 64      # estimate when the image size is unknown (reprocessing)
+    memory_profile_sample_rate: float = 0  # share of jobs traced per stage with tracemalloc
+    narrative_image_short_side: int = 768  # downscale for GPT-4 Vision (its high-detail size), 0 sends the original
+
+    # Startup (see lifecycle.py)
+    run_startup_migrations: bool = True  # False when `python -m app.lifecycle` runs as a release step
+    deployment_id: str | None = None     # startup work runs once per id (default: RENDER_GIT_COMMIT)
+    prewarm: bool = False                # load providers and fill pools before /ready reports ready
+    prewarm_db_connections: int = 4
+
     @property
     def allowed_origins_list(self) -> List[str]:
         return [origin.strip() for origin in self.allowed_origins.split(",")]
@@ -0,0 +1,88 @@
+"""
+Presigned S3 URLs for images, cached per key
+Signing is done by one shared client and each URL is reused for a whole
+refresh window (SIGNED_URL_TTL_SECONDS - SIGNED_URL_MIN_VALIDITY_SECONDS),
+so any URL handed out stays valid for at least the minimum validity. Within
+a window the same key always maps to the same URL, which also lets browsers
+cache the image. Timeline pages that embed URLs include the window in their
+cache variant, so a cached page never outlives its URLs.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from .settings import settings
+from . import metrics
+
+_lock = threading.Lock()
+_urls: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+_client = None
+
+
+def refresh_window() -> int:
+    return max(settings.signed_url_ttl_seconds - settings.signed_url_min_validity_seconds, 60)
+
+
+def current_window() -> int:
+    """Index of the current refresh window (changes when cached URLs are re-signed)"""
+    return int(time.time() // refresh_window())
+
+
+def _signing_client():
+    global _client
+    if _client is None:
+        from .s3 import get_s3_client
+        _client = get_s3_client()
+    return _client
+
+
+def _sign(s3_key: str) -> str:
+    return _signing_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': settings.aws_bucket_name, 'Key': s3_key},
+        ExpiresIn=settings.signed_url_ttl_seconds,
+    )
+
+
+def signed_url(s3_key: str) -> Optional[str]:
+    """Presigned GET URL for a key, or None when storage is not configured or signing fails"""
+    if not s3_key or not settings.aws_bucket_name:
+        return None
+    window = current_window()
+    with _lock:
+        cached = _urls.get(s3_key)
+        if cached and cached[0] == window:
+            _urls.move_to_end(s3_key)
+            metrics.inc("signed_url_hits")
+            return cached[1]
+
+    try:
+        url = _sign(s3_key)
+    except Exception as e:
+        print(f"Failed to sign URL for {s3_key}: {e}")
+        return None
+    metrics.inc("signed_url_misses")
+    with _lock:
+        _urls[s3_key] = (window, url)
+        _urls.move_to_end(s3_key)
+        while len(_urls) > settings.signed_url_cache_entries:
+            _urls.popitem(last=False)
+    return url
+
+
+def signed_urls(s3_keys: Iterable[str]) -> Dict[str, Optional[str]]:
+    return {s3_key: signed_url(s3_key) for s3_key in dict.fromkeys(s3_keys)}
+
+
+def expires_at() -> int:
+    """Unix time before which every URL of the current window is still valid"""
+    return (current_window() + 1) * refresh_window() + settings.signed_url_min_validity_seconds
+
+
+def embed_urls(events: List[Dict]) -> List[Dict]:
+    """Set image_url and preview_url on serialized image events"""
+    for event in events:
+        if event.get("kind") == "image":
+            event["image_url"] = signed_url(event.get("source"))
+            event["preview_url"] = signed_url(event.get("preview_key")) if event.get("preview_key") else event["image_url"]
+    return events
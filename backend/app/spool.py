@@ -0,0 +1,473 @@
+"""
+Write-ahead spool for uploads
+The upload request writes an image to local disk instead of waiting for
+S3, so S3 latency never shows up in upload latency and an S3 outage does
+not fail uploads. The bytes go to objects/<sha256> (written and fsync'd
+once per content); each S3 key gets a hard link to them plus a small JSON
+entry under entries/. Background threads drain the spool to S3 in
+batches, oldest first. Retry state lives in each entry: a failed upload
+records its attempts and backs off exponentially on its own (the entry's
+mtime is its next due time), so one bad entry never holds up the rest.
+After UPLOAD_SPOOL_MAX_ATTEMPTS failures, or at once when S3 rejects it
+for good (4xx, invalid parameters, a bug on our side), it moves to
+quarantine/, where
+`python -m app.spool --requeue` puts it back. Until an object is uploaded,
+download_from_s3 and the other readers serve it from the spool.
+
+Backpressure: with UPLOAD_SPOOL_MAX_MB queued, uploads go straight to S3
+again and fail with SpoolFull (503) when S3 does not take them either.
+Entries survive restarts and are drained again at startup (on a
+container's own disk only until it is replaced, so mount persistent disk
+at UPLOAD_SPOOL_DIR). Processes on one host may share the directory;
+whichever locks an entry uploads it. When the directory cannot be created
+(e.g. a non-root dev setup) uploads go to S3 within the request.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .settings import settings
+from .resilience import counts_as_failure
+from . import metrics
+
+MB = 1024 * 1024
+IDLE_RESCAN_SECONDS = 5     # picks up entries spooled by other processes
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 900     # per entry; S3 outages are ridden out well before quarantine
+STALE_SECONDS = 3600        # leftovers of a crashed write older than this are removed at startup
+
+
+class SpoolFull(Exception):
+    """Neither the spool nor S3 can take an upload right now"""
+
+
+def _write_durably(path: str, data: bytes) -> None:
+    """Write via a temporary file and rename, fsync'd, so a crash never leaves a partial file"""
+    temporary = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(temporary, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    def __init__(self, root: str, capacity: int, workers: int, batch: int):
+        self.objects = os.path.join(root, "objects")
+        self.entries = os.path.join(root, "entries")
+        self.quarantine = os.path.join(root, "quarantine")
+        for directory in (self.objects, self.entries, self.quarantine):
+            os.makedirs(directory, exist_ok=True)
+        self.capacity = capacity
+        self.workers = max(workers, 1)
+        self.batch = max(batch, 1)
+        self.max_attempts = max(settings.upload_spool_max_attempts, 1)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_error: Optional[str] = None
+        self._remove_leftovers()
+        self.pending_bytes = sum(size for _, _, size in self._pending() + self._pending(self.quarantine))
+
+    def _remove_leftovers(self) -> None:
+        """Temporary files and unreferenced blobs of writes interrupted by a crash"""
+        cutoff = time.time() - STALE_SECONDS
+        for directory in (self.objects, self.entries, self.quarantine):
+            with os.scandir(directory) as scan:
+                for item in scan:
+                    try:
+                        stat = item.stat()
+                        orphan = directory == self.objects and stat.st_nlink == 1
+                        if stat.st_mtime < cutoff and (".tmp-" in item.name or orphan):
+                            os.unlink(item.path)
+                    except FileNotFoundError:
+                        pass
+
+    def _paths(self, s3_key: str, directory: Optional[str] = None) -> Tuple[str, str]:
+        """(data hard link, JSON entry) of a key"""
+        name = os.path.join(directory or self.entries, hashlib.sha1(s3_key.encode()).hexdigest())
+        return name, name + ".json"
+
+    def put(self, s3_key: str, data: bytes) -> bool:
+        """Durably spool data for s3_key and wake the uploader; False when the spool is full"""
+        if self.pending_bytes + len(data) > self.capacity:
+            return False
+        digest = hashlib.sha256(data).hexdigest()
+        blob = os.path.join(self.objects, digest)
+        data_path, entry_path = self._paths(s3_key)
+        for _ in range(2):
+            if not os.path.exists(blob):
+                _write_durably(blob, data)
+                _fsync_dir(self.objects)
+            link = f"{data_path}.tmp-{uuid.uuid4().hex}"
+            try:
+                os.link(blob, link)
+                break
+            except FileNotFoundError:
+                continue  # collected by an uploader meanwhile; write it again
+        else:
+            raise OSError(f"Could not spool {s3_key}")
+        os.replace(link, data_path)
+        entry = {"key": s3_key, "sha256": digest, "bytes": len(data), "spooled_at": time.time()}
+        _write_durably(entry_path, json.dumps(entry).encode())
+        _fsync_dir(self.entries)
+        with self.lock:
+            self.pending_bytes += len(data)
+        metrics.inc("spool_spooled")
+        self.start()
+        self.wakeup.set()
+        return True
+
+    def read(self, s3_key: str, length: Optional[int] = None) -> Optional[bytes]:
+        """The spooled (or quarantined) bytes of s3_key (the first length bytes), or None once it is in S3"""
+        for directory in (self.entries, self.quarantine):
+            data_path, entry_path = self._paths(s3_key, directory)
+            if not os.path.exists(entry_path):
+                continue
+            try:
+                with open(data_path, "rb") as f:
+                    return f.read(length if length is not None else -1)
+            except FileNotFoundError:
+                continue  # uploaded or quarantined in the meantime
+        return None
+
+    def contains(self, s3_key: str) -> bool:
+        return os.path.exists(self._paths(s3_key)[1])
+
+    def quarantined(self, s3_key: str) -> bool:
+        return os.path.exists(self._paths(s3_key, self.quarantine)[1])
+
+    def wait(self, s3_key: str, timeout: float) -> bool:
+        """Block until s3_key has been uploaded; False on timeout or once it is quarantined"""
+        deadline = time.monotonic() + timeout
+        while self.contains(s3_key):
+            if time.monotonic() >= deadline or self.quarantined(s3_key):
+                return False
+            self.wakeup.set()
+            time.sleep(0.2)
+        return not self.quarantined(s3_key)
+
+    def discard(self, s3_keys: Iterable[str]) -> int:
+        """Drop keys that no longer need uploading (e.g. purged events); returns how many were spooled"""
+        discarded = 0
+        for s3_key in s3_keys:
+            for directory in (self.entries, self.quarantine):
+                data_path, entry_path = self._paths(s3_key, directory)
+                try:
+                    with open(entry_path) as f:
+                        # Waits out an upload attempt, which may rewrite the entry
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                        entry = json.load(f)
+                        os.unlink(entry_path)
+                except (FileNotFoundError, ValueError):
+                    continue
+                self._remove_data(data_path, entry)
+                discarded += 1
+                break
+        return discarded
+
+    def _remove_data(self, data_path: str, entry: Dict[str, Any]) -> None:
+        try:
+            os.unlink(data_path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.pending_bytes = max(self.pending_bytes - entry.get("bytes", 0), 0)
+        # The blob is only referenced by its own name now: no other key holds this content
+        blob = os.path.join(self.objects, entry["sha256"])
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+        except FileNotFoundError:
+            pass
+
+    def _pending(self, directory: Optional[str] = None) -> List[Tuple[float, str, int]]:
+        """(due time, entry path, bytes) of every entry, earliest first"""
+        pending = []
+        with os.scandir(directory or self.entries) as scan:
+            for item in scan:
+                if not item.name.endswith(".json"):
+                    continue
+                try:
+                    stat = item.stat()
+                    size = os.stat(item.path[:-len(".json")]).st_size
+                except FileNotFoundError:
+                    continue
+                pending.append((stat.st_mtime, item.path, size))
+        pending.sort()
+        return pending
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._drain, name="upload-spool", daemon=True)
+                self.thread.start()
+
+    def _drain(self) -> None:
+        from .s3 import get_s3_client
+        client = get_s3_client()
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload-spool")
+        while True:
+            self.wakeup.clear()
+            pending = self._pending()
+            quarantined = self._pending(self.quarantine)
+            with self.lock:
+                self.pending_bytes = sum(size for _, _, size in pending + quarantined)
+            now = time.time()
+            due = [item for item in pending if item[0] <= now]
+            if not due:
+                next_due = pending[0][0] - now if pending else IDLE_RESCAN_SECONDS
+                self.wakeup.wait(min(next_due, IDLE_RESCAN_SECONDS))
+                continue
+            outcomes = list(pool.map(lambda item: self._upload(client, item[1]), due[:self.batch]))
+            if False in outcomes:
+                print(f"Upload spool: {outcomes.count(False)} uploads failed ({self.last_error}), "
+                      f"{len(pending)} objects waiting")
+            if outcomes.count(None) == len(outcomes):
+                time.sleep(0.1)  # every entry was locked by another process
+
+    def _upload(self, client, entry_path: str) -> Optional[bool]:
+        """True once uploaded, False on failure, None when another process has the entry"""
+        from .s3 import upload_jpeg_to_s3
+        try:
+            f = open(entry_path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            if not os.path.exists(entry_path):
+                return None  # uploaded by the process that held the lock before
+            data_path = entry_path[:-len(".json")]
+            entry: Any = {}
+            try:
+                entry = json.load(f)
+                if entry.get("retry_at", 0) > time.time():
+                    return None  # failed in another process since we listed it
+                with open(data_path, "rb") as data_file:
+                    body = data_file.read()
+                upload_jpeg_to_s3(entry["key"], body, client)
+            except Exception as e:
+                self.last_error = f"{e.__class__.__name__}: {e}"
+                metrics.inc("spool_upload_failures")
+                # Only what counts against a breaker (transport, timeouts, 5xx, throttling) can pass by retrying
+                self._record_failure(entry_path, entry if isinstance(entry, dict) else {}, self.last_error,
+                                     permanent=not counts_as_failure(e))
+                return False
+            # Entry first: readers that still find it also still find the data
+            os.unlink(entry_path)
+            self._remove_data(data_path, entry)
+        metrics.inc("spool_uploaded")
+        metrics.inc("spool_uploaded_bytes", len(body))
+        metrics.max_gauge("spool_max_lag_ms", round((time.time() - entry["spooled_at"]) * 1000))
+        return True
+
+    def _record_failure(self, entry_path: str, entry: Dict[str, Any], error: str, permanent: bool) -> None:
+        """Back the entry off on its own, or quarantine it (permanent errors, max_attempts); called holding its lock"""
+        attempts = entry.get("attempts", 0) + 1
+        backoff = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+        retry_at = time.time() + backoff * (0.5 + random.random() / 2)
+        entry = {**entry, "attempts": attempts, "retry_at": retry_at, "last_error": error}
+        if permanent or attempts >= self.max_attempts:
+            self._quarantine(entry_path, entry)
+            return
+        _write_durably(entry_path, json.dumps(entry).encode())
+        os.utime(entry_path, (retry_at, retry_at))
+
+    def _quarantine(self, entry_path: str, entry: Dict[str, Any]) -> None:
+        data_path = entry_path[:-len(".json")]
+        held_entry = os.path.join(self.quarantine, os.path.basename(entry_path))
+        held_data = held_entry[:-len(".json")]
+        # Linked before the entry moves so readers always find the bytes in one place or the other
+        try:
+            os.link(data_path, held_data)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            os.unlink(entry_path)  # nothing left to upload
+            return
+        _write_durably(held_entry, json.dumps(entry).encode())
+        os.unlink(entry_path)
+        os.unlink(data_path)
+        metrics.inc("spool_quarantined")
+        print(f"Upload spool: {entry.get('key')} quarantined after {entry['attempts']} attempts ({entry['last_error']})")
+
+    def requeue(self) -> int:
+        """Give every quarantined entry a fresh set of attempts (drainers pick them up on their next scan)"""
+        requeued = 0
+        for _, held_entry, _ in self._pending(self.quarantine):
+            try:
+                with open(held_entry) as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for field in ("attempts", "retry_at", "last_error"):
+                entry.pop(field, None)
+            held_data = held_entry[:-len(".json")]
+            entry_path = os.path.join(self.entries, os.path.basename(held_entry))
+            data_path = entry_path[:-len(".json")]
+            try:
+                os.link(held_data, data_path)
+            except FileExistsError:
+                pass
+            _write_durably(entry_path, json.dumps(entry).encode())
+            os.unlink(held_entry)
+            os.unlink(held_data)
+            requeued += 1
+        return requeued
+
+    def flush(self, timeout: float) -> int:
+        """Give the uploader up to timeout seconds to upload what is due; returns the objects left"""
+        deadline = time.monotonic() + timeout
+        pending = self._pending()
+        if pending:
+            self.start()
+        while pending and pending[0][0] <= time.time() and time.monotonic() < deadline:
+            self.wakeup.set()
+            time.sleep(0.2)
+            pending = self._pending()
+        return len(pending)
+
+    def _age(self, due: float, entry_path: str) -> float:
+        """Seconds since an entry was spooled (due time is the spool time until it first fails)"""
+        if due > time.time():
+            try:
+                with open(entry_path) as f:
+                    due = json.load(f)["spooled_at"]
+            except (FileNotFoundError, ValueError, KeyError):
+                return 0.0
+        return time.time() - due
+
+    def status(self) -> Dict[str, Any]:
+        pending = self._pending()
+        quarantined = self._pending(self.quarantine)
+        now = time.time()
+        retrying = [item for item in pending if item[0] > now]
+        return {
+            "pending_objects": len(pending),
+            "pending_bytes": sum(size for _, _, size in pending),
+            "capacity_bytes": self.capacity,
+            "oldest_age_seconds": round(max((self._age(due, path) for due, path, _ in pending[:1] + retrying), default=0), 1),
+            "retrying_objects": len(retrying),
+            "quarantined_objects": len(quarantined),
+            "quarantined_bytes": sum(size for _, _, size in quarantined),
+            "last_error": self.last_error,
+        }
+
+
+_spool: Optional[Spool] = None
+_spool_unavailable = False
+_spool_lock = threading.Lock()
+
+
+def spool() -> Optional[Spool]:
+    """
+    The process's spool, or None when UPLOAD_SPOOL_DIR is empty or cannot
+    be created, or no bucket is configured (uploads go to S3 directly, and
+    fail there)
+    """
+    global _spool, _spool_unavailable
+    if not settings.upload_spool_dir or not settings.aws_bucket_name or _spool_unavailable:
+        return None
+    with _spool_lock:
+        if _spool is None and not _spool_unavailable:
+            try:
+                _spool = Spool(settings.upload_spool_dir, settings.upload_spool_max_mb * MB,
+                               settings.upload_spool_workers, settings.upload_spool_batch)
+            except OSError as e:
+                _spool_unavailable = True
+                print(f"Upload spool disabled, uploading to S3 within the request: {e}")
+        return _spool
+
+
+def store(s3_key: str, jpeg_bytes: bytes) -> None:
+    """
+    Write-ahead store of an uploaded JPEG: spooled, or uploaded right away
+    when the spool is off, full or cannot be written. Raises SpoolFull when
+    the spool cannot take it and S3 fails as well.
+    """
+    from .s3 import upload_jpeg_to_s3
+    active = spool()
+    if active is None:
+        upload_jpeg_to_s3(s3_key, jpeg_bytes)
+        return
+    try:
+        if active.put(s3_key, jpeg_bytes):
+            return
+        metrics.inc("spool_full")
+    except OSError as e:
+        metrics.inc("spool_write_failures")
+        print(f"Upload spool write failed, uploading {s3_key} directly: {e}")
+    try:
+        upload_jpeg_to_s3(s3_key, jpeg_bytes)
+    except Exception as e:
+        raise SpoolFull(f"Upload spool unavailable and S3 failed: {e}") from e
+
+
+def read(s3_key: str, length: Optional[int] = None) -> Optional[bytes]:
+    """Bytes of an upload still waiting in the spool (None otherwise)"""
+    active = spool()
+    return active.read(s3_key, length) if active is not None else None
+
+
+def wait(s3_key: str, timeout: float) -> bool:
+    """Block until s3_key has left the spool for S3; False on timeout"""
+    active = spool()
+    return active.wait(s3_key, timeout) if active is not None else True
+
+
+def discard(s3_keys: Iterable[str]) -> int:
+    active = spool()
+    return active.discard(s3_keys) if active is not None else 0
+
+
+def start() -> None:
+    """Resume uploading what an earlier run left in the spool"""
+    active = spool()
+    if active is not None and active.pending_bytes:
+        active.start()
+
+
+def flush(timeout: float) -> int:
+    active = spool()
+    return active.flush(timeout) if active is not None else 0
+
+
+def requeue() -> int:
+    active = spool()
+    return active.requeue() if active is not None else 0
+
+
+def spool_metrics() -> Dict[str, Any]:
+    active = spool()
+    return active.status() if active is not None else {"enabled": False}
+
+
+metrics.register_collector("spool", spool_metrics)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the upload spool, or retry its quarantined entries")
+    parser.add_argument("--requeue", action="store_true", help="move quarantined entries back for another round of attempts")
+    args = parser.parse_args()
+    if args.requeue:
+        print(f"Requeued {requeue()} entries; a running API uploads them")
+    for key, value in spool_metrics().items():
+        print(f"{key}: {value}")
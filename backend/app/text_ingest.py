@@ -0,0 +1,80 @@
+"""
+Text moment ingestion
+Labels are TF-IDF keywords scored against per-session document-frequency
+statistics, which are updated incrementally in the same transaction as the
+bulk insert of the new events.
+"""
+from collections import Counter
+from typing import Dict, List, Tuple
+from sqlalchemy import select, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import dialect_insert
+from .ai import tokenize, tfidf_keywords, summarize
+from . import models
+
+# Rows per statement for term lookups and upserts
+STATS_CHUNK_SIZE = 1000
+
+
+async def load_stats(db: AsyncSession, session_id: str, terms: List[str]) -> Tuple[int, Dict[str, int]]:
+    """Stored corpus size and document frequencies for the given terms"""
+    doc_count = await db.scalar(
+        select(models.SessionCorpus.doc_count).where(models.SessionCorpus.session_id == session_id)
+    ) or 0
+    doc_freq: Dict[str, int] = {}
+    for start in range(0, len(terms), STATS_CHUNK_SIZE):
+        result = await db.execute(
+            select(models.SessionTerm.term, models.SessionTerm.doc_freq).where(
+                models.SessionTerm.session_id == session_id,
+                models.SessionTerm.term.in_(terms[start:start + STATS_CHUNK_SIZE]),
+            )
+        )
+        doc_freq.update(result.tuples().all())
+    return doc_count, doc_freq
+
+
+async def update_stats(db: AsyncSession, session_id: str, new_docs: int, batch_df: Counter) -> None:
+    """Add a batch's document counts to the session statistics (atomic upserts)"""
+    dialect = db.bind.dialect.name
+
+    corpus = dialect_insert(dialect, models.SessionCorpus).values(session_id=session_id, doc_count=new_docs)
+    await db.execute(corpus.on_conflict_do_update(
+        index_elements=["session_id"],
+        set_={"doc_count": models.SessionCorpus.doc_count + corpus.excluded.doc_count},
+    ))
+
+    rows = [{"session_id": session_id, "term": term, "doc_freq": n} for term, n in batch_df.items()]
+    for start in range(0, len(rows), STATS_CHUNK_SIZE):
+        stmt = dialect_insert(dialect, models.SessionTerm).values(rows[start:start + STATS_CHUNK_SIZE])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["session_id", "term"],
+            set_={"doc_freq": models.SessionTerm.doc_freq + stmt.excluded.doc_freq},
+        ))
+
+
+async def ingest_texts(db: AsyncSession, session_id: str, texts: List[str]) -> List[int]:
+    """Label, summarize and bulk-insert text moments in one transaction; returns event ids"""
+    token_lists = [tokenize(text) for text in texts]
+    batch_df = Counter(term for tokens in token_lists for term in set(tokens))
+
+    stored_count, stored_df = await load_stats(db, session_id, list(batch_df))
+    doc_freq = {term: stored_df.get(term, 0) + n for term, n in batch_df.items()}
+    labels = tfidf_keywords(token_lists, doc_freq, stored_count + len(texts))
+
+    rows = [
+        {
+            "session_id": session_id,
+            "kind": "text",
+            "source": text[:2000],
+            "summary": await summarize(text),
+            "labels": ",".join(keywords),
+            "processing_status": "completed",
+        }
+        for text, keywords in zip(texts, labels)
+    ]
+    ids = (await db.scalars(
+        insert(models.Event).returning(models.Event.id, sort_by_parameter_order=True), rows
+    )).all()
+    await update_stats(db, session_id, len(texts), batch_df)
+    await db.commit()
+    return list(ids)
@@ -0,0 +1,186 @@
+"""
+Per-session timeline response cache
+Serialized timeline pages are cached under a monotonically bumped session
+version; every write to a session bumps the version, so stale pages are never
+served and unchanged timelines can be answered with 304 from the ETag alone.
+
+The in-memory backend only sees the bumps of its own process, while other
+API workers and the importer, reprocess and purge CLIs write too. Its
+versions therefore also carry a watermark of the session's events (count
+and newest updated_at, read from an index) and the current TTL period, so a
+write elsewhere changes the ETag and no 304 outlives the TTL. With Redis
+every process bumps the same counters and the version alone is enough.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from sqlalchemy import Select, func, select
+from .settings import settings
+from . import metrics, models
+
+
+class CacheBackend:
+    """Minimal key/value interface the timeline cache needs from a store"""
+
+    shared = False  # True when every process reads and bumps the same counters
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        raise NotImplementedError
+
+    def get_counter(self, key: str, default: int) -> int:
+        """Return the counter at key, initializing it to default if missing"""
+        raise NotImplementedError
+
+    def incr(self, key: str, default: int) -> int:
+        """Increment the counter at key (initialized to default) and return it"""
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU store; versions are only shared by threads of one worker"""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._values: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._counters: dict = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        with self._lock:
+            self._values[key] = (time.monotonic() + ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def get_counter(self, key: str, default: int) -> int:
+        with self._lock:
+            return self._counters.setdefault(key, default)
+
+    def incr(self, key: str, default: int) -> int:
+        with self._lock:
+            value = self._counters.get(key, default) + 1
+            self._counters[key] = value
+            return value
+
+
+class RedisCacheBackend(CacheBackend):
+    """Shared store so every API worker sees the same session versions"""
+
+    shared = True
+
+    def __init__(self, url: str):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        self.client.set(key, value, ex=ttl)
+
+    def get_counter(self, key: str, default: int) -> int:
+        self.client.set(key, default, nx=True)
+        return int(self.client.get(key))
+
+    def incr(self, key: str, default: int) -> int:
+        self.client.set(key, default, nx=True)
+        return int(self.client.incr(key))
+
+
+def create_backend() -> CacheBackend:
+    if settings.timeline_cache_backend == "redis" and settings.redis_url:
+        return RedisCacheBackend(settings.redis_url)
+    return MemoryCacheBackend(settings.timeline_cache_max_entries)
+
+
+backend = create_backend()
+
+# Versions start from a clock reading so a restarted in-memory cache never
+# reissues an ETag that was handed out before the restart
+_ALL_SESSIONS = "timeline:generation"
+
+
+def _initial_version() -> int:
+    return time.time_ns()
+
+
+def _version_key(session_id: str) -> str:
+    return f"timeline:version:{session_id}"
+
+
+def _written_key(session_id: str) -> str:
+    return f"timeline:written:{session_id}"
+
+
+def session_version(session_id: str) -> str:
+    """Current cache version for a session (includes the global generation)"""
+    generation = backend.get_counter(_ALL_SESSIONS, _initial_version())
+    version = backend.get_counter(_version_key(session_id), _initial_version())
+    return f"{generation}.{version}"
+
+
+def needs_watermark() -> bool:
+    return not backend.shared
+
+
+def watermark_query(session_id: str) -> Select:
+    """Cheap summary of a session's events that changes with every insert, update and delete"""
+    return select(func.count(), func.max(models.Event.updated_at)).where(models.Event.session_id == session_id)
+
+
+def with_watermark(version: str, count: int, updated_at) -> str:
+    """Fold the DB watermark and the TTL period into a process-local version"""
+    period = int(time.time() // max(settings.timeline_cache_ttl, 1))
+    stamp = updated_at.timestamp() if updated_at is not None else 0
+    return f"{version}.{count}.{stamp}.{period}"
+
+
+def etag_for(session_id: str, version: str, variant: str = "") -> str:
+    """Strong ETag for one representation (media type + encoding) of a session version"""
+    digest = hashlib.sha1(f"{session_id}:{version}:{variant}".encode()).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def get_page(session_id: str, version: str, variant: str = "") -> Optional[bytes]:
+    body = backend.get(f"timeline:page:{session_id}:{version}:{variant}")
+    metrics.inc("timeline_cache_hits" if body is not None else "timeline_cache_misses")
+    return body
+
+
+def store_page(session_id: str, version: str, body: bytes, variant: str = "") -> None:
+    backend.set(f"timeline:page:{session_id}:{version}:{variant}", body, settings.timeline_cache_ttl)
+
+
+def invalidate(session_id: str) -> None:
+    """Bump the session version after a committed write"""
+    backend.incr(_version_key(session_id), _initial_version())
+    backend.set(_written_key(session_id), str(time.time()).encode(), max(settings.replica_lag_window, 1))
+    metrics.inc("timeline_cache_invalidations")
+
+
+def invalidate_all() -> None:
+    """Bump the global generation, e.g. after a table-wide delete"""
+    backend.incr(_ALL_SESSIONS, _initial_version())
+    metrics.inc("timeline_cache_invalidations")
+
+
+def recently_written(session_id: str) -> bool:
+    """True while a replica may not have caught up with the session's last write"""
+    return backend.get(_written_key(session_id)) is not None
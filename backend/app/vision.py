@@ -0,0 +1,377 @@
+"""
+Pluggable vision providers for the pipeline's face, label and OCR stages
+Each stage picks its provider from settings (VISION_FACE_PROVIDER,
+VISION_LABEL_PROVIDER, VISION_OCR_PROVIDER):
+- "aws":   Rekognition / Textract (one request per image)
+- "local": CPU inference - OpenCV face detection, an ONNX image classifier
+           and Tesseract OCR; images from concurrent pipelines are batched
+- "mock":  fixed demo data
+- "none":  no results
+- "auto":  aws when credentials are configured, else local when its
+           dependencies (and model) are installed, else none
+A stage whose provider fails returns no results and is listed in
+ai_results["vision_degraded"]; demo data is never stored in its place.
+The local dependencies (opencv-python-headless, onnxruntime, pytesseract)
+are optional and only imported when the local provider is used.
+"""
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional
+from .settings import settings
+from . import metrics
+
+VISION_STAGES = ("faces", "labels", "ocr")
+PROVIDERS = ("auto", "aws", "local", "mock", "none")
+FALLBACK_PROVIDER = "none"
+
+LOCAL_IMAGE_MAX_SIDE = 1024  # faces/OCR run on a downscaled copy
+CLASSIFIER_SIZE = 224
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+MAX_LABELS = 15
+
+
+class VisionImage:
+    """One image to analyze; bytes are fetched from S3 once, on first use"""
+
+    def __init__(self, s3_key: str, data: Optional[bytes] = None):
+        self.s3_key = s3_key
+        self._data = data
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> bytes:
+        with self._lock:
+            if self._data is None:
+                from .s3 import download_from_s3
+                self._data = download_from_s3(self.s3_key)
+            return self._data
+
+
+class VisionProvider:
+    """Batch interface: every method takes a list of images and returns one result per image"""
+    name = "none"
+    batched = False
+
+    def supports(self, stage: str) -> bool:
+        return True
+
+    def detect_faces(self, images: List[VisionImage]) -> List[List[Dict[str, Any]]]:
+        return [[] for _ in images]
+
+    def detect_labels(self, images: List[VisionImage]) -> List[List[Dict[str, Any]]]:
+        return [[] for _ in images]
+
+    def extract_text(self, images: List[VisionImage]) -> List[str]:
+        return ["" for _ in images]
+
+    def run(self, stage: str, images: List[VisionImage]) -> List[Any]:
+        if stage == "faces":
+            return self.detect_faces(images)
+        if stage == "labels":
+            return self.detect_labels(images)
+        return self.extract_text(images)
+
+
+class AwsVisionProvider(VisionProvider):
+    name = "aws"
+
+    def supports(self, stage: str) -> bool:
+        return bool(settings.aws_access_key_id and settings.aws_secret_access_key and settings.aws_bucket_name)
+
+    def detect_faces(self, images):
+        from .image_processor import detect_faces
+        return [detect_faces(image.s3_key) for image in images]
+
+    def detect_labels(self, images):
+        from .image_processor import detect_labels
+        return [detect_labels(image.s3_key) for image in images]
+
+    def extract_text(self, images):
+        from .image_processor import extract_text_from_textract
+        return [extract_text_from_textract(image.s3_key) for image in images]
+
+
+class MockVisionProvider(VisionProvider):
+    """Fixed demo data; only used when selected explicitly"""
+    name = "mock"
+    FACES = [
+        {"age_range": {"Low": 25, "High": 35}, "gender": "Male", "emotions": []},
+        {"age_range": {"Low": 28, "High": 38}, "gender": "Female", "emotions": []},
+    ]
+    LABELS = [
+        {"name": "Person", "confidence": 85.0},
+        {"name": "Outdoor", "confidence": 75.0},
+        {"name": "Day", "confidence": 90.0},
+    ]
+
+    def detect_faces(self, images):
+        return [[dict(face) for face in self.FACES] for _ in images]
+
+    def detect_labels(self, images):
+        return [[dict(label) for label in self.LABELS] for _ in images]
+
+
+class LocalVisionProvider(VisionProvider):
+    """
+    CPU inference. Labels come from an ONNX ImageNet-style classifier
+    (VISION_LABEL_MODEL, NCHW float input, with VISION_LABEL_NAMES holding
+    one class name per line) run on whole batches. Faces use OpenCV's YuNet
+    detector when VISION_FACE_MODEL is set, else the bundled Haar cascade.
+    """
+    name = "local"
+    batched = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classifier = None
+        self._class_names: List[str] = []
+        self._cascade = None
+        self._pool = ThreadPoolExecutor(max_workers=max(settings.vision_threads, 1), thread_name_prefix="vision")
+
+    def supports(self, stage: str) -> bool:
+        try:
+            if stage == "faces":
+                import cv2
+                # OpenCV 5 moved the Haar cascades out of the main package
+                if settings.vision_face_model:
+                    return hasattr(cv2, "FaceDetectorYN") and os.path.exists(settings.vision_face_model)
+                return hasattr(cv2, "CascadeClassifier") and hasattr(cv2, "data")
+            if stage == "labels":
+                import onnxruntime  # noqa: F401
+                return bool(settings.vision_label_model and os.path.exists(settings.vision_label_model))
+            import pytesseract  # noqa: F401
+            return shutil.which("tesseract") is not None
+        except ImportError:
+            return False
+
+    # Image decoding
+
+    def _pil_image(self, image: VisionImage, max_side: int):
+        from PIL import Image, ImageOps
+        pil = Image.open(BytesIO(image.data))
+        pil.draft("RGB", (max_side, max_side))  # JPEG: decode at reduced scale
+        pil = ImageOps.exif_transpose(pil).convert("RGB")
+        pil.thumbnail((max_side, max_side))
+        return pil
+
+    # Faces
+
+    def _face_boxes(self, image: VisionImage) -> List[Dict[str, Any]]:
+        import cv2
+        import numpy as np
+        rgb = np.asarray(self._pil_image(image, LOCAL_IMAGE_MAX_SIDE))
+        height, width = rgb.shape[:2]
+        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+        faces = []
+        if settings.vision_face_model:
+            detector = cv2.FaceDetectorYN.create(settings.vision_face_model, "", (width, height))
+            _, detections = detector.detect(bgr)
+            for x, y, w, h, *rest in (detections if detections is not None else []):
+                faces.append(((x, y, w, h), float(rest[-1]) * 100))
+        else:
+            with self._lock:
+                if self._cascade is None:
+                    self._cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+            gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+            for x, y, w, h in self._cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(24, 24)):
+                faces.append(((x, y, w, h), None))
+        return [
+            {
+                "age_range": {},
+                "gender": None,
+                "emotions": [],
+                "bounding_box": {"Left": x / width, "Top": y / height, "Width": w / width, "Height": h / height},
+                "confidence": confidence,
+            }
+            for (x, y, w, h), confidence in faces
+        ]
+
+    def detect_faces(self, images):
+        import cv2
+        cv2.setNumThreads(max(settings.vision_threads, 1))
+        return list(self._pool.map(self._face_boxes, images))
+
+    # Labels
+
+    def _load_classifier(self):
+        with self._lock:
+            if self._classifier is None:
+                import onnxruntime
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = max(settings.vision_threads, 1)
+                options.inter_op_num_threads = 1
+                self._classifier = onnxruntime.InferenceSession(
+                    settings.vision_label_model, options, providers=["CPUExecutionProvider"]
+                )
+                if settings.vision_label_names:
+                    with open(settings.vision_label_names) as f:
+                        self._class_names = [line.strip() for line in f]
+        return self._classifier
+
+    def _classifier_input(self, image: VisionImage):
+        import numpy as np
+        pil = self._pil_image(image, CLASSIFIER_SIZE * 2)
+        # Resize the shorter side, then center crop
+        scale = CLASSIFIER_SIZE / min(pil.size)
+        pil = pil.resize((max(CLASSIFIER_SIZE, round(pil.width * scale)), max(CLASSIFIER_SIZE, round(pil.height * scale))))
+        left, top = (pil.width - CLASSIFIER_SIZE) // 2, (pil.height - CLASSIFIER_SIZE) // 2
+        pil = pil.crop((left, top, left + CLASSIFIER_SIZE, top + CLASSIFIER_SIZE))
+        array = np.asarray(pil, dtype=np.float32) / 255.0
+        array = (array - np.array(IMAGENET_MEAN, dtype=np.float32)) / np.array(IMAGENET_STD, dtype=np.float32)
+        return array.transpose(2, 0, 1)
+
+    def detect_labels(self, images):
+        import numpy as np
+        session = self._load_classifier()
+        model_input = session.get_inputs()[0]
+        batch = np.stack(list(self._pool.map(self._classifier_input, images)))
+        # Models exported with a fixed batch dimension of 1 run image by image
+        if model_input.shape and model_input.shape[0] == 1 and len(images) > 1:
+            scores = np.concatenate([session.run(None, {model_input.name: batch[i:i + 1]})[0] for i in range(len(images))])
+        else:
+            scores = session.run(None, {model_input.name: batch})[0]
+        scores = scores.reshape(len(images), -1)
+        if not np.allclose(scores.sum(axis=1), 1.0, atol=1e-3):
+            exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+            scores = exp / exp.sum(axis=1, keepdims=True)
+
+        results = []
+        for row in scores:
+            labels = []
+            for index in np.argsort(row)[::-1][:MAX_LABELS]:
+                confidence = float(row[index]) * 100
+                if confidence < settings.vision_label_min_confidence:
+                    break
+                name = self._class_names[index] if index < len(self._class_names) else f"class_{index}"
+                labels.append({"name": name, "confidence": round(confidence, 2)})
+            results.append(labels)
+        return results
+
+    # OCR
+
+    def _ocr(self, image: VisionImage) -> str:
+        import pytesseract
+        text = pytesseract.image_to_string(self._pil_image(image, 2 * LOCAL_IMAGE_MAX_SIDE))
+        return " ".join(line.strip() for line in text.splitlines() if line.strip())
+
+    def extract_text(self, images):
+        return list(self._pool.map(self._ocr, images))
+
+
+class MicroBatcher:
+    """
+    Collects single-image requests from concurrent pipeline threads into
+    batches of up to max_batch, waiting at most max_wait for a batch to fill.
+    """
+
+    def __init__(self, fn: Callable[[List[Any]], List[Any]], max_batch: int, max_wait: float, name: str):
+        self.fn = fn
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self.name = name
+        self.queue: "queue.Queue" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, item: Any) -> Any:
+        future: Future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            metrics.inc(f"vision_{self.name}_batches")
+            metrics.max_gauge(f"vision_{self.name}_max_batch", len(batch))
+            try:
+                results = self.fn([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # One unreadable image must not fail the others: retry one by one
+                for item, future in batch:
+                    try:
+                        future.set_result(self.fn([item])[0])
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+
+
+_providers: Dict[str, VisionProvider] = {}
+_batchers: Dict[str, MicroBatcher] = {}
+_registry_lock = threading.Lock()
+PROVIDER_CLASSES = {
+    "aws": AwsVisionProvider,
+    "local": LocalVisionProvider,
+    "mock": MockVisionProvider,
+    "none": VisionProvider,
+}
+
+
+def get_provider(name: str) -> VisionProvider:
+    with _registry_lock:
+        if name not in _providers:
+            _providers[name] = PROVIDER_CLASSES[name]()
+        return _providers[name]
+
+
+def configured_provider(stage: str) -> str:
+    return {
+        "faces": settings.vision_face_provider,
+        "labels": settings.vision_label_provider,
+        "ocr": settings.vision_ocr_provider,
+    }[stage].strip().lower()
+
+
+def provider_for(stage: str, name: Optional[str] = None) -> VisionProvider:
+    """Resolve the provider for a stage ("auto" tries aws, then local, then none)"""
+    name = name or configured_provider(stage)
+    if name not in PROVIDERS:
+        print(f"Warning: Unknown vision provider '{name}' for {stage}. Available: {', '.join(PROVIDERS)}")
+        name = "auto"
+    if name != "auto":
+        return get_provider(name)
+    for candidate in ("aws", "local"):
+        provider = get_provider(candidate)
+        if provider.supports(stage):
+            return provider
+    return fallback_provider(stage)
+
+
+def fallback_provider(stage: str) -> VisionProvider:
+    return get_provider(FALLBACK_PROVIDER)
+
+
+def analyze(stage: str, image: VisionImage, provider: Optional[VisionProvider] = None) -> Any:
+    """Run one vision stage for one image, batched with other callers for local inference"""
+    provider = provider or provider_for(stage)
+    metrics.inc(f"vision_{stage}_{provider.name}_images")
+    if not provider.batched:
+        return provider.run(stage, [image])[0]
+    key = f"{provider.name}_{stage}"
+    with _registry_lock:
+        if key not in _batchers:
+            _batchers[key] = MicroBatcher(
+                lambda images, provider=provider, stage=stage: provider.run(stage, images),
+                settings.vision_batch_size,
+                settings.vision_batch_wait_ms / 1000,
+                key,
+            )
+    return _batchers[key].submit(image)
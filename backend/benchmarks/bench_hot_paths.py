@@ -0,0 +1,319 @@
+"""
+Benchmark suite: CPU-bound image and metadata hot paths of an upload
+
+Times each function over a fixed corpus of synthetic photos (HEIC, JPEG
+and PNG at 0.3, 3 and 12 MP, generated from a fixed seed with EXIF
+date, camera and GPS) and records peak memory:
+- heic_processor.convert_heic_to_jpeg, extract_heic_metadata and
+  prepare_heic_upload
+- s3.convert_to_jpeg (JPEG passthrough and PNG re-encode)
+- the GPT-4 Vision request body of create_timeline_narrative (base64 data
+  URL plus JSON encoding)
+- EventOut validation/serialization of one event (the upload response) and
+  serialization.encode_events for a 50-event page
+
+Each case runs in its own interpreter, so peak RSS (which includes Pillow's
+and libheif's buffers; Linux only) is not hidden by earlier cases; Python
+heap peaks come from tracemalloc. Results can be saved as a baseline and
+later runs are compared to it case by case.
+
+Run from backend/:
+    python -m benchmarks.bench_hot_paths --save-baseline
+    python -m benchmarks.bench_hot_paths                          # compare to the baseline
+    python -m benchmarks.bench_hot_paths --only heic --max-regression 0.15   # exit 1 on regression
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hot_paths_baseline.json")
+DEFAULT_CORPUS = os.path.join(tempfile.gettempdir(), "lifetrails-bench-corpus-v1")
+
+RESOLUTIONS = {"0.3MP": (640, 480), "3MP": (2016, 1512), "12MP": (4032, 3024)}
+FORMATS = ("heic", "jpeg", "png")
+SEED = 20240601
+
+# case name -> corpus format it reads ("events" cases build their own input)
+CASES = {
+    "convert_heic_to_jpeg": "heic",
+    "extract_heic_metadata": "heic",
+    "prepare_heic_upload": "heic",
+    "convert_to_jpeg/jpeg": "jpeg",
+    "convert_to_jpeg/png": "png",
+    "narrative_payload": "jpeg",
+    "event_out": "events",
+    "encode_events/50": "events",
+}
+
+
+def synthetic_photo(size, seed: int):
+    """Gradients plus fine noise: compresses roughly like a phone photo"""
+    from PIL import Image, ImageChops
+    rng = random.Random(seed)
+    noise = Image.frombytes("L", size, rng.randbytes(size[0] * size[1])).point(lambda v: v // 6)
+    channels = (
+        Image.linear_gradient("L").resize(size),
+        Image.radial_gradient("L").resize(size),
+        Image.linear_gradient("L").rotate(90).resize(size),
+    )
+    return Image.merge("RGB", [ImageChops.add(channel, noise) for channel in channels])
+
+
+def photo_exif(i: int):
+    from PIL import Image, TiffImagePlugin
+    rational = TiffImagePlugin.IFDRational
+    exif = Image.Exif()
+    exif[0x010F] = "Apple"
+    exif[0x0110] = "iPhone 15 Pro"
+    exif[0x0132] = f"2024:06:{i + 1:02d} 12:30:00"
+    exif[0x8825] = {
+        1: "N", 2: (rational(37), rational(46), rational(30 + i)),
+        3: "W", 4: (rational(122), rational(25), rational(10)),
+    }
+    return exif
+
+
+def build_corpus(directory: str) -> dict:
+    """Write the corpus once (reused across runs); returns {file name: sha256}"""
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    os.makedirs(directory, exist_ok=True)
+    digests = {}
+    for i, (label, size) in enumerate(RESOLUTIONS.items()):
+        image = None
+        for image_format in FORMATS:
+            path = os.path.join(directory, f"{label}.{image_format}")
+            if not os.path.exists(path):
+                image = image or synthetic_photo(size, SEED + i)
+                output = BytesIO()
+                if image_format == "heic":
+                    image.save(output, format="HEIF", quality=80, exif=photo_exif(i).tobytes())
+                elif image_format == "jpeg":
+                    image.save(output, format="JPEG", quality=90, exif=photo_exif(i))
+                else:
+                    image.save(output, format="PNG")
+                with open(path + ".tmp", "wb") as f:
+                    f.write(output.getvalue())
+                os.replace(path + ".tmp", path)
+            with open(path, "rb") as f:
+                digests[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()[:16]
+    return digests
+
+
+def prepare(case: str, path: str):
+    """The function to time and its argument (imports happen here, outside the timing)"""
+    if CASES[case] == "events":
+        from types import SimpleNamespace
+        from .bench_serialization import make_event
+        if case == "event_out":
+            from pydantic import TypeAdapter
+            from app.schemas import EventOut
+            adapter = TypeAdapter(EventOut)
+            return lambda e: adapter.dump_json(adapter.validate_python(e, from_attributes=True)), SimpleNamespace(**make_event(1))
+        from app import serialization
+        return serialization.encode_events, [make_event(i) for i in range(50)]
+
+    with open(path, "rb") as f:
+        data = f.read()
+    import app.image_formats  # imported lazily by the app; keep it out of the first call's memory
+    if case == "convert_heic_to_jpeg":
+        from app.heic_processor import convert_heic_to_jpeg
+        return convert_heic_to_jpeg, data
+    if case == "extract_heic_metadata":
+        from app.heic_processor import extract_heic_metadata
+        return extract_heic_metadata, data
+    if case == "prepare_heic_upload":
+        from app.heic_processor import prepare_heic_upload
+        return (lambda image_bytes: prepare_heic_upload(image_bytes, "IMG_0001.HEIC")), data
+    if case.startswith("convert_to_jpeg"):
+        from app.s3 import convert_to_jpeg
+        return convert_to_jpeg, data
+    if case == "narrative_payload":
+        from app.ai import vision_message
+        return (lambda image_bytes: json.dumps({"model": "gpt-4o", "messages": [
+            vision_message("Analyze this photo", image_bytes)]})), data
+    raise ValueError(f"Unknown case '{case}'")
+
+
+def reset_peak_rss() -> bool:
+    """Reset the process's peak RSS (Linux); ru_maxrss would include the parent's peak from before exec"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """Peak resident set size in bytes since the last reset"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run_case(case: str, path: str, min_time: float, max_iterations: int) -> dict:
+    """Runs in a fresh interpreter; prints one JSON line"""
+    fn, argument = prepare(case, path)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # First call: peak memory over the interpreter's footprint, and warm-up
+        rss_peak = None
+        if reset_peak_rss():
+            rss_before = current_rss()
+            fn(argument)
+            rss_peak = max(peak_rss() - rss_before, 0)
+        else:
+            fn(argument)
+
+        timings = []
+        while len(timings) < 3 or (sum(timings) < min_time and len(timings) < max_iterations):
+            started = time.perf_counter()
+            fn(argument)
+            timings.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        fn(argument)
+        py_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "median_ms": round(statistics.median(timings) * 1000, 2),
+        "min_ms": round(min(timings) * 1000, 2),
+        "iterations": len(timings),
+        "rss_peak_mb": round(rss_peak / 2**20, 1) if rss_peak is not None else None,
+        "py_peak_mb": round(py_peak / 2**20, 2),
+    }
+
+
+def environment(digests: dict) -> dict:
+    from PIL import __version__ as pillow_version
+    import pillow_heif
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pillow": pillow_version,
+        "pillow_heif": pillow_heif.__version__,
+        "corpus": hashlib.sha256(json.dumps(digests, sort_keys=True).encode()).hexdigest()[:16],
+    }
+
+
+def case_ids(only: str):
+    for case, source in CASES.items():
+        inputs = ["page"] if source == "events" else list(RESOLUTIONS)
+        for label in inputs:
+            case_id = f"{case}[{label}]"
+            if not only or any(part in case_id for part in only.split(",")):
+                yield case_id, case, label
+
+
+def compare(results: dict, baseline: dict, max_regression: float):
+    """Rows of (case id, time change, rss change) and the regressions beyond max_regression"""
+    rows, regressions = {}, []
+    for case_id, result in results.items():
+        previous = baseline.get("results", {}).get(case_id)
+        if not previous:
+            continue
+        time_change = result["median_ms"] / previous["median_ms"] - 1 if previous["median_ms"] else 0.0
+        rss_change = None
+        if result["rss_peak_mb"] is not None and previous.get("rss_peak_mb"):
+            rss_change = result["rss_peak_mb"] / previous["rss_peak_mb"] - 1
+        rows[case_id] = (time_change, rss_change)
+        if max_regression is not None:
+            if time_change > max_regression:
+                regressions.append(f"{case_id}: {time_change:+.0%} time")
+            # Small peaks are noise (allocator, page granularity)
+            if rss_change is not None and rss_change > max_regression and result["rss_peak_mb"] - previous["rss_peak_mb"] > 8:
+                regressions.append(f"{case_id}: {rss_change:+.0%} peak memory")
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-bound image and metadata hot paths")
+    parser.add_argument("--only", help="Comma-separated substrings of case ids, e.g. heic,12MP")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds of timed calls per case")
+    parser.add_argument("--max-iterations", type=int, default=50)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="Directory the corpus is written to")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Write this run as the baseline")
+    parser.add_argument("--json", help="Also write this run's results to this file")
+    parser.add_argument("--max-regression", type=float, help="Exit with status 1 if a case is this much slower (0.15 = 15%%)")
+    parser.add_argument("--run-case", nargs=2, metavar=("CASE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case[0], args.run_case[1], args.min_time, args.max_iterations)))
+        return
+
+    digests = build_corpus(args.corpus)
+    env = environment(digests)
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differing = [key for key in ("python", "pillow", "pillow_heif", "corpus", "cpus")
+                     if baseline.get("environment", {}).get(key) != env[key]]
+        if differing:
+            print(f"Note: baseline differs in {', '.join(differing)}; comparisons may not be meaningful")
+
+    results = {}
+    print(f"{'case':<36}{'median ms':>11}{'min ms':>10}{'runs':>6}{'rss MB':>9}{'py MB':>8}{'vs base':>9}{'rss':>7}")
+    for case_id, case, label in case_ids(args.only):
+        path = os.path.join(args.corpus, f"{label}.{CASES[case]}")
+        command = [sys.executable, "-m", "benchmarks.bench_hot_paths", "--run-case", case, path,
+                   "--min-time", str(args.min_time), "--max-iterations", str(args.max_iterations)]
+        completed = subprocess.run(command, cwd=BACKEND_DIR, capture_output=True, text=True,
+                                   env={**os.environ, "DATABASE_URL": os.environ.get("DATABASE_URL", "sqlite://")})
+        if completed.returncode != 0:
+            print(f"{case_id:<36} failed: {completed.stderr.strip().splitlines()[-1:]}")
+            continue
+        result = results[case_id] = json.loads(completed.stdout.strip().splitlines()[-1])
+        changes, _ = compare({case_id: result}, baseline, None)
+        time_change, rss_change = changes.get(case_id, (None, None))
+        rss = f"{result['rss_peak_mb']:>9.1f}" if result["rss_peak_mb"] is not None else f"{'-':>9}"
+        print(f"{case_id:<36}{result['median_ms']:>11.2f}{result['min_ms']:>10.2f}{result['iterations']:>6}{rss}"
+              f"{result['py_peak_mb']:>8.2f}"
+              f"{(f'{time_change:+.0%}' if time_change is not None else '-'):>9}"
+              f"{(f'{rss_change:+.0%}' if rss_change is not None else '-'):>7}")
+
+    run = {"environment": env, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            # Keep cases this run did not cover (e.g. with --only)
+            with open(args.baseline) as f:
+                run["results"] = {**json.load(f).get("results", {}), **results}
+        with open(args.baseline, "w") as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+        return
+
+    _, regressions = compare(results, baseline, args.max_regression)
+    if regressions:
+        print("\nFAIL: regressions against the baseline:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
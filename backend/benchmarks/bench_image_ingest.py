@@ -0,0 +1,91 @@
+"""
+Benchmark: per-upload CPU for turning an upload into the stored JPEG
+
+Compares the previous path (Pillow open to check the format, re-encode of
+every non-JPEG, HEIC converted and then opened again before upload) with
+magic-byte sniffing, JPEG passthrough and a single decode/encode.
+
+Run from backend/:  python -m benchmarks.bench_image_ingest
+"""
+import os
+import time
+from io import BytesIO
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from PIL import Image, ImageDraw
+from app.image_formats import normalize_to_jpeg, to_jpeg
+
+SIZE = (4032, 3024)  # 12 MP phone photo
+ITERATIONS = 5
+
+
+def previous_convert_to_jpeg(image_bytes: bytes) -> bytes:
+    """s3.convert_to_jpeg before format sniffing"""
+    image = Image.open(BytesIO(image_bytes))
+    if image.format == 'JPEG':
+        return image_bytes
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGB')
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def previous_heic_path(image_bytes: bytes) -> bytes:
+    """convert_heic_to_jpeg followed by upload_image_to_s3's convert_to_jpeg"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=95, optimize=True)
+    return previous_convert_to_jpeg(output.getvalue())
+
+
+def current_heic_path(image_bytes: bytes) -> bytes:
+    return normalize_to_jpeg(to_jpeg(image_bytes, quality=95, optimize=True))
+
+
+def make_image() -> Image.Image:
+    image = Image.new("RGB", SIZE, (90, 140, 200))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, SIZE[0], 48):
+        draw.line([(i, 0), (SIZE[0] - i, SIZE[1])], fill=(i % 255, 80, 255 - i % 255), width=9)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees, like a portrait phone photo
+    image.info["exif"] = exif.tobytes()
+    return image
+
+
+def encode(image: Image.Image, fmt: str) -> bytes:
+    output = BytesIO()
+    image.save(output, format=fmt, exif=image.info["exif"])
+    return output.getvalue()
+
+
+def cpu_per_call(fn, data: bytes) -> float:
+    fn(data)
+    start = time.process_time()
+    for _ in range(ITERATIONS):
+        fn(data)
+    return (time.process_time() - start) / ITERATIONS * 1000
+
+
+def main():
+    image = make_image()
+    uploads = {"jpeg": encode(image, "JPEG"), "png": encode(image, "PNG"), "webp": encode(image, "WEBP")}
+    try:
+        uploads["heic"] = encode(image, "HEIF")
+    except Exception as e:
+        print(f"HEIC encoder unavailable, skipping HEIC case: {e}")
+
+    print(f"{SIZE[0]}x{SIZE[1]} uploads, {ITERATIONS} iterations")
+    print(f"{'format':<8}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for fmt, data in uploads.items():
+        before = cpu_per_call(previous_heic_path if fmt == "heic" else previous_convert_to_jpeg, data)
+        after = cpu_per_call(current_heic_path if fmt == "heic" else normalize_to_jpeg, data)
+        print(f"{fmt:<8}{before:>12.2f}{after:>12.2f}{before / max(after, 1e-6):>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
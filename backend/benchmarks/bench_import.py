@@ -0,0 +1,98 @@
+"""
+Benchmark: cold start of the API process
+
+Measures in fresh interpreters:
+- `import app.main` wall time and the slowest modules by cumulative
+  import time (python -X importtime)
+- which heavy provider packages got imported (should be none; they load on
+  first use or with PREWARM)
+- lifespan startup on an empty database and again once the startup work
+  has been applied (the path every further worker and restart takes)
+
+Run from backend/:
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --runs 10 --max-import-ms 1500   # exit 1 on regression
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDER_PACKAGES = ("boto3", "botocore", "openai", "PIL", "pillow_heif", "exifread", "numpy", "cv2", "onnxruntime")
+
+IMPORT_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import app.main
+print(round((time.perf_counter() - started) * 1000, 1))
+print(",".join(name for name in {packages!r} if name in sys.modules))
+"""
+
+STARTUP_SCRIPT = """
+import asyncio, time
+import app.main
+from app import lifecycle
+started = time.perf_counter()
+asyncio.run(lifecycle.startup())
+print(round((time.perf_counter() - started) * 1000, 1))
+"""
+
+
+def run(script: str, database_url: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", script]
+    env = {**os.environ, "DATABASE_URL": database_url, "PREWARM": "false"}
+    return subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+
+
+def slowest_modules(importtime_output: str, top: int):
+    """app.main's direct imports by cumulative time (deeper modules are included in their totals)"""
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite file")
+    parser.add_argument("--max-import-ms", type=float, help="Exit with status 1 if the median import exceeds this")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+
+        timings, loaded = [], ""
+        for _ in range(args.runs):
+            output = run(IMPORT_SCRIPT.format(packages=PROVIDER_PACKAGES), database_url).stdout.splitlines()
+            timings.append(float(output[-2]))
+            loaded = output[-1]
+        median = statistics.median(timings)
+        print(f"import app.main: median {median:.0f} ms, min {min(timings):.0f} ms over {args.runs} runs")
+        print(f"provider packages imported: {loaded or 'none'}")
+
+        profile = run("import app.main", database_url, importtime=True).stderr
+        print(f"\nslowest imports of app.main (cumulative ms):")
+        for ms, name in slowest_modules(profile, args.top):
+            print(f"{ms:>10.1f}  {name}")
+
+        first = float(run(STARTUP_SCRIPT, database_url).stdout.splitlines()[-1])
+        again = float(run(STARTUP_SCRIPT, database_url).stdout.splitlines()[-1])
+        print(f"\nlifespan startup: {first:.0f} ms on a new database, {again:.0f} ms once applied")
+
+    if args.max_import_ms and median > args.max_import_ms:
+        print(f"FAIL: median import {median:.0f} ms exceeds {args.max_import_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
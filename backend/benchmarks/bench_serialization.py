@@ -0,0 +1,100 @@
+"""
+Benchmark: per-request CPU for serializing a 50-event timeline page
+
+Compares the previous FastAPI path (Pydantic EventOut validation with
+from_attributes + jsonable_encoder + stdlib json) against the orjson and
+MessagePack row encoders, with and without compression.
+
+Run from backend/:  python -m benchmarks.bench_serialization
+"""
+import json
+import os
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from app import serialization
+from app.schemas import EventOut
+
+PAGE_SIZE = 50
+ITERATIONS = 200
+
+
+def make_event(i: int) -> dict:
+    """An image event with realistically large ai_results / heic_metadata dicts"""
+    return {
+        "id": i,
+        "session_id": "session-benchmark",
+        "kind": "image",
+        "source": f"images/{i:08d}-7f3a2c1e.jpg",
+        "summary": "John stepped away from his desk for a lunchtime walk through the park on Tuesday afternoon.",
+        "user_caption": "Lunch walk",
+        "labels": "Person,Outdoor,Tree,Park,Path",
+        "processing_status": "completed",
+        "ai_results": {
+            "faces": [{"age_range": {"Low": 25, "High": 35}, "gender": "Male",
+                       "emotions": [{"Type": "CALM", "Confidence": 97.1}]}] * 3,
+            "labels": [{"name": f"Label{j}", "confidence": 80.0 + j} for j in range(15)],
+            "ocr_text": "OPEN 9AM - 5PM " * 4,
+            "location": {"address": "Zilker Park, Austin, Texas, USA", "city": "Austin", "country": "United States"},
+            "event_type": "nature",
+            "clarification_questions": ["Who is with you in this photo?"],
+        },
+        "heic_metadata": {
+            "device_info": {"make": "Apple", "model": "iPhone 15 Pro", "software": "17.4"},
+            "camera_settings": {"f_number": "1.78", "exposure_time": "1/120", "iso": "50"},
+            "location": {"latitude": 30.2669, "longitude": -97.7729},
+            "timestamp": "2024-03-12T12:31:04",
+            "all_exif_tags": {f"EXIF Tag{j}": f"value {j}" for j in range(60)},
+        },
+        "original_filename": f"IMG_{i:04d}.HEIC",
+        "preview_key": f"previews/{i:08d}-7f3a2c1e.jpg",
+        "photo_taken_at": datetime(2024, 3, 12, 12, 31, 4, tzinfo=timezone.utc),
+        "created_at": datetime(2024, 3, 12, 18, 2, 11, tzinfo=timezone.utc),
+        "latitude": 30.2669,
+        "longitude": -97.7729,
+    }
+
+
+def previous_path(rows):
+    adapter = TypeAdapter(list[EventOut])
+    objects = [SimpleNamespace(**row) for row in rows]
+    validated = adapter.validate_python(objects, from_attributes=True)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def cpu_per_call(fn, *args) -> float:
+    fn(*args)
+    start = time.process_time()
+    for _ in range(ITERATIONS):
+        result = fn(*args)
+    elapsed = time.process_time() - start
+    return elapsed / ITERATIONS * 1000, len(result)
+
+
+def main():
+    rows = [make_event(i) for i in range(PAGE_SIZE)]
+    cases = [
+        ("previous: pydantic + json", previous_path, rows),
+        ("orjson", serialization.encode_events, rows),
+        ("msgpack", lambda r: serialization.encode_events(r, serialization.MSGPACK), rows),
+        ("orjson + gzip", lambda r: serialization.compress(serialization.encode_events(r), "gzip"), rows),
+    ]
+    if serialization.brotli is not None:
+        cases.append(("orjson + brotli", lambda r: serialization.compress(serialization.encode_events(r), "br"), rows))
+
+    baseline = None
+    print(f"{PAGE_SIZE} events per page, {ITERATIONS} iterations")
+    print(f"{'path':<28}{'cpu ms/request':>16}{'bytes':>10}{'speedup':>10}")
+    for name, fn, arg in cases:
+        ms, size = cpu_per_call(fn, arg)
+        baseline = baseline or ms
+        print(f"{name:<28}{ms:>16.3f}{size:>10}{baseline / ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
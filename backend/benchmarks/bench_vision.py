@@ -0,0 +1,90 @@
+"""
+Benchmark: vision providers per stage, one image at a time vs batched
+
+Runs every available provider over the same synthetic photos (or a
+directory of real ones) and reports per-image latency and throughput. The
+aws provider reads objects from S3, so it is only included with --s3-keys.
+Local labels need VISION_LABEL_MODEL (and optionally VISION_LABEL_NAMES).
+
+Run from backend/:
+    python -m benchmarks.bench_vision
+    python -m benchmarks.bench_vision --images ~/Pictures/sample --batch-sizes 1,4,16
+    python -m benchmarks.bench_vision --providers aws,local --s3-keys uploads/a.jpg,uploads/b.jpg
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from PIL import Image, ImageDraw
+from app import vision
+
+SIZE = (1600, 1200)
+
+
+def synthetic_photos(count: int):
+    photos = []
+    for i in range(count):
+        image = Image.new("RGB", SIZE, (40 + i * 13 % 200, 120, 180))
+        draw = ImageDraw.Draw(image)
+        for j in range(0, SIZE[0], 64):
+            draw.ellipse([j, (i * 37 + j) % SIZE[1], j + 120, (i * 37 + j) % SIZE[1] + 160], fill=(220, 180, 150))
+        draw.text((40, 40), f"Photo {i}", fill=(0, 0, 0))
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=90)
+        photos.append(output.getvalue())
+    return photos
+
+
+def directory_photos(path: str, count: int):
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+    photos = []
+    for name in names[:count]:
+        with open(os.path.join(path, name), "rb") as f:
+            photos.append(f.read())
+    return photos
+
+
+def time_stage(provider, stage: str, images, batch_size: int) -> float:
+    """Seconds per image running the stage in batches of batch_size"""
+    provider.run(stage, images[:1])  # warm up (model load, cascade load)
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        provider.run(stage, images[i:i + batch_size])
+    return (time.perf_counter() - start) / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare vision providers")
+    parser.add_argument("--providers", default="local,mock")
+    parser.add_argument("--stages", default=",".join(vision.VISION_STAGES))
+    parser.add_argument("--batch-sizes", default="1,8")
+    parser.add_argument("--count", type=int, default=32)
+    parser.add_argument("--images", help="Directory of JPEG/PNG photos instead of synthetic ones")
+    parser.add_argument("--s3-keys", help="Comma-separated S3 keys (needed for the aws provider)")
+    args = parser.parse_args()
+
+    if args.s3_keys:
+        images = [vision.VisionImage(key) for key in args.s3_keys.split(",")]
+    else:
+        photos = directory_photos(args.images, args.count) if args.images else synthetic_photos(args.count)
+        images = [vision.VisionImage(f"bench/{i}.jpg", data) for i, data in enumerate(photos)]
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    print(f"{len(images)} images")
+    print(f"{'provider':<10}{'stage':<8}{'batch':>7}{'ms/image':>12}{'images/s':>12}")
+    for name in args.providers.split(","):
+        provider = vision.get_provider(name)
+        for stage in args.stages.split(","):
+            if not provider.supports(stage):
+                print(f"{name:<10}{stage:<8}{'unavailable':>31}")
+                continue
+            for batch_size in (batch_sizes if provider.batched else [1]):
+                seconds = time_stage(provider, stage, images, batch_size)
+                print(f"{name:<10}{stage:<8}{batch_size:>7}{seconds * 1000:>12.2f}{1 / max(seconds, 1e-9):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Local stand-ins for the external providers, for load tests
+
+One threaded HTTP server answers everything the backend calls out to:
+- S3 (path-style PutObject, GetObject with Range, HeadObject, DeleteObject(s)),
+  kept in memory
+- Rekognition DetectFaces/DetectLabels and Textract DetectDocumentText
+  (same endpoint, told apart by X-Amz-Target); answers are canned and vary
+  per object key, so the stage planner skips OCR/faces for some images
+- OpenAI chat completions (/v1/chat/completions)
+- LocationIQ reverse geocoding (/v1/reverse.php)
+Each provider has its own latency and error rate; injected errors are the
+provider's 5xx so they count against the circuit breakers.
+
+Point the backend at it with settings.aws_endpoint_url, openai_base_url and
+locationiq_url (see env_for). Standalone:
+    python -m benchmarks.fake_providers --port 9100 --latency openai=800,s3=20 --error-rate openai=0.02
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+PROVIDERS = ("s3", "rekognition", "textract", "openai", "locationiq")
+
+# Canned Rekognition labels; each object gets one set, picked by key
+LABEL_SETS = (
+    [("Person", 98.2), ("Outdoors", 95.1), ("Nature", 91.0), ("Tree", 88.4), ("Lake", 80.3)],
+    [("Food", 97.5), ("Meal", 93.0), ("Table", 90.2), ("Restaurant", 72.6)],
+    [("Text", 96.4), ("Document", 94.8), ("Paper", 85.0)],
+    [("Landscape", 97.0), ("Mountain", 94.2), ("Sky", 92.7), ("Scenery", 88.1)],
+    [("Person", 99.1), ("Crowd", 90.5), ("Party", 84.2), ("Text", 62.0), ("Poster", 58.3)],
+)
+CATEGORIES = ("nature", "food", "travel", "family", "celebration")
+
+
+@dataclass
+class Fault:
+    latency_ms: float = 0
+    jitter: float = 0.0       # +- fraction of latency_ms
+    error_rate: float = 0.0   # share of requests answered with a 5xx
+
+    def delay(self) -> float:
+        if not self.latency_ms:
+            return 0.0
+        spread = self.latency_ms * self.jitter
+        return max(self.latency_ms + random.uniform(-spread, spread), 0) / 1000
+
+
+def parse_faults(latency: str = "", error_rate: str = "", jitter: float = 0.0) -> Dict[str, Fault]:
+    """Faults from "openai=800,s3=20" style specs ("*" applies to every provider)"""
+    faults = {provider: Fault(jitter=jitter) for provider in PROVIDERS}
+    for spec, field, cast in ((latency, "latency_ms", float), (error_rate, "error_rate", float)):
+        for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+            name, _, value = item.partition("=")
+            names = PROVIDERS if name == "*" else (name,)
+            for provider in names:
+                if provider not in faults:
+                    raise ValueError(f"Unknown provider '{provider}'. Available: {', '.join(PROVIDERS)}")
+                setattr(faults[provider], field, cast(value))
+    return faults
+
+
+def _pick(key: str, options):
+    return options[zlib.crc32(key.encode()) % len(options)]
+
+
+def _decode_aws_chunked(body: bytes) -> bytes:
+    """Payload of an aws-chunked upload (size;chunk-signature=...\\r\\ndata\\r\\n ... 0\\r\\n)"""
+    data, position = bytearray(), 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        position = line_end + 2 + size + 2
+
+
+class FakeProviders:
+    """The server plus its state: stored objects, faults and request counts"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, faults: Optional[Dict[str, Fault]] = None):
+        self.faults = faults or parse_faults()
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env_for(self, bucket: str = "loadtest") -> Dict[str, str]:
+        """Environment that points the backend's settings at this server"""
+        return {
+            "AWS_ENDPOINT_URL": self.url,
+            "AWS_ACCESS_KEY_ID": "fake",
+            "AWS_SECRET_ACCESS_KEY": "fake",
+            "AWS_BUCKET_NAME": bucket,
+            "AWS_REGION": "us-east-1",
+            "OPENAI_API_KEY": "fake",
+            "OPENAI_BASE_URL": f"{self.url}/v1",
+            "LOCATIONIQ_API_KEY": "fake",
+            "LOCATIONIQ_URL": f"{self.url}/v1/reverse.php",
+        }
+
+    def start(self) -> "FakeProviders":
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-providers", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+    def _handler_class(self):
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_HEAD(self):
+                self._dispatch()
+
+            def do_PUT(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def do_DELETE(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                target = self.headers.get("X-Amz-Target") or ""
+                path = urlsplit(self.path).path
+                if target.startswith("RekognitionService."):
+                    provider, handle = "rekognition", self._rekognition
+                elif target.startswith("Textract."):
+                    provider, handle = "textract", self._textract
+                elif path.startswith("/v1/chat/completions"):
+                    provider, handle = "openai", self._openai
+                elif path.startswith("/v1/reverse"):
+                    provider, handle = "locationiq", self._locationiq
+                else:
+                    provider, handle = "s3", self._s3
+
+                fault = fakes.faults[provider]
+                with fakes.lock:
+                    fakes.calls[provider] += 1
+                time.sleep(fault.delay())
+                if fault.error_rate and random.random() < fault.error_rate:
+                    with fakes.lock:
+                        fakes.errors[provider] += 1
+                    return self._error(provider)
+                try:
+                    handle(body, target)
+                except Exception as e:
+                    self._send(500, json.dumps({"message": str(e)}).encode(), "application/json")
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "application/json",
+                      headers: Optional[Dict[str, str]] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _json(self, payload, content_type: str = "application/json"):
+                self._send(200, json.dumps(payload).encode(), content_type)
+
+            def _error(self, provider: str):
+                if provider == "s3":
+                    body = b"<?xml version='1.0'?><Error><Code>InternalError</Code><Message>Injected error</Message></Error>"
+                    return self._send(500, body, "application/xml")
+                if provider in ("rekognition", "textract"):
+                    payload = {"__type": "InternalServerError", "message": "Injected error"}
+                    return self._send(500, json.dumps(payload).encode(), "application/x-amz-json-1.1")
+                payload = {"error": {"message": "Injected error", "type": "server_error"}}
+                return self._send(500, json.dumps(payload).encode())
+
+            # S3
+
+            def _s3(self, body: bytes, target: str):
+                parts = urlsplit(self.path)
+                bucket, _, key = unquote(parts.path).lstrip("/").partition("/")
+                query = parse_qs(parts.query, keep_blank_values=True)
+                if self.command == "PUT":
+                    if key:
+                        if "aws-chunked" in (self.headers.get("Content-Encoding") or "") or \
+                                (self.headers.get("x-amz-content-sha256") or "").startswith("STREAMING-"):
+                            body = _decode_aws_chunked(body)
+                        with fakes.lock:
+                            fakes.objects[(bucket, key)] = body
+                        return self._send(200, headers={"ETag": f'"{zlib.crc32(body):08x}"'})
+                    return self._send(200)
+                if self.command == "POST" and "delete" in query:
+                    keys = [element.text for element in ElementTree.fromstring(body).iter() if element.tag.endswith("Key")]
+                    with fakes.lock:
+                        for deleted in keys:
+                            fakes.objects.pop((bucket, deleted), None)
+                    result = "".join(f"<Deleted><Key>{escape(deleted)}</Key></Deleted>" for deleted in keys)
+                    return self._send(200, f"<DeleteResult>{result}</DeleteResult>".encode(), "application/xml")
+                if self.command == "DELETE":
+                    with fakes.lock:
+                        fakes.objects.pop((bucket, key), None)
+                    return self._send(204)
+
+                with fakes.lock:
+                    data = fakes.objects.get((bucket, key))
+                if data is None:
+                    body = f"<Error><Code>NoSuchKey</Code><Key>{escape(key)}</Key></Error>".encode()
+                    return self._send(404, body, "application/xml")
+                byte_range = self.headers.get("Range")
+                if byte_range and byte_range.startswith("bytes="):
+                    start, _, end = byte_range[len("bytes="):].partition("-")
+                    first, last = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+                    return self._send(206, data[first:last + 1], "image/jpeg",
+                                      {"Content-Range": f"bytes {first}-{last}/{len(data)}"})
+                return self._send(200, data, "image/jpeg")
+
+            # Rekognition / Textract
+
+            def _rekognition(self, body: bytes, target: str):
+                key = json.loads(body or b"{}").get("Image", {}).get("S3Object", {}).get("Name", "")
+                if target.endswith("DetectFaces"):
+                    face = {
+                        "AgeRange": {"Low": 28, "High": 36},
+                        "Gender": {"Value": "Male", "Confidence": 99.0},
+                        "Emotions": [{"Type": "HAPPY", "Confidence": 91.2}, {"Type": "CALM", "Confidence": 6.1}],
+                        "Confidence": 99.9,
+                    }
+                    return self._json({"FaceDetails": [face] * (1 + zlib.crc32(key.encode()) % 3)},
+                                      "application/x-amz-json-1.1")
+                labels = [{"Name": name, "Confidence": confidence} for name, confidence in _pick(key, LABEL_SETS)]
+                return self._json({"Labels": labels, "LabelModelVersion": "3.0"}, "application/x-amz-json-1.1")
+
+            def _textract(self, body: bytes, target: str):
+                lines = ["OPEN 9AM - 5PM", "Lakeside Trail", "Welcome"]
+                blocks = [{"BlockType": "PAGE"}] + [{"BlockType": "LINE", "Text": line, "Confidence": 98.0} for line in lines]
+                return self._json({"Blocks": blocks, "DocumentMetadata": {"Pages": 1}}, "application/x-amz-json-1.1")
+
+            # OpenAI / LocationIQ
+
+            def _openai(self, body: bytes, target: str):
+                request = json.loads(body or b"{}")
+                prompt = json.dumps(request.get("messages", []))
+                if "Category:" in prompt:
+                    content = _pick(prompt, CATEGORIES)
+                else:
+                    content = "John spent a calm afternoon by the lake, enjoying the view before heading home."
+                self._json({
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                              "total_tokens": (len(prompt) + len(content)) // 4},
+                })
+
+            def _locationiq(self, body: bytes, target: str):
+                query = parse_qs(urlsplit(self.path).query)
+                lat, lon = query.get("lat", ["0"])[0], query.get("lon", ["0"])[0]
+                self._json({
+                    "lat": lat,
+                    "lon": lon,
+                    "display_name": "Lakeside Trail, San Francisco, California, United States",
+                    "address": {"road": "Lakeside Trail", "city": "San Francisco", "country": "United States"},
+                })
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake S3/Rekognition/Textract/OpenAI/LocationIQ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="", help="Per provider ms, e.g. openai=800,s3=20 (* for all)")
+    parser.add_argument("--error-rate", default="", help="Per provider share of 5xx, e.g. openai=0.02")
+    parser.add_argument("--jitter", type=float, default=0.25, help="+- fraction of the latency")
+    args = parser.parse_args()
+
+    fakes = FakeProviders(args.host, args.port, parse_faults(args.latency, args.error_rate, args.jitter))
+    print(f"Fake providers on {fakes.url}; point the backend at them with:")
+    for name, value in fakes.env_for().items():
+        print(f"  {name}={value}")
+    try:
+        fakes.server.serve_forever()
+    except KeyboardInterrupt:
+        fakes.stop()
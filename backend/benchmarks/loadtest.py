@@ -0,0 +1,369 @@
+"""
+Load test: the API under mixed upload/list/image traffic, end to end
+
+Boots the backend with uvicorn against a database (Postgres via
+--database-url, otherwise a throwaway SQLite file) and the local provider
+stand-ins from fake_providers.py, then runs each scenario for --duration
+seconds with --users virtual users in a closed loop. Per scenario it reports
+throughput, latency percentiles per operation, end-to-end processing time of
+uploads (upload until the event is completed, polled from the timeline) and
+how many provider calls the traffic caused.
+
+Run from backend/:
+    python -m benchmarks.loadtest
+    python -m benchmarks.loadtest --database-url postgresql://localhost/loadtest --users 32 --workers 4
+    python -m benchmarks.loadtest --scenarios upload --latency openai=1500,rekognition=300 --error-rate openai=0.05
+    python -m benchmarks.loadtest --env PLANNER_ENABLED=false --json before.json
+    python -m benchmarks.loadtest --max-p99-ms 2000 --max-error-rate 0.01   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image, TiffImagePlugin
+
+from .fake_providers import FakeProviders, parse_faults
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Operation weights per scenario
+SCENARIOS = {
+    "upload": {"upload": 1.0},
+    "browse": {"list": 0.6, "image": 0.3, "image_urls": 0.1},
+    "mixed": {"upload": 0.2, "list": 0.5, "image": 0.25, "image_urls": 0.05},
+}
+UPLOADS_PER_SESSION = 20   # virtual users move to a new session so pending events stay on the first page
+POLL_INTERVAL = 0.25       # seconds between timeline polls for pending uploads
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    return {name: (round(percentile(values, q), 1) if values else None)
+            for name, q in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))}
+
+
+def make_images(count: int, width: int, height: int) -> List[bytes]:
+    """Noisy synthetic photos (realistic JPEG sizes); every other one has EXIF GPS"""
+    images = []
+    for i in range(count):
+        noise = Image.effect_noise((width, height), 40 + i * 3)
+        gradient = Image.linear_gradient("L").resize((width, height))
+        image = Image.merge("RGB", (noise, gradient, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        exif = Image.Exif()
+        exif[0x0132] = f"2024:06:{i % 28 + 1:02d} 12:30:00"
+        if i % 2 == 0:
+            rational = TiffImagePlugin.IFDRational
+            exif[0x8825] = {
+                1: "N", 2: (rational(37), rational(46), rational(30 + i)),
+                3: "W", 4: (rational(122), rational(25), rational(10)),
+            }
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=85, exif=exif)
+        images.append(output.getvalue())
+    return images
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, op: str, ms: float, ok: bool) -> None:
+        self.latencies.setdefault(op, []).append(ms)
+        if not ok:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+
+class Tracker:
+    """Uploads waiting for background processing, resolved by polling the timeline"""
+
+    def __init__(self):
+        self.pending: Dict[int, tuple] = {}   # event id -> (session id, upload start)
+        self.done: List[float] = []
+        self.failed = 0
+
+    def add(self, event_id: int, session_id: str, started: float) -> None:
+        self.pending[event_id] = (session_id, started)
+
+    async def poll(self, client: httpx.AsyncClient) -> None:
+        for session_id in {session for session, _ in self.pending.values()}:
+            try:
+                response = await client.get("/api/events", params={"session_id": session_id})
+                events = response.json() if response.status_code == 200 else []
+            except httpx.HTTPError:
+                continue
+            now = time.perf_counter()
+            for event in events:
+                entry = self.pending.get(event["id"])
+                if entry and event["processing_status"] in ("completed", "failed"):
+                    del self.pending[event["id"]]
+                    if event["processing_status"] == "completed":
+                        self.done.append((now - entry[1]) * 1000)
+                    else:
+                        self.failed += 1
+
+    async def run(self, client: httpx.AsyncClient, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            await self.poll(client)
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+class VirtualUser:
+    def __init__(self, number: int, run_id: str, images: List[bytes], keys: List[str]):
+        self.number = number
+        self.run_id = run_id
+        self.images = images
+        self.keys = keys   # shared across users: stored images to fetch
+        self.uploads = 0
+
+    @property
+    def session_id(self) -> str:
+        return f"loadtest-{self.run_id}-{self.number}-{self.uploads // UPLOADS_PER_SESSION}"
+
+    async def upload(self, client: httpx.AsyncClient, tracker: Optional[Tracker]) -> bool:
+        session_id = self.session_id
+        started = time.perf_counter()
+        response = await client.post(
+            "/api/upload",
+            files={"file": (f"photo-{self.uploads}.jpg", random.choice(self.images), "image/jpeg")},
+            data={"caption": "Afternoon by the lake", "session_id": session_id},
+        )
+        if response.status_code != 200:
+            return False
+        self.uploads += 1
+        event = response.json()
+        self.keys.append(event["source"])
+        if tracker is not None:
+            tracker.add(event["id"], session_id, started)
+        return True
+
+    async def step(self, op: str, client: httpx.AsyncClient, tracker: Tracker) -> bool:
+        if op == "upload":
+            return await self.upload(client, tracker)
+        if op == "list":
+            response = await client.get("/api/events", params={"session_id": self.session_id, "urls": "true"})
+        elif op == "image":
+            response = await client.get(f"/api/image/{random.choice(self.keys)}")
+        elif op == "image_urls":
+            keys = random.sample(self.keys, min(len(self.keys), 50))
+            response = await client.post("/api/image-urls", json={"keys": keys})
+        else:
+            raise ValueError(f"Unknown operation '{op}'")
+        return response.status_code == 200
+
+
+async def run_scenario(name: str, base_url: str, users: List[VirtualUser], duration: float,
+                       drain: float, think_ms: float) -> dict:
+    weights = SCENARIOS[name]
+    operations, op_weights = list(weights), list(weights.values())
+    stats, tracker, stop = Stats(), Tracker(), asyncio.Event()
+    limits = httpx.Limits(max_connections=len(users) + 4, max_keepalive_connections=len(users) + 4)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def user_loop(user: VirtualUser):
+            while not stop.is_set():
+                op = random.choices(operations, op_weights)[0]
+                started = time.perf_counter()
+                try:
+                    ok = await user.step(op, client, tracker)
+                except httpx.HTTPError:
+                    ok = False
+                stats.record(op, (time.perf_counter() - started) * 1000, ok)
+                if think_ms:
+                    await asyncio.sleep(random.uniform(0, 2 * think_ms) / 1000)
+
+        poller = asyncio.create_task(tracker.run(client, stop))
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(user_loop(user)) for user in users]
+        await asyncio.sleep(duration)
+        stop.set()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        await poller
+
+        # Let in-flight processing finish so its time is counted
+        drain_until = time.perf_counter() + drain
+        while tracker.pending and time.perf_counter() < drain_until:
+            await asyncio.sleep(POLL_INTERVAL)
+            await tracker.poll(client)
+
+    requests = sum(len(values) for values in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    return {
+        "duration_s": round(elapsed, 1),
+        "users": len(users),
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "error_rate": round(errors / requests, 4) if requests else 0.0,
+        "operations": {
+            op: {"count": len(values), "rps": round(len(values) / elapsed, 1),
+                 "errors": stats.errors.get(op, 0), **latency_summary(values)}
+            for op, values in stats.latencies.items()
+        },
+        "processing": {
+            "completed": len(tracker.done), "failed": tracker.failed, "unfinished": len(tracker.pending),
+            **latency_summary(tracker.done),
+        },
+    }
+
+
+def start_backend(port: int, env: Dict[str, str], workers: int, log_path: str) -> subprocess.Popen:
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    log = open(log_path, "w")
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Backend exited during startup")
+        try:
+            if httpx.get(f"{base_url}/ready", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Backend not ready after {timeout:.0f}s")
+
+
+def print_report(name: str, result: dict, provider_calls: Dict[str, int], uploads: int) -> None:
+    print(f"\nscenario {name}: {result['requests']} requests in {result['duration_s']} s "
+          f"with {result['users']} users, {result['rps']} req/s, {result['error_rate']:.2%} errors")
+    print(f"{'operation':<12}{'count':>8}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    rows = list(result["operations"].items())
+    if "upload" in result["operations"]:
+        rows.append(("processing", {**result["processing"], "count": result["processing"]["completed"],
+                                    "rps": None, "errors": result["processing"]["failed"]}))
+    for op, row in rows:
+        rps = f"{row['rps']:>8}" if row["rps"] is not None else f"{'':>8}"
+        cells = "".join(f"{row[q]:>9.0f}" if row[q] is not None else f"{'-':>9}" for q in ("p50", "p90", "p99", "max"))
+        print(f"{op:<12}{row['count']:>8}{rps}{row['errors']:>8}{cells}")
+    if result["processing"]["unfinished"]:
+        print(f"{result['processing']['unfinished']} uploads still processing after the drain")
+    if provider_calls:
+        per_upload = f" ({', '.join(f'{p} {n / uploads:.1f}' for p, n in provider_calls.items())} per upload)" if uploads else ""
+        print(f"provider calls: {', '.join(f'{p} {n}' for p, n in provider_calls.items())}{per_upload}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test with fake providers")
+    parser.add_argument("--scenarios", default="mixed", help=f"Comma-separated: {', '.join(SCENARIOS)}")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per scenario")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users")
+    parser.add_argument("--think-ms", type=float, default=0, help="Mean pause between a user's requests")
+    parser.add_argument("--drain", type=float, default=60, help="Seconds to wait for pending processing")
+    parser.add_argument("--database-url", default=os.environ.get("LOADTEST_DATABASE_URL"),
+                        help="Defaults to a throwaway SQLite file")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--images", type=int, default=6, help="Distinct synthetic photos")
+    parser.add_argument("--image-size", default="2016x1512")
+    parser.add_argument("--latency", default="s3=15,rekognition=250,textract=400,openai=900,locationiq=120",
+                        help="Per provider ms, e.g. openai=800,s3=20 (* for all)")
+    parser.add_argument("--error-rate", default="", help="Per provider share of 5xx, e.g. openai=0.02")
+    parser.add_argument("--jitter", type=float, default=0.25, help="+- fraction of the latency")
+    parser.add_argument("--env", action="append", default=[], help="Extra backend setting, KEY=VALUE (repeatable)")
+    parser.add_argument("--backend-log", help="Keep the backend's output in this file")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit with status 1 if any operation's p99 exceeds this")
+    parser.add_argument("--max-error-rate", type=float, help="Exit with status 1 if a scenario's error rate exceeds this")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario '{name}'. Available: {', '.join(SCENARIOS)}")
+    width, height = (int(value) for value in args.image_size.lower().split("x"))
+
+    fakes = FakeProviders(faults=parse_faults(args.latency, args.error_rate, args.jitter)).start()
+    images = make_images(args.images, width, height)
+    print(f"{len(images)} photos, {sum(map(len, images)) // len(images) // 1024} KB average; fake providers on {fakes.url}")
+
+    if not args.database_url:
+        print("No --database-url: using SQLite, which serializes writes; use Postgres for capacity numbers")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, **fakes.env_for(), "DATABASE_URL": args.database_url or f"sqlite:///{tmp}/loadtest.db"}
+        for name in ("AWS_SESSION_TOKEN", "AWS_PROFILE"):
+            env.pop(name, None)
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        log_path = args.backend_log or os.path.join(tmp, "backend.log")
+        process = start_backend(port, env, args.workers, log_path)
+        results, failures = {}, []
+        try:
+            wait_ready(base_url, process)
+            run_id = f"{int(time.time())}"
+            keys: List[str] = []
+            users = [VirtualUser(number, run_id, images, keys) for number in range(args.users)]
+
+            async def seed():
+                # Every user starts with one stored photo so list/image traffic has something to read
+                async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+                    await asyncio.gather(*(user.upload(client, None) for user in users))
+            asyncio.run(seed())
+            if not keys:
+                raise RuntimeError("Seeding uploads failed")
+
+            for name in scenarios:
+                before = fakes.snapshot()["calls"]
+                uploads_before = sum(user.uploads for user in users)
+                result = asyncio.run(run_scenario(name, base_url, users, args.duration, args.drain, args.think_ms))
+                after = fakes.snapshot()["calls"]
+                result["provider_calls"] = {p: after.get(p, 0) - before.get(p, 0) for p in after if after.get(p, 0) - before.get(p, 0)}
+                results[name] = result
+                print_report(name, result, result["provider_calls"], sum(user.uploads for user in users) - uploads_before)
+
+                if args.max_error_rate is not None and result["error_rate"] > args.max_error_rate:
+                    failures.append(f"{name}: error rate {result['error_rate']:.2%} exceeds {args.max_error_rate:.2%}")
+                for op, row in result["operations"].items():
+                    if args.max_p99_ms is not None and row["p99"] is not None and row["p99"] > args.max_p99_ms:
+                        failures.append(f"{name}/{op}: p99 {row['p99']:.0f} ms exceeds {args.max_p99_ms:.0f} ms")
+        except Exception:
+            with open(log_path) as log:
+                print("Backend log (last 40 lines):\n" + "".join(log.readlines()[-40:]))
+            raise
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            fakes.stop()
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ("json", "database_url")}
+        with open(args.json, "w") as output:
+            json.dump({"config": config, "scenarios": results}, output, indent=2)
+        print(f"\nResults written to {args.json}")
+    if failures:
+        print("\nFAIL:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# Settings require a database URL; the tests here never connect to it
+os.environ.setdefault("DATABASE_URL", "sqlite://")
@@ -0,0 +1,55 @@
+"""
+Property checks of the geographic helpers (run from backend/: python -m pytest tests)
+"""
+import math
+import random
+from app.geo import EARTH_RADIUS_KM, haversine_km, radius_bbox
+from app.geo_index import split_antimeridian
+
+
+def destination(latitude: float, longitude: float, bearing: float, distance_km: float):
+    """Point distance_km from a start point along an initial bearing (radians)"""
+    angle = distance_km / EARTH_RADIUS_KM
+    phi1, lambda1 = math.radians(latitude), math.radians(longitude)
+    phi2 = math.asin(math.sin(phi1) * math.cos(angle) + math.cos(phi1) * math.sin(angle) * math.cos(bearing))
+    lambda2 = lambda1 + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(phi1),
+                                   math.cos(angle) - math.sin(phi1) * math.sin(phi2))
+    return math.degrees(phi2), (math.degrees(lambda2) + 540.0) % 360.0 - 180.0
+
+
+def in_boxes(latitude: float, longitude: float, bbox) -> bool:
+    return any(
+        min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+        for min_lat, min_lon, max_lat, max_lon in split_antimeridian(bbox)
+    )
+
+
+def check_random_circles(rng: random.Random, centers, samples: int = 20000) -> None:
+    for _ in range(samples):
+        latitude, longitude = centers()
+        radius_km = rng.uniform(1, 3000)
+        point = destination(latitude, longitude, rng.uniform(0, 2 * math.pi), rng.uniform(0, radius_km))
+        assert haversine_km(latitude, longitude, *point) <= radius_km * (1 + 1e-9)
+        assert in_boxes(*point, radius_bbox(latitude, longitude, radius_km)), (latitude, longitude, radius_km, point)
+
+
+def test_radius_bbox_contains_circle_at_high_latitudes():
+    rng = random.Random(34)
+    check_random_circles(rng, lambda: (rng.choice((-1, 1)) * rng.uniform(60, 89.9), rng.uniform(-180, 180)))
+
+
+def test_radius_bbox_contains_circle_across_the_antimeridian():
+    rng = random.Random(180)
+    check_random_circles(rng, lambda: (rng.uniform(-85, 85), rng.choice((-1, 1)) * rng.uniform(170, 180)))
+
+
+def test_radius_bbox_reported_case():
+    bbox = radius_bbox(-82.32, 155.05, 487)
+    assert haversine_km(-82.32, 155.05, -83.52, -172.18) <= 487
+    assert in_boxes(-83.52, -172.18, bbox)
+
+
+def test_radius_bbox_stays_narrow_away_from_the_antimeridian():
+    min_lat, min_lon, max_lat, max_lon = radius_bbox(48.85, 2.35, 10)
+    assert min_lon < 2.35 < max_lon and max_lon - min_lon < 1
+    assert min_lat < 48.85 < max_lat and max_lat - min_lat < 1
@@ -43,7 +43,7 @@ export const api = {
   },
   async events() {
     const sessionId = getSessionId();
-    const res = await fetch(`${this.base}/api/events?session_id=${encodeURIComponent(sessionId)}`, { cache: "no-store" });
+    const res = await fetch(`${this.base}/api/events?session_id=${encodeURIComponent(sessionId)}&urls=true`, { cache: "no-cache" });
     if (!res.ok) throw new Error("Request failed");
     return res.json();
   },
@@ -61,11 +61,22 @@ export const api = {
     return `${this.base}/api/image/${s3Key}`;
   },
   async truncateEvents() {
-    // TODO: Implement backend endpoint to truncate all events from database
     const res = await fetch(`${this.base}/api/truncate-events`, {
       method: "POST",
     });
     if (!res.ok) throw new Error("Truncate failed");
-    return res.json();
+    const { job_id } = await res.json();
+    return this.waitForJob(job_id);
+  },
+  async waitForJob(jobId: string, intervalMs = 500) {
+    // Poll a background job until it finishes
+    while (true) {
+      const res = await fetch(`${this.base}/api/jobs/${jobId}`, { cache: "no-store" });
+      if (!res.ok) throw new Error("Job status request failed");
+      const job = await res.json();
+      if (job.status === "failed") throw new Error(job.error || "Job failed");
+      if (job.status === "completed" || job.status === "cancelled") return job;
+      await new Promise((resolve) => setTimeout(resolve, intervalMs));
+    }
   }
 };
\ No newline at end of file
@@ -2,12 +2,17 @@
 import React, { useEffect, useState, useRef } from "react";
 import { api } from "./lib/api";
 
-function ImageDisplay({ s3Key, thumbnail = false }: { s3Key: string, thumbnail?: boolean }) {
-  const [imageUrl, setImageUrl] = useState<string>("");
+function ImageDisplay({ s3Key, url, thumbnail = false }: { s3Key: string, url?: string, thumbnail?: boolean }) {
+  const [imageUrl, setImageUrl] = useState<string>(url || "");
   
   useEffect(() => {
-    api.getImageUrl(s3Key).then(setImageUrl);
-  }, [s3Key]);
+    // Presigned storage URL from the event when available, else the backend proxy
+    if (url) {
+      setImageUrl(url);
+    } else {
+      api.getImageUrl(s3Key).then(setImageUrl);
+    }
+  }, [s3Key, url]);
 
   if (!imageUrl) {
     return thumbnail ? (
@@ -51,6 +56,11 @@ function ImageDisplay({ s3Key, thumbnail = false }: { s3Key: string, thumbnail?:
         }}
         onError={(e) => {
           console.log(`Image failed: ${imageUrl}`);
+          if (url && imageUrl === url) {
+            // Expired or unreachable storage URL: retry through the proxy
+            api.getImageUrl(s3Key).then(setImageUrl);
+            return;
+          }
           e.currentTarget.style.display = "none";
         }}
       />
@@ -69,6 +79,9 @@ type Event = {
   ai_results?: any;
   heic_metadata?: any;
   original_filename?: string;
+  preview_key?: string;
+  image_url?: string;
+  preview_url?: string;
   photo_taken_at?: string;
   created_at: string;
 };
@@ -551,8 +564,8 @@ export default function Page() {
                   borderRadius: 4,
                   overflow: "hidden"
                 }}>
-                  {ev.source && (
-                    <ImageDisplay s3Key={ev.source} thumbnail={true} />
+                  {(ev.preview_key || ev.source) && (
+                    <ImageDisplay s3Key={(ev.preview_key || ev.source)!} url={ev.preview_url} thumbnail={true} />
                   )}
                 </div>
                 